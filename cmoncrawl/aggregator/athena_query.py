@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import asyncio
 import hashlib
+import importlib.util
 import logging
 import tempfile
 import uuid
@@ -11,10 +12,13 @@ from pathlib import Path
 from typing import (
     AsyncIterator,
     Deque,
+    Dict,
     List,
     Optional,
     Set,
+    Tuple,
 )
+from urllib.parse import urlparse
 
 import aioboto3
 import aiofiles
@@ -23,25 +27,89 @@ from aiocsv.readers import AsyncDictReader
 from aiohttp import ClientSession
 
 from cmoncrawl.aggregator.base import IAggregator
-from cmoncrawl.aggregator.gateway_query import crawl_to_year
 from cmoncrawl.aggregator.utils.athena_query_maker import (
     crawl_url_to_name,
     prepare_athena_sql_query,
+    prepare_athena_subset_query,
+    split_url_key_ranges,
+    unload_query,
+    url_table_columns,
+    url_table_rows,
 )
+from cmoncrawl.aggregator.utils.checkpoint import AggregationCheckpoint
 from cmoncrawl.aggregator.utils.constants import CC_INDEXES_SERVER
+from cmoncrawl.aggregator.utils.crawl_catalog import (
+    CrawlCatalog,
+    crawl_in_date_range,
+    get_crawl_catalog,
+)
 from cmoncrawl.aggregator.utils.helpers import (
-    get_all_CC_indexes,
+    AWSClientPool,
     remove_bucket_prefix,
     run_athena_query,
 )
 from cmoncrawl.common.loggers import all_purpose_logger
 from cmoncrawl.common.types import (
+    CollapseMode,
     DomainRecord,
+    DomainRecordBatch,
     MatchType,
+    RecordFilter,
 )
 
 QUERIES_SUBFOLDER = "queries"
 QUERIES_TMP_SUBFOLDER = "queries_tmp"
+URL_TABLES_SUBFOLDER = "url_tables"
+SUBSET_TABLES_SUBFOLDER = "subset_tables"
+# CTAS and INSERT INTO can write at most 100 partitions each
+MAX_PARTITIONS_PER_QUERY = 100
+UNLOADED_SUBFOLDER = "unloaded"
+CSV_RESULT_SUFFIX = ".csv"
+# UNLOAD writes the list of the parquet files to the query results location
+UNLOAD_RESULT_SUFFIX = "-manifest.csv"
+CC_INDEX_TABLE_LOCATION = "s3://commoncrawl/cc-index/table/cc-main/warc/"
+CC_INDEX_SUBSETS = ["warc", "robotstxt", "crawldiagnostics"]
+
+
+def partition_projection_properties(crawls: List[str]) -> Dict[str, str]:
+    """
+    Table properties projecting the crawl/subset partitions of the index,
+    so Athena computes the partition locations instead of listing S3 with MSCK REPAIR.
+    """
+    return {
+        "projection.enabled": "true",
+        "projection.crawl.type": "enum",
+        "projection.crawl.values": ",".join(crawls),
+        "projection.subset.type": "enum",
+        "projection.subset.values": ",".join(CC_INDEX_SUBSETS),
+        "storage.location.template": CC_INDEX_TABLE_LOCATION
+        + "crawl=${crawl}/subset=${subset}/",
+    }
+
+
+def sql_properties(properties: Dict[str, str]) -> str:
+    return ",\n".join(f"'{key}' = '{value}'" for key, value in properties.items())
+
+
+def append_result_row(batch: DomainRecordBatch, row: Dict[str, str]):
+    """
+    Appends a row of the query result to the batch
+    """
+    batch.append(
+        filename=row["warc_filename"],
+        url=row["url"],
+        offset=int(row["warc_record_offset"]),
+        length=int(row["warc_record_length"]),
+        digest=row.get("content_digest") or None,
+        timestamp=datetime.strptime(row["fetch_time"], "%Y-%m-%d %H:%M:%S.%f"),
+    )
+
+
+async def iter_batches(
+    batches: List[DomainRecordBatch],
+) -> AsyncIterator[DomainRecordBatch]:
+    for batch in batches:
+        yield batch
 
 
 class AthenaAggregator(IAggregator):
@@ -60,7 +128,7 @@ class AthenaAggregator(IAggregator):
         since (datetime, optional): The start date for the search. Defaults to datetime.min.
         to (datetime, optional): The end date for the search. Defaults to datetime.max.
         limit (int, optional): The maximum number of results to return. Defaults to None.
-        prefetch_size (int, optional): The number of indexes to fetch concurrently. Defaults to 3.
+        prefetch_size (int, optional): The number of finished query results to download ahead. Defaults to 2.
         max_retry (int, optional): The maximum number of retries for a single request. Defaults to 5.
         extra_sql_where_clause (str, optional): Additional SQL WHERE clause to append to the Athena query. Defaults to None.
         batch_size (int): How many crawls to query at once. Defaults to 1. If <= 0, all crawls will be queried at once.
@@ -69,6 +137,17 @@ class AthenaAggregator(IAggregator):
         catalog_name (str, optional): The Athena catalog to use. Defaults to "AwsDataCatalog".
         database_name (str, optional): The Athena database to use. Defaults to "commoncrawl".
         table_name (str, optional): The Athena table to use. Defaults to "ccindex".
+        crawl_catalog (CrawlCatalog, optional): Catalog used to skip crawls outside of the date range. If None and cc_servers are not set, it will be retrieved from the cc_indexes_server. Defaults to None.
+        checkpoint (AggregationCheckpoint, optional): Persisted progress, re-running with the same state file skips the finished crawl batches. Defaults to None.
+        record_filter (RecordFilter, optional): Filter on the index records, translated to the query conditions. If it doesn't set statuses, only 200 captures are returned. Defaults to None.
+        url_table_threshold (int, optional): Url lists longer than this are uploaded to the bucket as a table (the urls for EXACT, SURT key ranges otherwise) and joined, instead of OR-ing a condition per url, which would exceed the query length limit. Defaults to 100.
+        collapse (CollapseMode, optional): Keep only the first/latest capture of every url (per crawl for PER_CRAWL), so that the same page isn't downloaded multiple times. FIRST and LATEST query all crawls in a single batch, as the captures of an url must be compared across crawls. Defaults to None (all captures).
+        materialize_subset (bool, optional): First copy all warc captures of the urls in the cc_servers crawls to a parquet table in the bucket, partitioned by crawl, and run the queries against it. The table is named by the hash of the urls and crawls, so later runs with other dates, filters or extra clauses reuse it and scan only the small table. Defaults to False.
+        max_concurrent_queries (int, optional): Maximum number of crawl batch queries running at once. All crawl batches are dispatched at once and their results are read in the order the queries finish, keep it under the Athena quota of active queries. Defaults to 20.
+        max_pool_connections (int, optional): Size of the connection pool of the S3 and Athena clients, which are opened once and shared for the lifetime of the aggregator. Defaults to 50.
+        max_direct_result_rows (int, optional): Results with at most this many rows, as reported by the query runtime statistics, are read with GetQueryResults instead of downloading the CSV from S3, which makes small lookups nearly interactive. 0 disables it. Defaults to 1000.
+        split_queries (int, optional): Split the query of every crawl batch into up to this many queries over consecutive SURT key ranges of the urls, which run concurrently and whose results are streamed as they finish. Huge DOMAIN matches are split into the host and its subdomains by their first character. Defaults to 1 (no split).
+        unload (bool, optional): Write the results with UNLOAD as parquet files and stream them from S3 row group by row group, instead of downloading and parsing the whole CSV. Requires pyarrow. Defaults to False.
 
     Examples:
         >>> async with AthenaAggregator(["example.com"]) as aggregator:
@@ -95,6 +174,17 @@ class AthenaAggregator(IAggregator):
         catalog_name: str = "AwsDataCatalog",
         database_name: str = "commoncrawl",
         table_name: str = "ccindex",
+        crawl_catalog: Optional[CrawlCatalog] = None,
+        checkpoint: Optional[AggregationCheckpoint] = None,
+        record_filter: Optional[RecordFilter] = None,
+        collapse: Optional[CollapseMode] = None,
+        url_table_threshold: int = 100,
+        materialize_subset: bool = False,
+        unload: bool = False,
+        max_concurrent_queries: int = 20,
+        max_pool_connections: int = 50,
+        max_direct_result_rows: int = 1000,
+        split_queries: int = 1,
     ) -> None:
         self.urls = urls
         self.match_type = match_type
@@ -107,6 +197,19 @@ class AthenaAggregator(IAggregator):
         self.prefetch_size = prefetch_size
         self.batch_size = batch_size
         self.sleep_base = sleep_base
+        self.crawl_catalog = crawl_catalog
+        self.checkpoint = checkpoint
+        self.record_filter = record_filter
+        self.collapse = collapse
+        self.url_table_threshold = url_table_threshold
+        self.url_table: Optional[str] = None
+        self.unload = unload
+        self.max_concurrent_queries = max_concurrent_queries
+        self.max_pool_connections = max_pool_connections
+        self.max_direct_result_rows = max_direct_result_rows
+        self.split_queries = split_queries
+        self.materialize_subset = materialize_subset
+        self.subset_table: Optional[str] = None
 
         # AWS
         self.aws_profile = aws_profile
@@ -129,6 +232,8 @@ class AthenaAggregator(IAggregator):
             raise ValueError(
                 "If you want to limit the number of results, batch_size must be > 0, to avoid overfetching"
             )
+        if self.unload and importlib.util.find_spec("pyarrow") is None:
+            raise ValueError("unload requires pyarrow to be installed")
 
     async def __aenter__(self) -> AthenaAggregator:
         return await self.aopen()
@@ -140,11 +245,17 @@ class AthenaAggregator(IAggregator):
         self.aws_client = aioboto3.Session(
             profile_name=self.aws_profile, region_name="us-east-1"
         )
-        async with ClientSession() as client:
-            if not self.cc_servers:
-                self.cc_servers = await get_all_CC_indexes(client, CC_INDEXES_SERVER)
+        # Shared by all the requests of the aggregator and its iterators
+        self.aws_clients = AWSClientPool(self.aws_client, self.max_pool_connections)
+        if not self.cc_servers:
+            if self.crawl_catalog is None:
+                async with ClientSession() as client:
+                    self.crawl_catalog = await get_crawl_catalog(
+                        client, CC_INDEXES_SERVER
+                    )
+            self.cc_servers = self.crawl_catalog.cdx_apis
         # create bucket if not exists
-        async with self.aws_client.client("s3") as s3:
+        async with self.aws_clients.client("s3") as s3:
             # Check if bucket exists
             bucket = None
             try:
@@ -160,36 +271,89 @@ class AthenaAggregator(IAggregator):
 
         # create database and table if not exists
         if not await self.__commoncrawl_database_and_table_exists(
-            self.aws_client,
+            self.aws_clients,
             self.catalog_name,
             self.database_name,
             self.table_name,
         ):
             await self.__create_commoncrawl_database_and_table(
-                self.aws_client,
+                self.aws_clients,
+                self.bucket_name,
+                self.catalog_name,
+                self.database_name,
+                self.table_name,
+            )
+        else:
+            await self.__update_crawl_projection(
+                self.aws_clients,
                 self.bucket_name,
                 self.catalog_name,
                 self.database_name,
                 self.table_name,
             )
+        if len(self.urls) > self.url_table_threshold:
+            self.url_table = await self.__create_url_table(
+                self.aws_clients, self.bucket_name, self.database_name
+            )
+        if self.materialize_subset:
+            self.subset_table = await self.__create_subset_table(
+                self.aws_clients,
+                self.bucket_name,
+                self.catalog_name,
+                self.database_name,
+            )
         return self
 
     async def aclose(self) -> AthenaAggregator:
-        await self.cleanup()
+        if self.checkpoint is not None:
+            self.checkpoint.save()
+        try:
+            await self.cleanup()
+        finally:
+            await self.aws_clients.aclose()
         return self
 
     async def cleanup(self):
         if not self.delete_bucket:
             return
 
+        # The tables would point to the deleted bucket
+        for table in [self.url_table, self.subset_table]:
+            if table is not None:
+                await self.__drop_table(
+                    self.aws_clients, self.bucket_name, self.database_name, table
+                )
+
         all_purpose_logger.info(f"Deleting bucket {self.bucket_name}")
-        async with self.aws_client.client("s3") as s3:
-            await remove_bucket_prefix(self.aws_client, self.bucket_name, "")
+        async with self.aws_clients.client("s3") as s3:
+            await remove_bucket_prefix(self.aws_clients, self.bucket_name, "")
             await s3.delete_bucket(Bucket=self.bucket_name)
 
+    async def __drop_table(
+        self,
+        session: aioboto3.Session | AWSClientPool,
+        s3_bucket: str,
+        database: str,
+        table: str,
+    ):
+        prefix = f"DDL-{uuid.uuid4()}"
+        try:
+            await run_athena_query(
+                session,
+                {
+                    "QueryString": f"DROP TABLE IF EXISTS {database}.{table}",
+                    "QueryExecutionContext": {"Database": database},
+                    "ResultConfiguration": {
+                        "OutputLocation": f"s3://{s3_bucket}/{prefix}"
+                    },
+                },
+            )
+        finally:
+            await remove_bucket_prefix(session, s3_bucket, prefix)
+
     async def __commoncrawl_database_and_table_exists(
         self,
-        session: aioboto3.Session,
+        session: aioboto3.Session | AWSClientPool,
         catalog_name: str,
         database_name: str,
         table_name: str,
@@ -205,9 +369,64 @@ class AthenaAggregator(IAggregator):
                 return False
             return len(response["TableMetadataList"]) > 0
 
+    def __projected_crawls(self, existing: Optional[List[str]] = None) -> List[str]:
+        """
+        Crawls of the catalog and the queried ones, which the table must project
+        """
+        crawls = set(existing or [])
+        crawls.update(crawl_url_to_name(crawl) for crawl in self.cc_servers or [])
+        if self.crawl_catalog is not None:
+            crawls.update(crawl.id for crawl in self.crawl_catalog.crawls)
+        return sorted(crawls, reverse=True)
+
+    async def __update_crawl_projection(
+        self,
+        session: aioboto3.Session | AWSClientPool,
+        s3_bucket: str,
+        catalog: str,
+        database: str,
+        table: str,
+    ):
+        """
+        Adds the queried crawls, which were released after the table was created,
+        to its projected partitions. Tables created with MSCK REPAIR are switched to projection.
+        """
+        async with session.client("athena") as athena:
+            response = await athena.get_table_metadata(
+                CatalogName=catalog, DatabaseName=database, TableName=table
+            )
+        parameters = response["TableMetadata"].get("Parameters", {})
+        projected = [
+            crawl
+            for crawl in parameters.get("projection.crawl.values", "").split(",")
+            if crawl
+        ]
+        crawls = self.__projected_crawls(projected)
+        if parameters.get("projection.enabled") == "true" and set(crawls) <= set(
+            projected
+        ):
+            return
+
+        all_purpose_logger.info(f"Updating projected crawls of {database}.{table}")
+        prefix = f"DDL-{uuid.uuid4()}"
+        try:
+            await run_athena_query(
+                session,
+                {
+                    "QueryString": f"ALTER TABLE {database}.{table} SET TBLPROPERTIES (\n"
+                    f"{sql_properties(partition_projection_properties(crawls))})",
+                    "QueryExecutionContext": {"Database": database},
+                    "ResultConfiguration": {
+                        "OutputLocation": f"s3://{s3_bucket}/{prefix}"
+                    },
+                },
+            )
+        finally:
+            await remove_bucket_prefix(session, s3_bucket, prefix)
+
     async def __create_commoncrawl_database_and_table(
         self,
-        session: aioboto3.Session,
+        session: aioboto3.Session | AWSClientPool,
         s3_bucket: str,
         catalog: str,
         database: str,
@@ -261,7 +480,9 @@ class AthenaAggregator(IAggregator):
             crawl                         STRING,
             subset                        STRING)
             STORED AS parquet
-            LOCATION 's3://commoncrawl/cc-index/table/cc-main/warc/';
+            LOCATION '{CC_INDEX_TABLE_LOCATION}'
+            TBLPROPERTIES (
+            {sql_properties(partition_projection_properties(self.__projected_crawls()))});
             """
             await run_athena_query(
                 session,
@@ -271,24 +492,128 @@ class AthenaAggregator(IAggregator):
                     "ResultConfiguration": {"OutputLocation": results_location},
                 },
             )
-            # TODO make sure that if table is not partitioned, this function will run
-            repair_statement = f"MSCK REPAIR TABLE {database}.{table};"
+        finally:
+            # remove all query results
+            await remove_bucket_prefix(session, s3_bucket, prefix)
+
+    async def __create_url_table(
+        self, session: aioboto3.Session | AWSClientPool, s3_bucket: str, database: str
+    ) -> str:
+        """
+        Uploads the rows of `url_table_rows` to the bucket and creates a table over them.
+        The table is named by the hash of its content, so re-runs with the same urls reuse it.
+        """
+        body = "".join(
+            "\t".join(row) + "\n" for row in url_table_rows(self.urls, self.match_type)
+        )
+        table = f"{self.table_name}_urls_{hashlib.sha256(body.encode('utf-8')).hexdigest()[:16]}"
+        location = f"{URL_TABLES_SUBFOLDER}/{table}"
+        async with session.client("s3") as s3:
+            await s3.put_object(
+                Bucket=s3_bucket, Key=f"{location}/urls.tsv", Body=body.encode("utf-8")
+            )
+
+        columns = ",\n            ".join(
+            f"{column:<30}STRING" for column in url_table_columns(self.match_type)
+        )
+        prefix = f"DDL-{uuid.uuid4()}"
+        try:
+            create_table_query = f"""
+            CREATE EXTERNAL TABLE IF NOT EXISTS {database}.{table} (
+            {columns})
+            ROW FORMAT DELIMITED FIELDS TERMINATED BY '\\t'
+            LOCATION 's3://{s3_bucket}/{location}/';
+            """
             await run_athena_query(
                 session,
                 {
-                    "QueryString": repair_statement,
+                    "QueryString": create_table_query,
                     "QueryExecutionContext": {"Database": database},
-                    "ResultConfiguration": {"OutputLocation": results_location},
+                    "ResultConfiguration": {
+                        "OutputLocation": f"s3://{s3_bucket}/{prefix}"
+                    },
                 },
             )
         finally:
-            # remove all query results
             await remove_bucket_prefix(session, s3_bucket, prefix)
+        all_purpose_logger.info(f"Created url table {table} for {len(self.urls)} urls")
+        return table
+
+    async def __create_subset_table(
+        self,
+        session: aioboto3.Session | AWSClientPool,
+        s3_bucket: str,
+        catalog: str,
+        database: str,
+    ) -> str:
+        """
+        Materializes the captures of the urls in a parquet table partitioned by crawl.
+        The table is named by the hash of its content, so re-runs with the same urls reuse it.
+        """
+        crawls = sorted(
+            {crawl_url_to_name(crawl) for crawl in self.cc_servers or []}, reverse=True
+        )
+        definition = "\n".join(
+            [self.match_type.value, *crawls]
+            + ["\t".join(row) for row in url_table_rows(self.urls, self.match_type)]
+        )
+        table = f"{self.table_name}_subset_{hashlib.sha256(definition.encode('utf-8')).hexdigest()[:16]}"
+        if await self.__commoncrawl_database_and_table_exists(
+            session, catalog, database, table
+        ):
+            all_purpose_logger.info(f"Using subset table {table}")
+            return table
+
+        location = f"s3://{s3_bucket}/{SUBSET_TABLES_SUBFOLDER}/{table}/"
+        prefix = f"DDL-{uuid.uuid4()}"
+        # A failed attempt could leave the files behind
+        await remove_bucket_prefix(
+            session, s3_bucket, f"{SUBSET_TABLES_SUBFOLDER}/{table}/"
+        )
+        try:
+            for i in range(0, len(crawls), MAX_PARTITIONS_PER_QUERY):
+                select_query = prepare_athena_subset_query(
+                    self.urls,
+                    crawls[i : i + MAX_PARTITIONS_PER_QUERY],
+                    database,
+                    self.table_name,
+                    self.match_type,
+                    url_table=self.url_table,
+                )
+                if i == 0:
+                    query = (
+                        f"CREATE TABLE {database}.{table}\n"
+                        f"WITH (format = 'PARQUET', external_location = '{location}', "
+                        "partitioned_by = ARRAY['crawl', 'subset'])\n"
+                        f"AS {select_query}"
+                    )
+                else:
+                    query = f"INSERT INTO {database}.{table}\n{select_query}"
+                await run_athena_query(
+                    session,
+                    {
+                        "QueryString": query,
+                        "QueryExecutionContext": {"Database": database},
+                        "ResultConfiguration": {
+                            "OutputLocation": f"s3://{s3_bucket}/{prefix}"
+                        },
+                    },
+                )
+        except Exception:
+            # Don't leave a table with only some of the crawls
+            await self.__drop_table(session, s3_bucket, database, table)
+            raise
+        finally:
+            await remove_bucket_prefix(session, s3_bucket, prefix)
+        all_purpose_logger.info(
+            f"Created subset table {table} for {len(self.urls)} urls in {len(crawls)} crawls"
+        )
+        return table
 
     class AthenaAggregatorIterator(AsyncIterator[DomainRecord]):
         def __init__(
             self,
-            aws_client: aioboto3.Session,
+            aws_client: aioboto3.Session | AWSClientPool,
             urls: List[str],
             cc_servers: List[str],
             match_type: MatchType,
@@ -303,13 +628,38 @@ class AthenaAggregator(IAggregator):
             bucket_name: str,
             database_name: str,
             table_name: str,
+            crawl_catalog: Optional[CrawlCatalog] = None,
+            checkpoint: Optional[AggregationCheckpoint] = None,
+            record_filter: Optional[RecordFilter] = None,
+            collapse: Optional[CollapseMode] = None,
+            url_table: Optional[str] = None,
+            unload: bool = False,
+            max_concurrent_queries: int = 20,
+            max_direct_result_rows: int = 1000,
+            split_queries: int = 1,
+            record_batch_size: int = 10_000,
         ):
             self.__aws_client = aws_client
             self.__since = since
             self.__to = to
-            self.__crawls_remaining: List[List[str]] = self.init_crawls_queue(
-                cc_servers, batch_size
+            self.__crawl_catalog = crawl_catalog
+            if collapse in (CollapseMode.FIRST, CollapseMode.LATEST):
+                # The captures of an url must be ranked across all crawls
+                batch_size = 0
+            # Every crawl batch is queried once per key range
+            key_ranges: List[Optional[Tuple[str, str]]] = (
+                list(split_url_key_ranges(urls, match_type, split_queries))
+                if split_queries > 1
+                else [None]
             )
+            self.__crawls_remaining: List[
+                Tuple[List[str], Optional[Tuple[str, str]]]
+            ] = [
+                (crawl_batch, key_range)
+                for crawl_batch in self.init_crawls_queue(cc_servers, batch_size)
+                for key_range in key_ranges
+            ]
+            # Records of the current batch of the first result stream
             self.__domain_records: Deque[DomainRecord] = deque()
             self.__limit = limit
             self.__match_type = match_type
@@ -319,10 +669,44 @@ class AthenaAggregator(IAggregator):
             self.__database_name = database_name
             self.__table_name = table_name
             self.__extra_sql_where_clause = extra_sql_where_clause
-            self.__prefetch_queue: Set[asyncio.Task[List[DomainRecord]]] = set()
+            # Running queries, the keys of their results once finished
+            # and the results being read
+            self.__query_tasks: Set[asyncio.Task[Tuple[str, str]]] = set()
+            self.__finished_queries: Deque[Tuple[str, str]] = deque()
+            self.__prefetch_queue: Set[
+                asyncio.Task[Tuple[AsyncIterator[DomainRecordBatch], str]]
+            ] = set()
+            self.__query_semaphore = asyncio.Semaphore(max_concurrent_queries)
+            self.__max_direct_result_rows = max_direct_result_rows
+            # Records of the small results read with GetQueryResults, by result key
+            self.__direct_results: Dict[str, DomainRecordBatch] = {}
+            self.__record_batch_size = record_batch_size
             self.__opt_prefetch_size = prefetch_size
             self.__sleep_base = sleep_base
             self.__max_retry = max_retry
+            self.__checkpoint = checkpoint
+            self.__record_filter = record_filter
+            self.__collapse = collapse
+            self.__url_table = url_table
+            self.__unload = unload
+            self.__result_suffix = UNLOAD_RESULT_SUFFIX if unload else CSV_RESULT_SUFFIX
+            # Results of the finished queries, streamed one after another
+            self.__result_streams: Deque[
+                Tuple[AsyncIterator[DomainRecordBatch], str]
+            ] = deque()
+            if checkpoint is not None:
+                checkpoint.bind(
+                    {
+                        "urls": urls,
+                        "match_type": match_type.value,
+                        "since": since,
+                        "to": to,
+                        "extra_sql_where_clause": extra_sql_where_clause,
+                        "record_filter": record_filter,
+                        "collapse": collapse,
+                    }
+                )
+                self.__total = checkpoint.total
 
         def init_crawls_queue(
             self, CC_files: List[str], batch_size: int
@@ -330,8 +714,9 @@ class AthenaAggregator(IAggregator):
             allowed_crawls = [
                 crawl_url_to_name(crawl)
                 for crawl in CC_files
-                if (self.__since is None or crawl_to_year(crawl) >= self.__since.year)
-                and (self.__to is None or crawl_to_year(crawl) <= self.__to.year)
+                if crawl_in_date_range(
+                    crawl, self.__since, self.__to, self.__crawl_catalog
+                )
             ]
             if batch_size <= 0:
                 return [allowed_crawls]
@@ -349,6 +734,15 @@ class AthenaAggregator(IAggregator):
 
         async def __await_athena_query(self, query: str, result_name: str) -> str:
             s3_location = f"s3://{self.__bucket_name}/{QUERIES_TMP_SUBFOLDER}"
+            if self.__unload:
+                # UNLOAD fails if the location isn't empty, e.g. after a failed attempt
+                unload_folder = f"{UNLOADED_SUBFOLDER}/{result_name}/"
+                await remove_bucket_prefix(
+                    self.__aws_client, self.__bucket_name, unload_folder
+                )
+                query = unload_query(
+                    query, f"s3://{self.__bucket_name}/{unload_folder}"
+                )
             query_execution_id = await run_athena_query(
                 self.__aws_client,
                 {
@@ -357,44 +751,157 @@ class AthenaAggregator(IAggregator):
                     "ResultConfiguration": {"OutputLocation": s3_location},
                 },
             )
+            if self.__unload or not await self.__is_small_result(query_execution_id):
+                return await self.__move_query_result(query_execution_id, result_name)
+
+            # The result is still moved to be cached, but the records are read
+            # from Athena directly instead of downloading the file
+            batch, expected_result_key = await asyncio.gather(
+                self.__get_query_results(query_execution_id),
+                self.__move_query_result(query_execution_id, result_name),
+            )
+            self.__direct_results[expected_result_key] = batch
+            return expected_result_key
+
+        async def __move_query_result(
+            self, query_execution_id: str, result_name: str
+        ) -> str:
             # Move file to bucket/result_name
-            query_result_key = f"{QUERIES_TMP_SUBFOLDER}/{query_execution_id}.csv"
-            expected_result_key = f"{QUERIES_SUBFOLDER}/{result_name}.csv"
+            query_result_key = (
+                f"{QUERIES_TMP_SUBFOLDER}/{query_execution_id}{self.__result_suffix}"
+            )
+            expected_result_key = (
+                f"{QUERIES_SUBFOLDER}/{result_name}{self.__result_suffix}"
+            )
             async with self.__aws_client.client("s3") as s3:
                 await s3.copy_object(
                     Bucket=self.__bucket_name,
                     CopySource=f"{self.__bucket_name}/{query_result_key}",
                     Key=expected_result_key,
                 )
-                await s3.delete_object(
-                    Bucket=self.__bucket_name,
-                    Key=f"{QUERIES_TMP_SUBFOLDER}/{query_execution_id}.csv",
-                )
+                await s3.delete_object(Bucket=self.__bucket_name, Key=query_result_key)
             return expected_result_key
 
+        async def __is_small_result(self, query_execution_id: str) -> bool:
+            """
+            Decides from the runtime statistics of the query, whether the result
+            has at most max_direct_result_rows rows
+            """
+            if self.__max_direct_result_rows <= 0:
+                return False
+            async with self.__aws_client.client(
+                "athena", region_name=self.__aws_client.region_name or "us-east-1"
+            ) as athena:
+                try:
+                    response = await athena.get_query_runtime_statistics(
+                        QueryExecutionId=query_execution_id
+                    )
+                except Exception as e:
+                    all_purpose_logger.debug(
+                        f"Runtime statistics of {query_execution_id} are not available {str(e)}"
+                    )
+                    return False
+            output_rows = (
+                response["QueryRuntimeStatistics"].get("Rows", {}).get("OutputRows")
+            )
+            return (
+                output_rows is not None and output_rows <= self.__max_direct_result_rows
+            )
+
+        async def __get_query_results(
+            self, query_execution_id: str
+        ) -> DomainRecordBatch:
+            """
+            Reads the result rows with paginated GetQueryResults
+            """
+            batch = DomainRecordBatch()
+            async with self.__aws_client.client(
+                "athena", region_name=self.__aws_client.region_name or "us-east-1"
+            ) as athena:
+                paginator = athena.get_paginator("get_query_results")
+                header: List[str] | None = None
+                async for page in paginator.paginate(
+                    QueryExecutionId=query_execution_id
+                ):
+                    rows = page["ResultSet"]["Rows"]
+                    if header is None:
+                        # The first row of the first page holds the column names
+                        header = [
+                            column["Name"]
+                            for column in page["ResultSet"]["ResultSetMetadata"][
+                                "ColumnInfo"
+                            ]
+                        ]
+                        rows = rows[1:]
+                    for row in rows:
+                        values = [
+                            column.get("VarCharValue", "") for column in row["Data"]
+                        ]
+                        append_result_row(batch, dict(zip(header, values)))
+            return batch
+
         async def domain_records_from_s3(
             self, csv_file: str
         ) -> AsyncIterator[DomainRecord]:
+            async for batch in self.domain_record_batches_from_csv(csv_file):
+                for domain_record in batch.domain_records():
+                    yield domain_record
+
+        async def domain_record_batches_from_csv(
+            self, csv_file: str
+        ) -> AsyncIterator[DomainRecordBatch]:
+            """
+            Reads the CSV result into batches of at most record_batch_size records
+            """
+            if csv_file in self.__direct_results:
+                # Already read with GetQueryResults
+                yield self.__direct_results.pop(csv_file)
+                return
+
             # download file
             csv_file = await self.__download_results(csv_file)
             try:
+                batch = DomainRecordBatch()
                 async with aiofiles.open(csv_file, mode="r") as afp:
                     async for row in AsyncDictReader(afp):
-                        yield DomainRecord(
-                            url=row["url"],
-                            timestamp=datetime.strptime(
-                                row["fetch_time"], "%Y-%m-%d %H:%M:%S.%f"
-                            ),
-                            filename=row["warc_filename"],
-                            offset=int(row["warc_record_offset"]),
-                            length=int(row["warc_record_length"]),
-                        )
+                        append_result_row(batch, row)
+                        if len(batch) >= self.__record_batch_size:
+                            yield batch
+                            batch = DomainRecordBatch()
+                if len(batch) > 0:
+                    yield batch
             finally:
                 # remove file
                 Path(csv_file).unlink()
 
+        async def domain_record_batches_from_s3(
+            self, manifest_key: str
+        ) -> AsyncIterator[DomainRecordBatch]:
+            """
+            Streams the parquet files listed in the UNLOAD manifest, a batch per row group
+            """
+            from cmoncrawl.aggregator.utils.parquet_stream import (
+                arrow_to_domain_record_batch,
+                iter_s3_parquet_row_groups,
+            )
+
+            async with self.__aws_client.client("s3") as s3:
+                response = await s3.get_object(
+                    Bucket=self.__bucket_name, Key=manifest_key
+                )
+                manifest = (await response["Body"].read()).decode("utf-8")
+                for location in manifest.splitlines():
+                    if not location:
+                        continue
+                    parsed = urlparse(location)
+                    async for table in iter_s3_parquet_row_groups(
+                        s3, parsed.netloc, parsed.path.lstrip("/")
+                    ):
+                        for batch in table.to_batches():
+                            yield arrow_to_domain_record_batch(batch)
+
         async def is_crawl_cached(self, query_id: str):
-            key = f"{QUERIES_SUBFOLDER}/{query_id}.csv"
+            key = f"{QUERIES_SUBFOLDER}/{query_id}{self.__result_suffix}"
             async with self.__aws_client.client("s3") as s3:
                 try:
                     await s3.head_object(Bucket=self.__bucket_name, Key=key)
@@ -402,7 +909,12 @@ class AthenaAggregator(IAggregator):
                 except s3.exceptions.ClientError:
                     return None
 
-        async def __fetch_next_crawl_batch(self, crawl_batch: List[str]):
+        def __crawl_batch_query(
+            self, crawl_batch: List[str], key_range: Optional[Tuple[str, str]] = None
+        ) -> Tuple[str, str]:
+            """
+            Returns the query of the crawl batch, restricted to the key range if set, and its id
+            """
             query = prepare_athena_sql_query(
                 self.__urls,
                 self.__since,
@@ -412,6 +924,11 @@ class AthenaAggregator(IAggregator):
                 self.__table_name,
                 self.__match_type,
                 self.__extra_sql_where_clause,
+                crawl_catalog=self.__crawl_catalog,
+                record_filter=self.__record_filter,
+                collapse=self.__collapse,
+                url_table=self.__url_table,
+                key_range=key_range,
             )
             query_hash = hashlib.sha256(query.encode("utf-8")).hexdigest()
             crawl_batch_id = (
@@ -419,25 +936,10 @@ class AthenaAggregator(IAggregator):
                 if len(crawl_batch) == 1
                 else f"{crawl_batch[0]}...{crawl_batch[-1]}"
             )
-            query_id = f"{crawl_batch_id}-{query_hash}"
-            crawl_s3_key = await self.is_crawl_cached(query_id)
-            if crawl_s3_key is not None:
-                all_purpose_logger.info(f"Using cached crawl batch {crawl_batch}")
-            else:
-                all_purpose_logger.info(f"Querying for crawl batch {crawl_batch}")
-                crawl_s3_key = await self.__await_athena_query(query, query_id)
-
-            domain_records: List[DomainRecord] = []
-            async for domain_record in self.domain_records_from_s3(crawl_s3_key):
-                domain_records.append(domain_record)
-            return domain_records
+            return query, f"{crawl_batch_id}-{query_hash}"
 
-        async def __await_next_prefetch(self):
-            """
-            Gets the next athen result and adds it to the prefetch queue
-            """
-
-            @tenacity.retry(
+        def __retrying(self):
+            return tenacity.retry(
                 wait=tenacity.wait_random_exponential(
                     multiplier=5, exp_base=self.__sleep_base, max=120
                 ),
@@ -448,59 +950,224 @@ class AthenaAggregator(IAggregator):
                 ),
                 reraise=True,
             )
-            async def fetch_next_crawl_batch(crawl_batch: List[str]):
-                return await self.__fetch_next_crawl_batch(crawl_batch)
 
-            # Wait for the next prefetch to finish
-            # Don't prefetch if limit is set to avoid overfetching
+        async def __run_crawl_batch_query(
+            self, crawl_batch: List[str], key_range: Optional[Tuple[str, str]] = None
+        ) -> Tuple[str, str]:
+            """
+            Returns the key of the crawl batch result and its id,
+            running the query if it's not cached.
+            """
+            query, query_id = self.__crawl_batch_query(crawl_batch, key_range)
+            crawl_s3_key = await self.is_crawl_cached(query_id)
+            if crawl_s3_key is not None:
+                all_purpose_logger.info(f"Using cached crawl batch {crawl_batch}")
+                return crawl_s3_key, query_id
+
+            # Queries over the concurrency quota would be rejected
+            async with self.__query_semaphore:
+                all_purpose_logger.info(f"Querying for crawl batch {crawl_batch}")
+                crawl_s3_key = await self.__await_athena_query(query, query_id)
+            return crawl_s3_key, query_id
+
+        async def __read_crawl_batch_results(self, crawl_s3_key: str, query_id: str):
+            if self.__unload:
+                return self.domain_record_batches_from_s3(crawl_s3_key), query_id
+
+            # The CSV is read whole, while the previous results are consumed
+            batches = [
+                batch
+                async for batch in self.domain_record_batches_from_csv(crawl_s3_key)
+            ]
+            return iter_batches(batches), query_id
+
+        def __dispatch_queries(self):
+            """
+            Starts the queries of the remaining crawl batches, Athena runs at most
+            max_concurrent_queries of them at once.
+            """
+            # Don't query ahead if limit is set to avoid overfetching
             while len(self.__crawls_remaining) > 0 and (
-                len(self.__prefetch_queue) == 0
+                self.__limit is None
                 or (
-                    self.__limit is None
-                    and len(self.__prefetch_queue) <= self.__opt_prefetch_size
+                    len(self.__query_tasks) == 0
+                    and len(self.__finished_queries) == 0
+                    and len(self.__prefetch_queue) == 0
+                )
+            ):
+                next_crawl_batch, key_range = self.__crawls_remaining.pop(0)
+                if self.__checkpoint is not None and self.__checkpoint.is_batch_done(
+                    self.__crawl_batch_query(next_crawl_batch, key_range)[1]
+                ):
+                    all_purpose_logger.info(
+                        f"Skipping finished crawl batch {next_crawl_batch}"
+                    )
+                    continue
+                self.__query_tasks.add(
+                    asyncio.create_task(
+                        self.__retrying()(self.__run_crawl_batch_query)(
+                            next_crawl_batch, key_range
+                        )
+                    )
                 )
+
+        def __start_result_reads(self):
+            """
+            Starts reading the results of the finished queries, at most prefetch_size at once
+            """
+            while len(self.__finished_queries) > 0 and len(self.__prefetch_queue) < max(
+                1, self.__opt_prefetch_size
             ):
-                next_crawl_batch = self.__crawls_remaining.pop(0)
+                crawl_s3_key, query_id = self.__finished_queries.popleft()
                 self.__prefetch_queue.add(
-                    asyncio.create_task(fetch_next_crawl_batch(next_crawl_batch))
+                    asyncio.create_task(
+                        self.__retrying()(self.__read_crawl_batch_results)(
+                            crawl_s3_key, query_id
+                        )
+                    )
                 )
 
-            while len(self.__prefetch_queue) > 0 and len(self.__domain_records) == 0:
-                done, self.__prefetch_queue = await asyncio.wait(
-                    self.__prefetch_queue, return_when="FIRST_COMPLETED"
+        def __in_flight(self) -> bool:
+            return (
+                len(self.__query_tasks) > 0
+                or len(self.__finished_queries) > 0
+                or len(self.__prefetch_queue) > 0
+            )
+
+        async def __await_next_prefetch(self):
+            """
+            Waits until the results of the next finished query are read
+            """
+            self.__dispatch_queries()
+            while (
+                self.__in_flight()
+                and len(self.__domain_records) == 0
+                and len(self.__result_streams) == 0
+            ):
+                self.__start_result_reads()
+                done, _ = await asyncio.wait(
+                    self.__query_tasks | self.__prefetch_queue,
+                    return_when="FIRST_COMPLETED",
                 )
                 for task in done:
+                    if task in self.__query_tasks:
+                        self.__query_tasks.remove(task)
+                        try:
+                            self.__finished_queries.append(task.result())
+                        except Exception as e:
+                            all_purpose_logger.error(
+                                f"Error during a crawl query {str(e)}"
+                            )
+                        continue
+
+                    self.__prefetch_queue.remove(task)
                     try:
-                        domain_records = task.result()
-                        self.__domain_records.extend(domain_records)
+                        self.__result_streams.append(task.result())
                     except Exception as e:
-                        all_purpose_logger.error(f"Error during a crawl query {str(e)}")
+                        all_purpose_logger.error(
+                            f"Error during reading a crawl query {str(e)}"
+                        )
+                self.__dispatch_queries()
+
+        async def __read_next_result_batch(self) -> Optional[DomainRecordBatch]:
+            """
+            Reads the next batch of the first result stream, None if the stream ended
+            """
+            stream, batch_id = self.__result_streams[0]
+            try:
+                batch = await anext(stream, None)
+            except Exception as e:
+                # The batch stays unfinished, so that it's read again on resume
+                all_purpose_logger.error(f"Error during reading a crawl query {str(e)}")
+                self.__result_streams.popleft()
+                return None
+            if batch is None:
+                self.__result_streams.popleft()
+                # All records of the stream were already processed
+                if self.__checkpoint is not None:
+                    self.__checkpoint.complete_batch(batch_id)
+            return batch
+
+        def __is_exhausted(self) -> bool:
+            return (
+                not self.__in_flight()
+                and len(self.__crawls_remaining) == 0
+                and len(self.__domain_records) == 0
+                and len(self.__result_streams) == 0
+            )
+
+        async def next_record_batch(self) -> Optional[DomainRecordBatch]:
+            """
+            Returns the next batch of the result, or None if there are no more records.
+            Batches are returned as they were decoded from parquet or CSV,
+            without creating the individual DomainRecord objects.
+            """
+            if self.__checkpoint is not None:
+                self.__checkpoint.total = self.__total
+            while self.__limit is None or self.__total < self.__limit:
+                if len(self.__result_streams) > 0:
+                    batch = await self.__read_next_result_batch()
+                    if batch is None or len(batch) == 0:
+                        continue
+                    if self.__limit is not None:
+                        batch.truncate(self.__limit - self.__total)
+                    self.__total += len(batch)
+                    return batch
+
+                await self.__await_next_prefetch()
+                if self.__is_exhausted():
+                    # No more data to fetch
+                    return None
+            return None
 
         async def __anext__(self) -> DomainRecord:
+            # Asking for the next record means, the previous one was processed
+            if self.__checkpoint is not None:
+                self.__checkpoint.total = self.__total
+
             # Stop if we fetched everything or reached limit
             if self.__limit is not None and self.__total >= self.__limit:
                 raise StopAsyncIteration
 
             # Nothing prefetched
             while len(self.__domain_records) == 0:
+                if len(self.__result_streams) > 0:
+                    batch = await self.__read_next_result_batch()
+                    if batch is not None:
+                        self.__domain_records.extend(batch.domain_records())
+                    continue
                 await self.__await_next_prefetch()
-                if (
-                    len(self.__prefetch_queue) == 0
-                    and len(self.__crawls_remaining) == 0
-                    and len(self.__domain_records) == 0
-                ):
+                if self.__is_exhausted():
                     # No more data to fetch
                     raise StopAsyncIteration
 
-            result = self.__domain_records.popleft()
             self.__total += 1
-            return result
+            return self.__domain_records.popleft()
+
+    async def batches(
+        self, batch_size: int = 10_000
+    ) -> AsyncIterator[DomainRecordBatch]:
+        """
+        Yields the result as DomainRecordBatch, decoded directly from the parquet row groups
+        with unload and from the CSV rows otherwise, without creating the individual DomainRecord objects.
+
+        Args:
+            batch_size (int, optional): Maximum number of records per batch of the CSV results. Defaults to 10_000.
+        """
+        iterator = self.__iterator(batch_size)
+        while (batch := await iterator.next_record_batch()) is not None:
+            yield batch
 
     def __aiter__(self) -> AsyncIterator[DomainRecord]:
+        return self.__iterator()
+
+    def __iterator(
+        self, record_batch_size: int = 10_000
+    ) -> AthenaAggregator.AthenaAggregatorIterator:
         if not self.cc_servers:
             raise ValueError("cc_servers must be initialized before iterating")
         return AthenaAggregator.AthenaAggregatorIterator(
-            aws_client=self.aws_client,
+            aws_client=self.aws_clients,
             urls=self.urls,
             cc_servers=self.cc_servers,
             match_type=self.match_type,
@@ -514,5 +1181,16 @@ class AthenaAggregator(IAggregator):
             extra_sql_where_clause=self.extra_sql_where_clause,
             bucket_name=self.bucket_name,
             database_name=self.database_name,
-            table_name=self.table_name,
+            # Subset table has the same columns, only the captures of the urls
+            table_name=self.subset_table or self.table_name,
+            crawl_catalog=self.crawl_catalog,
+            checkpoint=self.checkpoint,
+            record_filter=self.record_filter,
+            collapse=self.collapse,
+            url_table=self.url_table,
+            unload=self.unload,
+            max_concurrent_queries=self.max_concurrent_queries,
+            max_direct_result_rows=self.max_direct_result_rows,
+            split_queries=self.split_queries,
+            record_batch_size=record_batch_size,
         )
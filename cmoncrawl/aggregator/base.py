@@ -1,10 +1,27 @@
 import abc
-from typing import AsyncContextManager, AsyncIterable
+from typing import AsyncContextManager, AsyncIterable, AsyncIterator
 
-from cmoncrawl.common.types import DomainRecord
+from cmoncrawl.common.types import DomainRecord, DomainRecordBatch
 
 
 class IAggregator(AsyncContextManager, AsyncIterable[DomainRecord], abc.ABC):
     """
     Base interface for aggregators
     """
+
+    async def batches(
+        self, batch_size: int = 10_000
+    ) -> AsyncIterator[DomainRecordBatch]:
+        """
+        Yields the found domain records as columnar batches of at most `batch_size` records.
+        Aggregators, which receive the records in bulk, override it to skip creating
+        the individual DomainRecord objects.
+        """
+        batch = DomainRecordBatch()
+        async for domain_record in self:
+            batch.append_record(domain_record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = DomainRecordBatch()
+        if len(batch) > 0:
+            yield batch
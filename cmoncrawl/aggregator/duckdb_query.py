@@ -0,0 +1,372 @@
+from __future__ import annotations
+
+import asyncio
+import textwrap
+from collections import deque
+from datetime import datetime
+from typing import (
+    AsyncIterator,
+    Deque,
+    List,
+    Optional,
+)
+
+import duckdb
+import pyarrow as pa
+
+from cmoncrawl.aggregator.base import IAggregator
+from cmoncrawl.aggregator.utils.athena_query_maker import (
+    collapse_select,
+    crawl_url_to_name,
+    prepare_athena_where_conditions,
+    sql_string,
+)
+from cmoncrawl.aggregator.utils.crawl_catalog import (
+    CrawlCatalog,
+    crawl_in_date_range,
+)
+from cmoncrawl.aggregator.utils.parquet_stream import arrow_to_domain_record_batch
+from cmoncrawl.aggregator.utils.surt import surt_range
+from cmoncrawl.common.loggers import all_purpose_logger
+from cmoncrawl.common.types import (
+    CollapseMode,
+    DomainRecord,
+    DomainRecordBatch,
+    MatchType,
+    RecordFilter,
+)
+
+CC_INDEX_TABLE_PATH = "s3://commoncrawl/cc-index/table/cc-main/warc"
+
+
+def url_surtkey_range_condition(urls: List[str], match_type: MatchType) -> str:
+    """
+    Condition on url_surtkey, which the parquet files are sorted by.
+    Unlike the host/url conditions, it can be answered from row group statistics.
+    It's only a host (or domain) level range, the exact matching is left to the other conditions.
+    """
+    range_type = MatchType.DOMAIN if match_type == MatchType.DOMAIN else MatchType.HOST
+    conditions = []
+    for url in urls:
+        start, end = surt_range(url, range_type)
+        conditions.append(
+            f"(cc.url_surtkey >= {sql_string(start)} AND cc.url_surtkey < {sql_string(end)})"
+        )
+    return " OR ".join(conditions)
+
+
+def prepare_duckdb_sql_query(
+    urls: List[str],
+    since: Optional[datetime],
+    to: Optional[datetime],
+    crawl_urls: List[str],
+    index_path: str,
+    match_type: MatchType = MatchType.EXACT,
+    extra_sql_where_clause: str | None = None,
+    limit: int | None = None,
+    crawl_catalog: Optional[CrawlCatalog] = None,
+    record_filter: Optional[RecordFilter] = None,
+    collapse: Optional[CollapseMode] = None,
+):
+    """
+    Prepares the same query as Athena, but over the parquet files of the columnar index.
+    The crawl and subset conditions are applied to the hive partitions, so the files
+    of other crawls are never opened.
+    """
+    where_conditions = prepare_athena_where_conditions(
+        urls,
+        since,
+        to,
+        crawl_urls,
+        match_type,
+        crawl_catalog,
+        record_filter,
+        regex_function="regexp_matches",
+    )
+    where_conditions.append(url_surtkey_range_condition(urls, match_type))
+    where_conditions += (
+        [extra_sql_where_clause] if extra_sql_where_clause is not None else []
+    )
+    where_conditions_query = " AND ".join(
+        f"({condition})" for condition in where_conditions
+    )
+    parquet_glob = f"{index_path.rstrip('/')}/crawl=*/subset=*/*.parquet"
+    limit_query = f"\nLIMIT {limit}" if limit is not None else ""
+    source = f"read_parquet({sql_string(parquet_glob)}, hive_partitioning = true)"
+    if collapse is not None:
+        columns = [
+            "url",
+            "fetch_time",
+            "content_digest",
+            "warc_filename",
+            "warc_record_offset",
+            "warc_record_length",
+        ]
+        query = collapse_select(columns, source, where_conditions_query, collapse)
+        return query + limit_query + ";"
+    query = textwrap.dedent(
+        f"""\
+        SELECT cc.url,
+                cc.fetch_time,
+                cc.content_digest,
+                cc.warc_filename,
+                cc.warc_record_offset,
+                cc.warc_record_length
+        FROM {source} AS cc
+        WHERE {where_conditions_query}"""
+    )
+    return query + limit_query + ";"
+
+
+class DuckDBAggregator(IAggregator):
+    """
+    This class is responsible for aggregating the index files from commoncrawl
+    by querying the columnar index (parquet files) with a local DuckDB engine.
+    It is an async context manager which can then be used as an async iterator
+    which yields DomainRecord objects, found in the index files of commoncrawl.
+
+    The query has the same conditions as the one of AthenaAggregator. Crawl conditions prune
+    the hive partitions (crawl=.../subset=...) and url/date conditions are checked against
+    row group statistics, so only the matching row groups are read. The index can be
+    read from a local directory or directly from S3 with ranged reads.
+
+    Args:
+        urls (List[str]): A list of urls to search for.
+        match_type (MatchType, optional): Match type for the urls. Defaults to MatchType.EXACT.
+        cc_servers (List[str], optional): Crawls to query, either crawl ids (CC-MAIN-2023-23) or cdx server urls. If None, all crawls in the index are queried. Defaults to None.
+        since (datetime, optional): The start date for the search. Defaults to datetime.min.
+        to (datetime, optional): The end date for the search. Defaults to datetime.max.
+        limit (int, optional): The maximum number of results to return. Defaults to None.
+        index_path (str, optional): Root of the columnar index, local directory or s3:// url. Defaults to "s3://commoncrawl/cc-index/table/cc-main/warc".
+        batch_size (int, optional): Number of rows fetched from DuckDB at once. Defaults to 10_000.
+        extra_sql_where_clause (str, optional): Additional SQL WHERE clause to append to the query. Defaults to None.
+        aws_profile (str, optional): The AWS profile to use when reading from S3. Defaults to None.
+        threads (int, optional): Number of DuckDB threads. Defaults to None, which lets DuckDB decide.
+        crawl_catalog (CrawlCatalog, optional): Catalog used to skip crawls outside of the date range. Defaults to None.
+        record_filter (RecordFilter, optional): Filter on the index records, applied in the query, so that it's pushed down to the parquet scan. Defaults to None.
+        collapse (CollapseMode, optional): Keep only the first/latest capture of every url (per crawl for PER_CRAWL), so that the same page isn't downloaded multiple times. Defaults to None (all captures).
+
+    Examples:
+        >>> async with DuckDBAggregator(["example.com"], index_path="cc-index/table/cc-main/warc") as aggregator:
+        >>>     async for domain_record in aggregator:
+        >>>         print(domain_record)
+
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        match_type: MatchType = MatchType.EXACT,
+        cc_servers: Optional[List[str]] = None,
+        since: datetime = datetime.min,
+        to: datetime = datetime.max,
+        limit: int | None = None,
+        index_path: str = CC_INDEX_TABLE_PATH,
+        batch_size: int = 10_000,
+        extra_sql_where_clause: str | None = None,
+        aws_profile: Optional[str] = None,
+        threads: Optional[int] = None,
+        crawl_catalog: Optional[CrawlCatalog] = None,
+        record_filter: Optional[RecordFilter] = None,
+        collapse: Optional[CollapseMode] = None,
+    ) -> None:
+        self.urls = urls
+        self.match_type = match_type
+        self.cc_servers = cc_servers
+        self.since = since
+        self.to = to
+        self.limit = limit
+        self.index_path = index_path
+        self.batch_size = batch_size
+        self.extra_sql_where_clause = extra_sql_where_clause
+        self.aws_profile = aws_profile
+        self.threads = threads
+        self.crawl_catalog = crawl_catalog
+        self.record_filter = record_filter
+        self.collapse = collapse
+
+    async def __aenter__(self) -> DuckDBAggregator:
+        return await self.aopen()
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.aclose()
+
+    async def aopen(self) -> DuckDBAggregator:
+        self.connection = await asyncio.to_thread(self.__connect)
+        return self
+
+    async def aclose(self) -> DuckDBAggregator:
+        self.connection.close()
+        return self
+
+    def __connect(self) -> duckdb.DuckDBPyConnection:
+        connection = duckdb.connect()
+        if self.threads is not None:
+            connection.execute(f"SET threads = {int(self.threads)}")
+        if self.index_path.startswith("s3://"):
+            connection.execute("INSTALL httpfs; LOAD httpfs; INSTALL aws; LOAD aws;")
+            profile = (
+                f", PROFILE {sql_string(self.aws_profile)}"
+                if self.aws_profile is not None
+                else ""
+            )
+            connection.execute(
+                f"CREATE SECRET (TYPE s3, PROVIDER credential_chain, REGION 'us-east-1'{profile})"
+            )
+        return connection
+
+    class DuckDBAggregatorIterator(AsyncIterator[DomainRecord]):
+        def __init__(
+            self,
+            connection: duckdb.DuckDBPyConnection,
+            urls: List[str],
+            cc_servers: Optional[List[str]],
+            match_type: MatchType,
+            since: Optional[datetime],
+            to: Optional[datetime],
+            limit: int | None,
+            index_path: str,
+            batch_size: int,
+            extra_sql_where_clause: str | None,
+            crawl_catalog: Optional[CrawlCatalog] = None,
+            record_filter: Optional[RecordFilter] = None,
+            collapse: Optional[CollapseMode] = None,
+        ):
+            self.__cursor = connection.cursor()
+            self.__since = since
+            self.__to = to
+            self.__limit = limit
+            self.__batch_size = batch_size
+            self.__crawl_catalog = crawl_catalog
+            self.__total = 0
+            self.__domain_records: Deque[DomainRecord] = deque()
+            self.__reader: Optional[pa.RecordBatchReader] = None
+            self.__prefetch: Optional[asyncio.Task[Optional[pa.RecordBatch]]] = None
+            self.__finished = False
+
+            crawls = self.init_crawls_queue(cc_servers)
+            if cc_servers and len(crawls) == 0:
+                # No crawl in the date range, without crawls the query would search all of them
+                self.__query = None
+            else:
+                self.__query = prepare_duckdb_sql_query(
+                    urls,
+                    since,
+                    to,
+                    crawls,
+                    index_path,
+                    match_type,
+                    extra_sql_where_clause,
+                    limit,
+                    crawl_catalog=crawl_catalog,
+                    record_filter=record_filter,
+                    collapse=collapse,
+                )
+
+        def init_crawls_queue(self, cc_servers: Optional[List[str]]) -> List[str]:
+            return [
+                crawl_url_to_name(crawl)
+                for crawl in cc_servers or []
+                if crawl_in_date_range(
+                    crawl, self.__since, self.__to, self.__crawl_catalog
+                )
+            ]
+
+        def __read_next_batch(self) -> Optional[pa.RecordBatch]:
+            if self.__reader is None:
+                all_purpose_logger.debug(f"Executing duckdb query {self.__query}")
+                self.__reader = self.__cursor.execute(self.__query).to_arrow_reader(
+                    self.__batch_size
+                )
+            try:
+                return self.__reader.read_next_batch()
+            except StopIteration:
+                return None
+
+        def __prefetch_next_batch(self):
+            self.__prefetch = asyncio.create_task(
+                asyncio.to_thread(self.__read_next_batch)
+            )
+
+        async def next_record_batch(self) -> Optional[pa.RecordBatch]:
+            """
+            Returns the next arrow batch of the result, or None if there are no more rows.
+            The following batch is read while the returned one is consumed.
+            """
+            if self.__query is None or self.__finished:
+                self.__finished = True
+                return None
+
+            if self.__prefetch is None:
+                self.__prefetch_next_batch()
+            batch = await self.__prefetch  # type: ignore
+            self.__prefetch = None
+            if batch is None:
+                self.__finished = True
+                return None
+
+            self.__prefetch_next_batch()
+            return batch
+
+        async def __await_next_batch(self):
+            batch = await self.next_record_batch()
+            if batch is not None:
+                self.__domain_records.extend(
+                    arrow_to_domain_record_batch(batch).domain_records()
+                )
+
+        async def __anext__(self) -> DomainRecord:
+            # Stop if we fetched everything or reached limit
+            if self.__limit is not None and self.__total >= self.__limit:
+                self.clean()
+                raise StopAsyncIteration
+
+            while len(self.__domain_records) == 0:
+                if self.__finished:
+                    # No more data to fetch
+                    raise StopAsyncIteration
+                await self.__await_next_batch()
+
+            self.__total += 1
+            return self.__domain_records.popleft()
+
+        def clean(self):
+            if self.__prefetch is not None:
+                self.__prefetch.cancel()
+
+    async def batches(
+        self, batch_size: int | None = None
+    ) -> AsyncIterator[DomainRecordBatch]:
+        """
+        Yields the result as DomainRecordBatch, converted directly from the arrow batches.
+
+        Args:
+            batch_size (int, optional): Number of rows per batch. Defaults to batch_size of the aggregator.
+        """
+        iterator = self.__iterator(batch_size or self.batch_size)
+        try:
+            while (batch := await iterator.next_record_batch()) is not None:
+                if batch.num_rows > 0:
+                    yield arrow_to_domain_record_batch(batch)
+        finally:
+            iterator.clean()
+
+    def __aiter__(self) -> AsyncIterator[DomainRecord]:
+        return self.__iterator(self.batch_size)
+
+    def __iterator(self, batch_size: int) -> DuckDBAggregator.DuckDBAggregatorIterator:
+        return DuckDBAggregator.DuckDBAggregatorIterator(
+            connection=self.connection,
+            urls=self.urls,
+            cc_servers=self.cc_servers,
+            match_type=self.match_type,
+            since=self.since,
+            to=self.to,
+            limit=self.limit,
+            index_path=self.index_path,
+            batch_size=batch_size,
+            extra_sql_where_clause=self.extra_sql_where_clause,
+            crawl_catalog=self.crawl_catalog,
+            record_filter=self.record_filter,
+            collapse=self.collapse,
+        )
@@ -11,6 +11,7 @@ from typing import (
     List,
     Optional,
     Set,
+    Tuple,
     Type,
 )
 
@@ -19,22 +20,41 @@ from aiohttp import (
 )
 
 from cmoncrawl.aggregator.base import IAggregator
+from cmoncrawl.aggregator.utils.athena_query_maker import crawl_url_to_name
+from cmoncrawl.aggregator.utils.cdx_cache import CDXResponseCache
+from cmoncrawl.aggregator.utils.checkpoint import AggregationCheckpoint
+from cmoncrawl.aggregator.utils.collapse import RecordCollapser, order_crawls
 from cmoncrawl.aggregator.utils.constants import CC_INDEXES_SERVER
+from cmoncrawl.aggregator.utils.crawl_catalog import (
+    CrawlCatalog,
+    crawl_in_date_range,
+    get_crawl_catalog,
+)
 from cmoncrawl.aggregator.utils.helpers import (
-    crawl_to_year,
-    get_all_CC_indexes,
+    record_filter_to_cdx_filters,
     retrieve,
+    retrieve_stream,
     timestamp_to_datetime,
     to_timestamp_format,
 )
+from cmoncrawl.aggregator.utils.record_buffer import (
+    RecordBuffer,
+    estimate_record_size,
+)
+from cmoncrawl.aggregator.utils.row_store import CDXRowStore
 from cmoncrawl.common.loggers import all_purpose_logger
 from cmoncrawl.common.throttling import Throttler
 from cmoncrawl.common.types import (
+    CollapseMode,
     DomainCrawl,
     DomainRecord,
     MatchType,
+    RecordFilter,
 )
 
+# Fields of the index rows used to create DomainRecord, the rest is not requested
+CDX_FIELDS = "url,timestamp,filename,offset,length,digest,encoding"
+
 
 class GatewayAggregator(IAggregator):
     """
@@ -54,9 +74,20 @@ class GatewayAggregator(IAggregator):
         to (datetime, optional): The end date for the search. Defaults to datetime.max.
         limit (int, optional): The maximum number of results to return. Defaults to None.
         max_retry (int, optional): The maximum number of retries for a single request. Defaults to 5.
-        prefetch_size (int, optional): The number of indexes to fetch concurrently. Defaults to 3.
+        prefetch_size (int, optional): The number of indexes whose number of pages is looked up concurrently, ahead of page fetches. Defaults to 3.
         sleep_base: float: The base for the exponential backoff time calculation between retries. Defaults to 1.5.
         max_requests_per_second (int, optional): The maximum number of requests per second. Defaults to 20.
+        max_inflight_pages (int, optional): The maximum number of index pages fetched concurrently. Defaults to 10.
+        max_buffered_records (int, optional): The maximum number of fetched records waiting for the consumer. Defaults to 10_000.
+        max_buffered_bytes (int, optional): The maximum estimated size of fetched records waiting for the consumer. Defaults to 64 MiB.
+        crawl_catalog (CrawlCatalog, optional): Catalog used to skip crawls outside of the date range. If None and cc_servers are not set, it will be retrieved from the cc_indexes_server. Defaults to None.
+        cdx_cache (CDXResponseCache, optional): Cache of index server responses, re-runs and overlapping queries are answered from it. Defaults to None.
+        throttler (Throttler, optional): Throttler for the index server requests, e.g. AdaptiveThrottler shared with the downloader. Defaults to Throttler with max_requests_per_second.
+        checkpoint (AggregationCheckpoint, optional): Persisted progress, re-running with the same state file resumes at the first unfinished page. Defaults to None.
+        page_size (int, optional): Number of index blocks (3000 rows each) per page, larger pages mean fewer requests. Defaults to None (server default of 5).
+        record_filter (RecordFilter, optional): Filter on the index records, sent to the index server as `filter` params. Defaults to None.
+        collapse (CollapseMode, optional): Keep only a single capture of every url (per crawl for PER_CRAWL). FIRST and PER_CRAWL keep the earliest capture, LATEST the latest capture of the newest crawl containing the url. The index server collapses the captures within a page for FIRST and PER_CRAWL, the rest is dropped client side. The pages of a crawl are streamed one by one and for FIRST and LATEST the crawls are visited one by one from the oldest/newest. Defaults to None (all captures).
+        row_store (CDXRowStore, optional): Local store, which every completely fetched page is written to, so that later queries can be answered by RowStoreAggregator. Not used with collapse. Defaults to None.
 
     Examples:
         >>> async with GatewayAggregator(["example.com"]) as aggregator:
@@ -77,6 +108,17 @@ class GatewayAggregator(IAggregator):
         prefetch_size: int = 3,
         sleep_base: float = 1.3,
         max_requests_per_second: int = 20,
+        max_inflight_pages: int = 10,
+        max_buffered_records: int = 10_000,
+        max_buffered_bytes: int = 64 * 1024 * 1024,
+        crawl_catalog: Optional[CrawlCatalog] = None,
+        cdx_cache: Optional[CDXResponseCache] = None,
+        throttler: Optional[Throttler] = None,
+        checkpoint: Optional[AggregationCheckpoint] = None,
+        page_size: int | None = None,
+        record_filter: Optional[RecordFilter] = None,
+        collapse: Optional[CollapseMode] = None,
+        row_store: Optional[CDXRowStore] = None,
     ) -> None:
         self.urls = urls
         self.cc_servers = cc_servers
@@ -87,15 +129,33 @@ class GatewayAggregator(IAggregator):
         self.prefetch_size = prefetch_size
         self.sleep_base = sleep_base
         self.match_type = match_type
+        self.max_inflight_pages = max_inflight_pages
+        self.max_buffered_records = max_buffered_records
+        self.max_buffered_bytes = max_buffered_bytes
+        self.crawl_catalog = crawl_catalog
+        self.cdx_cache = cdx_cache
+        self.checkpoint = checkpoint
+        self.page_size = page_size
+        self.record_filter = record_filter
+        self.collapse = collapse
+        self.row_store = row_store
         self.iterators: List[GatewayAggregator.GatewayAggregatorIterator] = []
-        self.throttler = Throttler(int(1000 / max_requests_per_second))
+        self.throttler = (
+            throttler
+            if throttler is not None
+            else Throttler(int(1000 / max_requests_per_second))
+        )
 
     async def aopen(self) -> GatewayAggregator:
         self.client: ClientSession = ClientSession()
         await self.client.__aenter__()
 
         if not self.cc_servers:
-            self.cc_servers = await get_all_CC_indexes(self.client, CC_INDEXES_SERVER)
+            if self.crawl_catalog is None:
+                self.crawl_catalog = await get_crawl_catalog(
+                    self.client, CC_INDEXES_SERVER, self.cdx_cache
+                )
+            self.cc_servers = self.crawl_catalog.cdx_apis
         return self
 
     async def __aenter__(self) -> GatewayAggregator:
@@ -117,6 +177,16 @@ class GatewayAggregator(IAggregator):
             prefetch_size=self.prefetch_size,
             sleep_base=self.sleep_base,
             throttler=self.throttler,
+            max_inflight_pages=self.max_inflight_pages,
+            max_buffered_records=self.max_buffered_records,
+            max_buffered_bytes=self.max_buffered_bytes,
+            crawl_catalog=self.crawl_catalog,
+            cdx_cache=self.cdx_cache,
+            checkpoint=self.checkpoint,
+            page_size=self.page_size,
+            record_filter=self.record_filter,
+            collapse=self.collapse,
+            row_store=self.row_store,
         )
         self.iterators.append(iterator)
         return iterator
@@ -149,6 +219,7 @@ class GatewayAggregator(IAggregator):
         sleep_base: float,
         throttler: Throttler,
         page_size: int | None = None,
+        cache: CDXResponseCache | None = None,
     ) -> int:
         params: Dict[str, str | int] = {
             "showNumPages": "true",
@@ -160,7 +231,7 @@ class GatewayAggregator(IAggregator):
             params["matchType"] = match_type.value
 
         if page_size is not None:
-            params["page_size"] = page_size
+            params["pageSize"] = page_size
         response = await retrieve(
             client,
             cdx_server,
@@ -174,13 +245,14 @@ class GatewayAggregator(IAggregator):
                 "domain": domain,
                 "cdx_server": cdx_server,
             },
+            cache=cache,
         )
         pages = response[0].get("pages", 0)
 
         return pages
 
     @staticmethod
-    async def get_captured_responses(
+    async def iter_captured_responses(
         client: ClientSession,
         cdx_server: str,
         domain: str,
@@ -191,9 +263,25 @@ class GatewayAggregator(IAggregator):
         throttler: Throttler,
         since: datetime = datetime.min,
         to: datetime = datetime.max,
-    ) -> List[DomainRecord]:
-        params: Dict[str, str | int] = {
+        cache: CDXResponseCache | None = None,
+        raise_errors: bool = False,
+        page_size: int | None = None,
+        limit: int | None = None,
+        record_filter: RecordFilter | None = None,
+        collapse: bool = False,
+    ) -> AsyncIterator[DomainRecord]:
+        """
+        Streams the domain records of a single index page, as they are received.
+        Failures are logged and end the stream, records yielded before the failure are kept.
+        With `raise_errors` the failure is re-raised after logging.
+
+        Only the fields needed for DomainRecord are requested. `page_size` must be the same
+        as used for `get_number_of_pages`, and `limit` makes the server return at most `limit` rows.
+        With `collapse` the server returns only the first capture of each url of the page.
+        """
+        params: Dict[str, str | int | List[str]] = {
             "output": "json",
+            "fl": CDX_FIELDS,
             "page": page,
             "url": domain,
             "from": to_timestamp_format(since),
@@ -201,12 +289,23 @@ class GatewayAggregator(IAggregator):
         }
         if match_type is not None:
             params["matchType"] = match_type.value
+        if page_size is not None:
+            params["pageSize"] = page_size
+        if limit is not None:
+            params["limit"] = limit
+        if record_filter is not None:
+            cdx_filters = record_filter_to_cdx_filters(record_filter)
+            if len(cdx_filters) > 0:
+                params["filter"] = cdx_filters
+        if collapse:
+            params["collapse"] = "urlkey"
+
+        found = 0
         try:
-            reponse = await retrieve(
+            async for js in retrieve_stream(
                 client,
                 cdx_server,
                 params,
-                "text/x-ndjson",
                 max_retry=max_retry,
                 sleep_base=sleep_base,
                 throttler=throttler,
@@ -216,29 +315,66 @@ class GatewayAggregator(IAggregator):
                     "page": page,
                     "cdx_server": cdx_server,
                 },
-            )
+                cache=cache,
+            ):
+                found += 1
+                yield DomainRecord.construct_trusted(
+                    filename=js.get("filename", ""),
+                    offset=int(js.get("offset", 0)),
+                    length=int(js.get("length", 0)),
+                    url=js.get("url", ""),
+                    encoding=js.get("encoding"),
+                    digest=js.get("digest", None),
+                    timestamp=timestamp_to_datetime(js["timestamp"]),
+                )
         except Exception as e:
             all_purpose_logger.error(
                 f"Failed to retrieve page {page} for {domain} from {cdx_server} with reason {e}"
             )
-            return []
-
-        domain_records = [
-            DomainRecord(
-                filename=js.get("filename", 0),
-                offset=int(js.get("offset", 0)),
-                length=int(js.get("length", 0)),
-                url=js.get("url", ""),
-                encoding=js.get("encoding"),
-                digest=js.get("digest", None),
-                timestamp=timestamp_to_datetime(js["timestamp"]),
-            )
-            for js in reponse
-        ]
+            if raise_errors:
+                raise
+            return
+
         all_purpose_logger.info(
-            f"Found {len(domain_records)} domain records for {domain} on page {page} from {cdx_server}"
+            f"Found {found} domain records for {domain} on page {page} from {cdx_server}"
         )
-        return domain_records
+
+    @staticmethod
+    async def get_captured_responses(
+        client: ClientSession,
+        cdx_server: str,
+        domain: str,
+        match_type: MatchType | None,
+        max_retry: int,
+        sleep_base: float,
+        page: int,
+        throttler: Throttler,
+        since: datetime = datetime.min,
+        to: datetime = datetime.max,
+        cache: CDXResponseCache | None = None,
+        page_size: int | None = None,
+        limit: int | None = None,
+        record_filter: RecordFilter | None = None,
+    ) -> List[DomainRecord]:
+        return [
+            domain_record
+            async for domain_record in GatewayAggregator.iter_captured_responses(
+                client,
+                cdx_server,
+                domain,
+                match_type=match_type,
+                max_retry=max_retry,
+                sleep_base=sleep_base,
+                page=page,
+                throttler=throttler,
+                since=since,
+                to=to,
+                cache=cache,
+                page_size=page_size,
+                limit=limit,
+                record_filter=record_filter,
+            )
+        ]
 
     class GatewayAggregatorIterator(AsyncIterator[DomainRecord]):
         def __init__(
@@ -254,11 +390,28 @@ class GatewayAggregator(IAggregator):
             prefetch_size: int,
             sleep_base: float,
             throttler: Throttler,
+            max_inflight_pages: int = 10,
+            max_buffered_records: int = 10_000,
+            max_buffered_bytes: int = 64 * 1024 * 1024,
+            crawl_catalog: Optional[CrawlCatalog] = None,
+            cdx_cache: Optional[CDXResponseCache] = None,
+            checkpoint: Optional[AggregationCheckpoint] = None,
+            page_size: int | None = None,
+            record_filter: Optional[RecordFilter] = None,
+            collapse: Optional[CollapseMode] = None,
+            row_store: Optional[CDXRowStore] = None,
         ):
             self.__client = client
             self.__opt_prefetch_size = prefetch_size
-            self.__domain_records: Deque[DomainRecord] = deque()
-            self.prefetch_queue: Set[asyncio.Task[List[DomainRecord]]] = set()
+            self.__max_inflight_pages = max_inflight_pages
+            # Records are tagged with their page, to know when the page was consumed
+            self.__domain_records: RecordBuffer[
+                Tuple[DomainRecord, DomainCrawl]
+            ] = RecordBuffer(max_buffered_records, max_buffered_bytes)
+            # Crawls with known number of pages, page of DomainCrawl is the next page to fetch
+            self.__pages_remaining: Deque[Tuple[DomainCrawl, int]] = deque()
+            self.prefetch_queue: Set[asyncio.Task[None]] = set()
+            self.__discovery_queue: Set[asyncio.Task[None]] = set()
             self.__since = since
             self.__to = to
             self.__limit = limit
@@ -267,118 +420,374 @@ class GatewayAggregator(IAggregator):
             self.__sleep_base = sleep_base
             self.__match_type = match_type
             self.__throttler = throttler
+            self.__crawl_catalog = crawl_catalog
+            self.__cdx_cache = cdx_cache
+            self.__checkpoint = checkpoint
+            self.__page_size = page_size
+            self.__record_filter = record_filter
+            self.__collapse = collapse
+            self.__collapser: Optional[
+                RecordCollapser[Tuple[DomainRecord, DomainCrawl]]
+            ] = RecordCollapser(collapse) if collapse is not None else None
+            # Records kept by the collapser, yielded before the buffered ones
+            self.__collapsed: Deque[Tuple[DomainRecord, DomainCrawl]] = deque()
+            # Captures must be seen crawl by crawl, in the order of order_crawls
+            self.__crawl_by_crawl = collapse in (
+                CollapseMode.FIRST,
+                CollapseMode.LATEST,
+            )
+            if self.__crawl_by_crawl:
+                self.__opt_prefetch_size = 1
+            # Collapsed pages are not complete, so they aren't stored
+            self.__row_store = row_store if collapse is None else None
+            # Ids of the row store fetches per (cdx server, url)
+            self.__row_store_fetches: Dict[Tuple[str, str], int] = {}
+            # Number of page fetches in flight per cdx server
+            self.__inflight_crawls: Dict[str, int] = {}
+            # Number of buffered records of pages, which are not yet consumed
+            self.__page_records: Dict[Tuple[str, str, int], int] = {}
+            self.__last_page: DomainCrawl | None = None
+            if checkpoint is not None:
+                checkpoint.bind(
+                    {
+                        "urls": urls,
+                        "match_type": match_type.value if match_type else None,
+                        "since": since,
+                        "to": to,
+                        "record_filter": record_filter,
+                        "collapse": collapse,
+                    }
+                )
+                self.__total = checkpoint.total
 
-            self.__crawls_remaining = self.init_crawls_queue(urls, CC_files)
+            self.__crawls_remaining = self.init_crawls_queue(
+                urls, order_crawls(CC_files, collapse)
+            )
 
         def init_crawls_queue(
             self, urls: List[str], CC_files: List[str]
         ) -> Deque[DomainCrawl]:
-            # TODO Be smarter about this, The last -XX determines the week in the year
             return deque(
                 [
                     DomainCrawl(cdx_server=crawl, url=url, page=0)
                     for crawl in CC_files
-                    if (
-                        crawl_to_year(crawl) >= self.__since.year
-                        and crawl_to_year(crawl) <= self.__to.year
+                    if crawl_in_date_range(
+                        crawl, self.__since, self.__to, self.__crawl_catalog
                     )
                     for url in urls
+                    if self.__checkpoint is None
+                    or not self.__checkpoint.is_crawl_done(crawl, url)
                 ]
             )
 
-        async def __prefetch_next_crawl(self) -> int:
+        def __prefetch_next_crawls(self):
             """
-            Prefetch the next index server
+            Starts looking up the number of pages of upcoming crawls, so that
+            up to `prefetch_size` crawls are discovered ahead of the page fetches.
             """
-            while len(self.__crawls_remaining) > 0:
+            while len(self.__crawls_remaining) > 0 and (
+                len(self.__discovery_queue) + len(self.__pages_remaining)
+                < self.__opt_prefetch_size
+            ):
                 next_crawl = self.__crawls_remaining.popleft()
+                self.__discovery_queue.add(
+                    asyncio.create_task(self.__discover_pages(next_crawl))
+                )
 
-                try:
-                    num_pages = await GatewayAggregator.get_number_of_pages(
-                        self.__client,
-                        next_crawl.cdx_server,
-                        next_crawl.url,
-                        match_type=self.__match_type,
-                        max_retry=self.__max_retry,
-                        sleep_base=self.__sleep_base,
-                        throttler=self.__throttler,
-                    )
-                except Exception as e:
-                    all_purpose_logger.error(
-                        f"Failed to retrieve number of pages for {next_crawl.url} from {next_crawl.cdx_server} with reason {e}"
-                    )
-                    continue
-                all_purpose_logger.info(
-                    f"Found {num_pages} pages for {next_crawl.url} from {next_crawl.cdx_server}"
+        async def __discover_pages(self, next_crawl: DomainCrawl):
+            """
+            Finds the number of pages of the crawl and queues them
+            """
+            if self.__checkpoint is not None:
+                num_pages = self.__checkpoint.num_pages(
+                    next_crawl.cdx_server, next_crawl.url
+                )
+                if num_pages is not None:
+                    self.__begin_row_store_fetch(next_crawl, num_pages)
+                    self.__queue_pages(next_crawl, num_pages)
+                    return
+
+            try:
+                num_pages = await GatewayAggregator.get_number_of_pages(
+                    self.__client,
+                    next_crawl.cdx_server,
+                    next_crawl.url,
+                    match_type=self.__match_type,
+                    max_retry=self.__max_retry,
+                    sleep_base=self.__sleep_base,
+                    throttler=self.__throttler,
+                    page_size=self.__page_size,
+                    cache=self.__cdx_cache,
                 )
+            except Exception as e:
+                all_purpose_logger.error(
+                    f"Failed to retrieve number of pages for {next_crawl.url} from {next_crawl.cdx_server} with reason {e}"
+                )
+                return
+            all_purpose_logger.info(
+                f"Found {num_pages} pages for {next_crawl.url} from {next_crawl.cdx_server}"
+            )
+            if self.__checkpoint is not None:
+                self.__checkpoint.set_num_pages(
+                    next_crawl.cdx_server, next_crawl.url, num_pages
+                )
+            self.__begin_row_store_fetch(next_crawl, num_pages)
+            self.__queue_pages(next_crawl, num_pages)
+
+        def __begin_row_store_fetch(self, crawl: DomainCrawl, num_pages: int):
+            if self.__row_store is None:
+                return
+            self.__row_store_fetches[
+                (crawl.cdx_server, crawl.url)
+            ] = self.__row_store.begin_fetch(
+                crawl_url_to_name(crawl.cdx_server),
+                crawl.url,
+                self.__match_type or MatchType.EXACT,
+                self.__since,
+                self.__to,
+                num_pages,
+                self.__record_filter,
+                self.__page_size,
+            )
 
-                for i in range(num_pages):
-                    dc = DomainCrawl(next_crawl.url, next_crawl.cdx_server, i)
-                    self.prefetch_queue.add(
-                        asyncio.create_task(
-                            GatewayAggregator.get_captured_responses(
-                                self.__client,
-                                dc.cdx_server,
-                                dc.url,
-                                match_type=self.__match_type,
-                                page=dc.page,
-                                since=self.__since,
-                                to=self.__to,
-                                max_retry=self.__max_retry,
-                                sleep_base=self.__sleep_base,
-                                throttler=self.__throttler,
-                            ),
-                        )
-                    )
-                return num_pages
-            return 0
+        def __skip_completed_pages(self, crawl: DomainCrawl):
+            if self.__checkpoint is None:
+                return
+            completed = self.__checkpoint.completed_pages(crawl.cdx_server, crawl.url)
+            while crawl.page in completed:
+                crawl.page += 1
+
+        def __queue_pages(self, crawl: DomainCrawl, num_pages: int):
+            self.__skip_completed_pages(crawl)
+            if crawl.page < num_pages:
+                self.__pages_remaining.append((crawl, num_pages))
+
+        def __next_page(self) -> DomainCrawl:
+            crawl, num_pages = self.__pages_remaining[0]
+            dc = DomainCrawl(crawl.url, crawl.cdx_server, crawl.page)
+            crawl.page += 1
+            self.__skip_completed_pages(crawl)
+            if crawl.page >= num_pages:
+                self.__pages_remaining.popleft()
+            return dc
+
+        def __can_schedule_page(self) -> bool:
+            if len(self.prefetch_queue) >= self.__max_inflight_pages:
+                return False
+
+            # The next crawl starts only after all pages of the current one were streamed
+            if self.__crawl_by_crawl and any(
+                cdx_server != self.__pages_remaining[0][0].cdx_server
+                for cdx_server in self.__inflight_crawls
+            ):
+                return False
+
+            # Captures of an url must be seen in the index order, so with collapse
+            # the pages of a crawl are streamed one by one
+            if (
+                self.__collapser is not None
+                and self.__pages_remaining[0][0].cdx_server in self.__inflight_crawls
+            ):
+                return False
+
+            # Pages already fetching will fill the buffer, no need for more
+            if self.__domain_records.full():
+                return False
+
+            # Don't prefetch if limit is set to avoid overfetching
+            if self.__limit is not None and (
+                len(self.prefetch_queue) > 0
+                or self.__total + len(self.__domain_records) >= self.__limit
+            ):
+                return False
+            return True
 
-        async def __await_next_prefetch(self):
+        def __schedule_pages(self):
             """
-            Gets the next index retry
+            Starts page fetches until the in-flight or buffer bounds are reached.
             """
-            # Wait for the next prefetch to finish
-            # Don't prefetch if limit is set to avoid overfetching
-            while len(self.__crawls_remaining) > 0 and (
-                len(self.prefetch_queue) == 0
-                or (
-                    self.__limit is None
-                    and len(self.prefetch_queue) <= self.__opt_prefetch_size
+            self.__prefetch_next_crawls()
+            while len(self.__pages_remaining) > 0 and self.__can_schedule_page():
+                dc = self.__next_page()
+                # With limit, only one page is in flight, so the server can be asked for just the rest.
+                # Not with collapse, the records dropped as duplicates would count towards it
+                limit = (
+                    self.__limit - self.__total - len(self.__domain_records)
+                    if self.__limit is not None and self.__collapser is None
+                    else None
+                )
+                self.__inflight_crawls[dc.cdx_server] = (
+                    self.__inflight_crawls.get(dc.cdx_server, 0) + 1
+                )
+                self.prefetch_queue.add(
+                    asyncio.create_task(self.__stream_page(dc, limit))
                 )
-            ):
-                await self.__prefetch_next_crawl()
 
-            while len(self.prefetch_queue) > 0 and len(self.__domain_records) == 0:
-                done, self.prefetch_queue = await asyncio.wait(
-                    self.prefetch_queue, return_when="FIRST_COMPLETED"
+        async def __stream_page(self, dc: DomainCrawl, limit: int | None = None):
+            """
+            Streams the records of a page into the domain records buffer.
+            Waits when the buffer is full, until the consumer drains it.
+            """
+            key = (dc.cdx_server, dc.url, dc.page)
+            # The running stream holds one reference to the page
+            self.__page_records[key] = 1
+            try:
+                await self.__stream_page_records(dc, key, limit)
+            finally:
+                self.__inflight_crawls[dc.cdx_server] -= 1
+                if self.__inflight_crawls[dc.cdx_server] == 0:
+                    del self.__inflight_crawls[dc.cdx_server]
+
+        async def __stream_page_records(
+            self, dc: DomainCrawl, key: Tuple[str, str, int], limit: int | None
+        ):
+            found = 0
+            page_records: List[DomainRecord] = []
+            try:
+                async for domain_record in GatewayAggregator.iter_captured_responses(
+                    self.__client,
+                    dc.cdx_server,
+                    dc.url,
+                    match_type=self.__match_type,
+                    page=dc.page,
+                    since=self.__since,
+                    to=self.__to,
+                    max_retry=self.__max_retry,
+                    sleep_base=self.__sleep_base,
+                    throttler=self.__throttler,
+                    cache=self.__cdx_cache,
+                    raise_errors=self.__checkpoint is not None
+                    or self.__row_store is not None,
+                    page_size=self.__page_size,
+                    limit=limit,
+                    record_filter=self.__record_filter,
+                    # The server keeps the first capture, only the earliest can be collapsed
+                    collapse=self.__collapse
+                    in (CollapseMode.FIRST, CollapseMode.PER_CRAWL),
+                ):
+                    found += 1
+                    if self.__row_store is not None:
+                        page_records.append(domain_record)
+                    self.__page_records[key] += 1
+                    await self.__domain_records.put(
+                        (domain_record, dc), estimate_record_size(domain_record)
+                    )
+            except Exception:
+                # Already logged, the page stays unfinished in the checkpoint
+                del self.__page_records[key]
+                return
+
+            if limit is not None and found >= limit:
+                # The page might have been cut by the limit, so it's not completed
+                del self.__page_records[key]
+                return
+            if self.__row_store is not None:
+                self.__row_store.add_page(
+                    self.__row_store_fetches[(dc.cdx_server, dc.url)],
+                    dc.page,
+                    crawl_url_to_name(dc.cdx_server),
+                    page_records,
                 )
-                for task in done:
-                    response = task.result()
-                    self.__domain_records.extend(response)
+            self.__release_page(dc)
+
+        def __release_page(self, dc: DomainCrawl):
+            """
+            Drops a reference to the page, the page is completed once its stream
+            has finished and all of its records were consumed.
+            """
+            key = (dc.cdx_server, dc.url, dc.page)
+            if key not in self.__page_records:
+                return
+            self.__page_records[key] -= 1
+            if self.__page_records[key] > 0:
+                return
+            del self.__page_records[key]
+            if self.__checkpoint is not None:
+                self.__checkpoint.complete_page(dc.cdx_server, dc.url, dc.page)
+
+        def __collect_finished_tasks(self):
+            finished_pages = {task for task in self.prefetch_queue if task.done()}
+            finished_discoveries = {
+                task for task in self.__discovery_queue if task.done()
+            }
+            self.prefetch_queue -= finished_pages
+            self.__discovery_queue -= finished_discoveries
+            for task in finished_pages | finished_discoveries:
+                task.result()
+
+        async def __await_next_record(self):
+            """
+            Waits until a record is buffered or a page fetch or page discovery finishes
+            """
+            records_waiter = asyncio.create_task(self.__domain_records.get())
+            try:
+                done, _ = await asyncio.wait(
+                    self.prefetch_queue | self.__discovery_queue | {records_waiter},
+                    return_when="FIRST_COMPLETED",
+                )
+            except BaseException:
+                records_waiter.cancel()
+                raise
+
+            if records_waiter in done:
+                return records_waiter.result()
+
+            records_waiter.cancel()
+            return None
 
         async def __anext__(self) -> DomainRecord:
+            # Asking for the next record means, the previous one was processed
+            if self.__last_page is not None:
+                self.__release_page(self.__last_page)
+                self.__last_page = None
+                if self.__checkpoint is not None:
+                    self.__checkpoint.total = self.__total
+
             # Stop if we fetched everything or reached limit
             if self.__limit is not None and self.__total >= self.__limit:
                 self.clean()
                 raise StopAsyncIteration
 
-            # Nothing prefetched
-            while len(self.__domain_records) == 0:
-                await self.__await_next_prefetch()
-                if (
-                    len(self.prefetch_queue) == 0
-                    and len(self.__crawls_remaining) == 0
-                    and len(self.__domain_records) == 0
+            result: Tuple[DomainRecord, DomainCrawl] | None = None
+            while result is None:
+                self.__collect_finished_tasks()
+                self.__schedule_pages()
+                if len(self.__collapsed) > 0:
+                    result = self.__collapsed.popleft()
+                    break
+                if len(self.__domain_records) > 0:
+                    result = self.__domain_records.get_nowait()
+                elif len(self.prefetch_queue) > 0 or len(self.__discovery_queue) > 0:
+                    result = await self.__await_next_record()
+                elif (
+                    len(self.__crawls_remaining) == 0
+                    and len(self.__pages_remaining) == 0
                 ):
+                    if self.__collapser is not None:
+                        self.__collapsed.extend(self.__collapser.flush())
+                    if len(self.__collapsed) > 0:
+                        continue
                     # No more data to fetch
                     self.clean()
                     raise StopAsyncIteration
 
-            result = self.__domain_records.popleft()
+                if result is not None and self.__collapser is not None:
+                    kept, dropped = self.__collapser.add(
+                        result, result[0], result[1].cdx_server
+                    )
+                    # Other captures of the url
+                    for _, page in dropped:
+                        self.__release_page(page)
+                    self.__collapsed.extend(kept)
+                    result = None
+
+            domain_record, self.__last_page = result
             self.__total += 1
-            return result
+            return domain_record
 
         # Helper functions
         def clean(self):
-            for task in self.prefetch_queue:
+            for task in self.prefetch_queue | self.__discovery_queue:
                 task.cancel()
+            if self.__checkpoint is not None:
+                self.__checkpoint.save()
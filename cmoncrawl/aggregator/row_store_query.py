@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from typing import AsyncIterator, Deque, Iterator, List, Optional, Tuple
+
+from cmoncrawl.aggregator.base import IAggregator
+from cmoncrawl.aggregator.utils.athena_query_maker import crawl_url_to_name
+from cmoncrawl.aggregator.utils.collapse import RecordCollapser, order_crawls
+from cmoncrawl.aggregator.utils.row_store import CDXRowStore
+from cmoncrawl.common.loggers import all_purpose_logger
+from cmoncrawl.common.types import (
+    CollapseMode,
+    DomainRecord,
+    MatchType,
+    RecordFilter,
+)
+
+
+class RowStoreAggregator(IAggregator):
+    """
+    This class is responsible for aggregating the index rows stored locally
+    in CDXRowStore by previous runs of GatewayAggregator.
+    It is an async context manager which can then be used as an async iterator
+    which yields DomainRecord objects, found in the store.
+
+    A crawl is answered from the store only if it covers the query: a completely
+    fetched query of the crawl with the same record filter, whose SURT key range and date range
+    contain the ones of the url. Crawls, which are not covered, are skipped with a warning.
+    No request is made to the index server.
+
+    Args:
+        urls (List[str]): A list of urls to search for.
+        store_path (Path): Path to the SQLite database of CDXRowStore.
+        match_type (MatchType, optional): Match type for the urls. Defaults to MatchType.EXACT.
+        cc_servers (List[str], optional): Crawls to query, either crawl ids (CC-MAIN-2023-23) or cdx server urls. If None, all crawls of the store are used. Defaults to None.
+        since (datetime, optional): The start date for the search. Defaults to datetime.min.
+        to (datetime, optional): The end date for the search. Defaults to datetime.max.
+        limit (int, optional): The maximum number of results to return. Defaults to None.
+        batch_size (int, optional): Number of rows read from the store at once. Defaults to 10_000.
+        record_filter (RecordFilter, optional): Filter the rows were fetched with. Defaults to None.
+        collapse (CollapseMode, optional): Keep only a single capture of every url (per crawl for PER_CRAWL). Defaults to None (all captures).
+
+    Examples:
+        >>> async with RowStoreAggregator(["example.com"], store_path=Path("rows.sqlite")) as aggregator:
+        >>>     async for domain_record in aggregator:
+        >>>         print(domain_record)
+
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        store_path: Path,
+        match_type: MatchType = MatchType.EXACT,
+        cc_servers: Optional[List[str]] = None,
+        since: datetime = datetime.min,
+        to: datetime = datetime.max,
+        limit: int | None = None,
+        batch_size: int = 10_000,
+        record_filter: Optional[RecordFilter] = None,
+        collapse: Optional[CollapseMode] = None,
+    ) -> None:
+        self.urls = urls
+        self.store_path = store_path
+        self.match_type = match_type
+        self.cc_servers = cc_servers
+        self.since = since
+        self.to = to
+        self.limit = limit
+        self.batch_size = batch_size
+        self.record_filter = record_filter
+        self.collapse = collapse
+
+    async def __aenter__(self) -> RowStoreAggregator:
+        return await self.aopen()
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.aclose()
+
+    async def aopen(self) -> RowStoreAggregator:
+        self.store = CDXRowStore(self.store_path)
+        if not self.cc_servers:
+            self.cc_servers = self.store.crawls()
+        return self
+
+    async def aclose(self) -> RowStoreAggregator:
+        self.store.close()
+        return self
+
+    class RowStoreAggregatorIterator(AsyncIterator[DomainRecord]):
+        def __init__(
+            self,
+            store: CDXRowStore,
+            urls: List[str],
+            cc_servers: List[str],
+            match_type: MatchType,
+            since: datetime,
+            to: datetime,
+            limit: int | None,
+            batch_size: int,
+            record_filter: Optional[RecordFilter] = None,
+            collapse: Optional[CollapseMode] = None,
+        ):
+            self.__store = store
+            self.__match_type = match_type
+            self.__since = since
+            self.__to = to
+            self.__limit = limit
+            self.__batch_size = batch_size
+            self.__record_filter = record_filter
+            self.__collapser: Optional[RecordCollapser[DomainRecord]] = (
+                RecordCollapser(collapse) if collapse is not None else None
+            )
+            self.__total = 0
+            self.__domain_records: Deque[DomainRecord] = deque()
+            self.__crawls_remaining = self.init_crawls_queue(
+                urls, order_crawls(cc_servers, collapse)
+            )
+            self.__batches = self.__iter_batches()
+
+        def init_crawls_queue(
+            self, urls: List[str], cc_servers: List[str]
+        ) -> List[Tuple[str, str]]:
+            crawls: List[Tuple[str, str]] = []
+            for crawl in cc_servers:
+                crawl = crawl_url_to_name(crawl)
+                for url in urls:
+                    if self.__store.covers(
+                        crawl,
+                        url,
+                        self.__match_type,
+                        self.__since,
+                        self.__to,
+                        self.__record_filter,
+                    ):
+                        crawls.append((crawl, url))
+                    else:
+                        all_purpose_logger.warning(
+                            f"{url} in {crawl} is not covered by the row store, skipping"
+                        )
+            return crawls
+
+        def __iter_batches(self) -> Iterator[Tuple[str, List[DomainRecord]]]:
+            for crawl, url in self.__crawls_remaining:
+                for domain_records in self.__store.query(
+                    crawl,
+                    url,
+                    self.__match_type,
+                    self.__since,
+                    self.__to,
+                    self.__record_filter,
+                    self.__batch_size,
+                ):
+                    yield crawl, domain_records
+
+        async def __anext__(self) -> DomainRecord:
+            # Stop if we fetched everything or reached limit
+            if self.__limit is not None and self.__total >= self.__limit:
+                raise StopAsyncIteration
+
+            while len(self.__domain_records) == 0:
+                next_batch = next(self.__batches, None)
+                if next_batch is None:
+                    if self.__collapser is not None:
+                        self.__domain_records.extend(self.__collapser.flush())
+                    if len(self.__domain_records) == 0:
+                        # No more data to fetch
+                        raise StopAsyncIteration
+                    continue
+                crawl, domain_records = next_batch
+                if self.__collapser is not None:
+                    domain_records = self.__collapser.collapse_records(
+                        domain_records, crawl
+                    )
+                self.__domain_records.extend(domain_records)
+
+            self.__total += 1
+            return self.__domain_records.popleft()
+
+    def __aiter__(self) -> AsyncIterator[DomainRecord]:
+        if self.cc_servers is None:
+            raise ValueError("cc_servers must be initialized before iterating")
+        return RowStoreAggregator.RowStoreAggregatorIterator(
+            store=self.store,
+            urls=self.urls,
+            cc_servers=self.cc_servers,
+            match_type=self.match_type,
+            since=self.since,
+            to=self.to,
+            limit=self.limit,
+            batch_size=self.batch_size,
+            record_filter=self.record_filter,
+            collapse=self.collapse,
+        )
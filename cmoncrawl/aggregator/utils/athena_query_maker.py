@@ -1,10 +1,181 @@
 import textwrap
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from urllib.parse import urlparse
 
-from cmoncrawl.aggregator.utils.helpers import crawl_to_year
-from cmoncrawl.common.types import MatchType
+from cmoncrawl.aggregator.utils.crawl_catalog import CrawlCatalog, crawl_in_date_range
+from cmoncrawl.aggregator.utils.surt import surt_range, url_to_surt
+from cmoncrawl.common.types import CollapseMode, MatchType, RecordFilter
+
+
+def sql_string(value: str) -> str:
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def record_filter_conditions(
+    record_filter: RecordFilter, regex_function: str = "regexp_like"
+) -> List[str]:
+    """
+    Translates the record filter to SQL conditions over the columnar index.
+    `regex_function(string, pattern)` is the engine's regex search function.
+    """
+    conditions: List[str] = []
+    if record_filter.statuses is not None:
+        statuses = ", ".join(str(int(status)) for status in record_filter.statuses)
+        conditions.append(f"cc.fetch_status IN ({statuses})")
+    if record_filter.mimes is not None:
+        mimes = ", ".join(sql_string(mime) for mime in record_filter.mimes)
+        conditions.append(f"cc.content_mime_detected IN ({mimes})")
+    if record_filter.languages is not None:
+        conditions.append(
+            " OR ".join(
+                f"cc.content_languages LIKE {sql_string(f'%{language}%')}"
+                for language in record_filter.languages
+            )
+        )
+    if record_filter.url_regex is not None:
+        conditions.append(
+            f"{regex_function}(cc.url, {sql_string(record_filter.url_regex)})"
+        )
+    if record_filter.digests is not None:
+        digests = ", ".join(sql_string(digest) for digest in record_filter.digests)
+        conditions.append(f"cc.content_digest IN ({digests})")
+    return conditions
+
+
+def collapse_select(
+    columns: List[str],
+    source: str,
+    where_conditions_query: str,
+    collapse: CollapseMode,
+    join: str = "",
+):
+    """
+    Selects the `columns` of captures matching the conditions, keeping only
+    a single capture of every url (of every url in each crawl for PER_CRAWL),
+    the first or the latest one by fetch_time.
+    """
+    partition = (
+        "cc.url_surtkey, cc.crawl"
+        if collapse == CollapseMode.PER_CRAWL
+        else "cc.url_surtkey"
+    )
+    order = "DESC" if collapse == CollapseMode.LATEST else "ASC"
+    inner_columns = "".join(f"cc.{column},\n" for column in columns)
+    return (
+        f"SELECT {', '.join(columns)}\n"
+        f"FROM (\n"
+        f"SELECT {inner_columns}"
+        f"ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY cc.fetch_time {order}) AS collapse_rank\n"
+        f"FROM {source} AS cc{join}\n"
+        f"WHERE {where_conditions_query}\n"
+        f")\n"
+        f"WHERE collapse_rank = 1"
+    )
+
+
+def url_key_ranges(urls: List[str], match_type: MatchType) -> List[Tuple[str, str]]:
+    """
+    Returns sorted, non-overlapping [start, end) ranges of url_surtkey, which match the urls.
+    """
+    ranges = []
+    for url in urls:
+        if match_type == MatchType.EXACT:
+            # url_surtkey has no timestamp, so it's just the key itself
+            surt = url_to_surt(url)
+            ranges.append((surt, f"{surt} "))
+        else:
+            ranges.append(surt_range(url, match_type))
+
+    merged: List[Tuple[str, str]] = []
+    for start, end in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+# First characters of subdomains and paths, the key ranges are split at
+SPLIT_CHARS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def split_key_range(key_range: Tuple[str, str], parts: int) -> List[Tuple[str, str]]:
+    """
+    Splits a range of `url_key_ranges` into at most `parts` consecutive ranges.
+    Domain ranges (com,example) ... com,example-) are split into the host itself
+    and its subdomains by their first character, host and prefix ranges by the first
+    character after the key prefix. Exact ranges aren't split.
+    """
+    start, end = key_range
+    if parts <= 1 or end == f"{start} ":
+        return [key_range]
+    if start.endswith(")") and end == f"{start[:-1]}-":
+        # The host itself and com,example,<subdomain>
+        stem = f"{start[:-1]},"
+        return [(start, stem)] + split_key_range((stem, end), parts - 1)
+    # com,example)/<path> for host ranges, the prefix itself for prefix ranges
+    stem = f"{start}/" if start.endswith(")") else start
+    boundaries = [
+        f"{stem}{SPLIT_CHARS[len(SPLIT_CHARS) * i // parts]}" for i in range(1, parts)
+    ]
+    boundaries = [b for b in dict.fromkeys(boundaries) if start < b < end]
+    return list(zip([start, *boundaries], [*boundaries, end]))
+
+
+def split_url_key_ranges(
+    urls: List[str], match_type: MatchType, parts: int
+) -> List[Tuple[str, str]]:
+    """
+    Splits the url_surtkey space of the urls into at most `parts` consecutive ranges,
+    each one for a separate query. Many urls are grouped by their key ranges,
+    a few ranges are split further with `split_key_range`.
+    """
+    key_ranges = url_key_ranges(urls, match_type)
+    if len(key_ranges) >= parts:
+        groups = [
+            key_ranges[
+                len(key_ranges) * i // parts : len(key_ranges) * (i + 1) // parts
+            ]
+            for i in range(parts)
+        ]
+        return [(group[0][0], group[-1][1]) for group in groups]
+    split_ranges: List[Tuple[str, str]] = []
+    for i, key_range in enumerate(key_ranges):
+        # The parts are spread over the ranges, the first ones get the remainder
+        range_parts = parts // len(key_ranges) + (i < parts % len(key_ranges))
+        split_ranges.extend(split_key_range(key_range, range_parts))
+    return split_ranges
+
+
+def key_range_condition(key_range: Tuple[str, str]) -> str:
+    return f"cc.url_surtkey >= {sql_string(key_range[0])} AND cc.url_surtkey < {sql_string(key_range[1])}"
+
+
+def url_table_columns(match_type: MatchType) -> List[str]:
+    return ["url"] if match_type == MatchType.EXACT else ["key_start", "key_end"]
+
+
+def url_table_rows(urls: List[str], match_type: MatchType) -> List[Tuple[str, ...]]:
+    """
+    Rows of the url table. EXACT urls are stored as they are, so that the join matches
+    the same captures as the url conditions, other match types as `url_key_ranges`.
+    """
+    if match_type == MatchType.EXACT:
+        return [(url,) for url in sorted(set(urls))]
+    return list(url_key_ranges(urls, match_type))
+
+
+def url_table_join(database: str, url_table: str, match_type: MatchType) -> str:
+    """
+    Join of the url table created from `url_table_rows`, replacing the url conditions
+    """
+    condition = (
+        "cc.url = u.url"
+        if match_type == MatchType.EXACT
+        else "cc.url_surtkey >= u.key_start AND cc.url_surtkey < u.key_end"
+    )
+    return f'\nJOIN "{database}"."{url_table}" AS u\nON {condition}'
 
 
 def url_query_based_on_match_type(match_type: MatchType, url: str):
@@ -57,13 +228,15 @@ def crawl_url_to_name(crawl_url: str):
 
 
 def crawl_query(
-    crawl_urls: List[str], since: Optional[datetime], to: Optional[datetime]
+    crawl_urls: List[str],
+    since: Optional[datetime],
+    to: Optional[datetime],
+    crawl_catalog: Optional[CrawlCatalog] = None,
 ):
     allowed_crawls = [
         crawl_url_to_name(crawl)
         for crawl in crawl_urls
-        if (since is None or crawl_to_year(crawl) >= since.year)
-        and (to is None or crawl_to_year(crawl) <= to.year)
+        if crawl_in_date_range(crawl, since, to, crawl_catalog)
     ]
     allowed_crawls_query = " OR ".join(
         f"cc.crawl = '{crawl}'" for crawl in allowed_crawls
@@ -71,25 +244,50 @@ def crawl_query(
     return allowed_crawls_query
 
 
+def url_conditions(
+    urls: List[str], match_type: MatchType, url_table: Optional[str] = None
+) -> str:
+    if url_table is None:
+        urls_with_type_query = [
+            f"({url_query_based_on_match_type(match_type, url)})" for url in urls
+        ]
+        return " OR ".join(urls_with_type_query)
+    # The urls are matched by the join, only the bounds of all keys
+    # are kept, so that row groups outside of them are skipped
+    key_ranges = url_key_ranges(urls, match_type)
+    return key_range_condition((key_ranges[0][0], key_ranges[-1][1]))
+
+
 def prepare_athena_where_conditions(
     urls: List[str],
     since: Optional[datetime],
     to: Optional[datetime],
     crawl_urls: List[str],
     match_type: MatchType = MatchType.EXACT,
+    crawl_catalog: Optional[CrawlCatalog] = None,
+    record_filter: Optional[RecordFilter] = None,
+    regex_function: str = "regexp_like",
+    url_table: Optional[str] = None,
+    key_range: Optional[Tuple[str, str]] = None,
 ):
-    urls_with_type_query = [
-        f"({url_query_based_on_match_type(match_type, url)})" for url in urls
-    ]
-    url_query = " OR ".join(urls_with_type_query)
-    allowed_crawls_query = crawl_query(crawl_urls, since, to)
+    url_query = url_conditions(urls, match_type, url_table)
+    allowed_crawls_query = crawl_query(crawl_urls, since, to, crawl_catalog)
     date_query = url_query_date_range(since, to)
+    filter_conditions = (
+        record_filter_conditions(record_filter, regex_function)
+        if record_filter is not None
+        else []
+    )
+    # Only successful captures, unless the filter asks for other statuses
+    if record_filter is None or record_filter.statuses is None:
+        filter_conditions.insert(0, "cc.fetch_status = 200")
     where_conditions = [
         date_query,
         allowed_crawls_query,
-        "cc.fetch_status = 200",
+        *filter_conditions,
         "cc.subset = 'warc'",
         url_query,
+        key_range_condition(key_range) if key_range is not None else "",
     ]
     where_conditions = [condition for condition in where_conditions if condition]
     return where_conditions
@@ -104,9 +302,22 @@ def prepare_athena_sql_query(
     table: str,
     match_type: MatchType = MatchType.EXACT,
     extra_sql_where_clause: str | None = None,
+    crawl_catalog: Optional[CrawlCatalog] = None,
+    record_filter: Optional[RecordFilter] = None,
+    collapse: Optional[CollapseMode] = None,
+    url_table: Optional[str] = None,
+    key_range: Optional[Tuple[str, str]] = None,
 ):
     where_conditions = prepare_athena_where_conditions(
-        urls, since, to, crawl_urls, match_type
+        urls,
+        since,
+        to,
+        crawl_urls,
+        match_type,
+        crawl_catalog,
+        record_filter,
+        url_table=url_table,
+        key_range=key_range,
     )
     where_conditions += (
         [extra_sql_where_clause] if extra_sql_where_clause is not None else []
@@ -114,17 +325,64 @@ def prepare_athena_sql_query(
     where_conditions_query = " AND ".join(
         f"({condition})" for condition in where_conditions
     )
+    join = (
+        url_table_join(database, url_table, match_type) if url_table is not None else ""
+    )
+    if collapse is not None:
+        columns = [
+            "url",
+            "fetch_time",
+            "content_digest",
+            "warc_filename",
+            "warc_record_offset",
+            "warc_record_length",
+        ]
+        source = f'"{database}"."{table}"'
+        return (
+            collapse_select(columns, source, where_conditions_query, collapse, join)
+            + ";"
+        )
     query = textwrap.dedent(
         f"""\
         SELECT cc.url,
                 cc.fetch_time,
+                cc.content_digest,
                 cc.warc_filename,
                 cc.warc_record_offset,
                 cc.warc_record_length
-        FROM "{database}"."{table}" AS cc
-        WHERE {where_conditions_query};"""
+        FROM "{database}"."{table}" AS cc"""
+    )
+    return query + join + f"\nWHERE {where_conditions_query};"
+
+
+def prepare_athena_subset_query(
+    urls: List[str],
+    crawl_urls: List[str],
+    database: str,
+    table: str,
+    match_type: MatchType = MatchType.EXACT,
+    url_table: Optional[str] = None,
+):
+    """
+    Selects all columns of the warc captures of the urls in the crawls, to materialize
+    them in a subset table. Dates, statuses and other filters are left to the queries
+    of the subset table, so that it can be reused for any of them.
+    """
+    where_conditions = [
+        crawl_query(crawl_urls, None, None),
+        "cc.subset = 'warc'",
+        url_conditions(urls, match_type, url_table),
+    ]
+    where_conditions_query = " AND ".join(
+        f"({condition})" for condition in where_conditions
+    )
+    join = (
+        url_table_join(database, url_table, match_type) if url_table is not None else ""
+    )
+    return (
+        f'SELECT cc.*\nFROM "{database}"."{table}" AS cc{join}\n'
+        f"WHERE {where_conditions_query}"
     )
-    return query
 
 
 def get_name(
@@ -138,3 +396,15 @@ def get_name(
 
 def to_timestamp_format(date: datetime):
     return date.strftime("%Y%m%d%H%M%S")
+
+
+def unload_query(query: str, location: str) -> str:
+    """
+    Wraps the query to write its result as parquet files to the `location` (s3://bucket/prefix/),
+    which must be empty.
+    """
+    return (
+        f"UNLOAD ({query.rstrip().rstrip(';')})\n"
+        f"TO {sql_string(location)}\n"
+        "WITH (format = 'PARQUET', compression = 'SNAPPY')"
+    )
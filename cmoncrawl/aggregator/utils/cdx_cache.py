@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+from pathlib import Path
+from typing import IO, Any, AsyncIterator, Dict, Optional
+
+import aiofiles
+
+from cmoncrawl.common.loggers import all_purpose_logger
+
+CHUNK_SIZE = 64 * 1024
+TMP_SUFFIX = ".tmp"
+
+
+def cdx_cache_key(cdx_server: str, params: Dict[str, Any]) -> str:
+    """Returns an opaque key / filename for caching a response of the cdx server."""
+    h = hashlib.sha256()
+    h.update(cdx_server.encode())
+    h.update("|".encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return f"{h.hexdigest()}.bin"
+
+
+class CDXResponseCache:
+    """
+    A local filesystem cache of raw responses of the cdx servers.
+
+    Entries are keyed by the cdx server and the request params
+    (url, matchType, page, from, to, ...). The total size of the cache is bounded
+    and the least recently used entries are evicted first. Last use of an entry is
+    tracked in the file's access time, while the modification time keeps the time
+    it was written, which is used for entries with a TTL. The entries are listed
+    by their last use once on start and the list is kept up to date in memory,
+    so eviction doesn't scan the cache dir.
+
+    Indexes of published crawls never change, so page responses are stored without TTL,
+    only the listing of crawls (collinfo.json) should be read with `collinfo_ttl`.
+
+    If `cache_dir` does not exist, it's created.
+
+    Args:
+        cache_dir (Path): Directory to store the responses in.
+        max_size (int, optional): Maximum total size of the cache in bytes. Defaults to 1 GiB.
+        collinfo_ttl (timedelta, optional): How long is the listing of crawls valid. Defaults to 1 day.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        max_size: int = 1024 * 1024 * 1024,
+        collinfo_ttl: timedelta = timedelta(days=1),
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.collinfo_ttl = collinfo_ttl
+        if not self.cache_dir.exists():
+            all_purpose_logger.info(f"Creating cdx cache dir {self.cache_dir}")
+            os.makedirs(str(self.cache_dir), exist_ok=True)
+
+        # Leftovers of interrupted writes
+        for tmp_file in self.cache_dir.glob(f"*{TMP_SUFFIX}"):
+            tmp_file.unlink(missing_ok=True)
+        # Sizes of the entries, from the least to the most recently used
+        self.__entries: OrderedDict[str, int] = OrderedDict(
+            (entry.name, stat.st_size)
+            for entry, stat in sorted(
+                ((entry, entry.stat()) for entry in self.cache_dir.glob("*.bin")),
+                key=lambda x: x[1].st_atime,
+            )
+        )
+        self.size = sum(self.__entries.values())
+
+    def __path(self, cdx_server: str, params: Dict[str, Any]) -> Path:
+        return self.cache_dir / cdx_cache_key(cdx_server, params)
+
+    def __lookup(
+        self, cdx_server: str, params: Dict[str, Any], ttl: Optional[timedelta]
+    ) -> Optional[Path]:
+        cache_path = self.__path(cdx_server, params)
+        try:
+            stat = cache_path.stat()
+        except FileNotFoundError:
+            return None
+
+        now = time.time()
+        if ttl is not None and now - stat.st_mtime > ttl.total_seconds():
+            self.__remove(cache_path)
+            return None
+
+        # Mark as recently used, keep the write time
+        os.utime(cache_path, (now, stat.st_mtime))
+        if cache_path.name in self.__entries:
+            self.__entries.move_to_end(cache_path.name)
+        return cache_path
+
+    def get(
+        self,
+        cdx_server: str,
+        params: Dict[str, Any],
+        ttl: Optional[timedelta] = None,
+    ) -> bytes | None:
+        cache_path = self.__lookup(cdx_server, params, ttl)
+        if cache_path is None:
+            return None
+        try:
+            with open(cache_path, "rb") as fp:
+                all_purpose_logger.debug(
+                    f"Reading response of {cdx_server} with params: {params} from cdx cache"
+                )
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    async def iter_chunks(
+        self,
+        cdx_server: str,
+        params: Dict[str, Any],
+        ttl: Optional[timedelta] = None,
+    ) -> Optional[AsyncIterator[bytes]]:
+        """
+        Returns the cached response as a stream of chunks, or None if it's not cached.
+        """
+        cache_path = self.__lookup(cdx_server, params, ttl)
+        if cache_path is None:
+            return None
+
+        all_purpose_logger.debug(
+            f"Reading response of {cdx_server} with params: {params} from cdx cache"
+        )
+
+        async def _chunks():
+            async with aiofiles.open(cache_path, "rb") as afp:
+                while chunk := await afp.read(CHUNK_SIZE):
+                    yield chunk
+
+        return _chunks()
+
+    def set(self, cdx_server: str, params: Dict[str, Any], data: bytes) -> None:
+        writer = self.writer(cdx_server, params)
+        writer.write(data)
+        writer.commit()
+
+    def writer(self, cdx_server: str, params: Dict[str, Any]) -> CDXCacheWriter:
+        """
+        Returns a writer, which stores a streamed response.
+        The entry only becomes visible after `commit`.
+        """
+        return CDXCacheWriter(self, self.__path(cdx_server, params))
+
+    def _add(self, tmp_path: Path, cache_path: Path):
+        size = tmp_path.stat().st_size
+        if size > self.max_size:
+            tmp_path.unlink(missing_ok=True)
+            return
+
+        if cache_path.exists():
+            self.__remove(cache_path)
+        os.replace(tmp_path, cache_path)
+        self.__entries[cache_path.name] = size
+        self.size += size
+        self.__evict()
+
+    def __remove(self, cache_path: Path):
+        self.size -= self.__entries.pop(cache_path.name, 0)
+        cache_path.unlink(missing_ok=True)
+
+    def __evict(self):
+        while self.size > self.max_size and len(self.__entries) > 0:
+            name = next(iter(self.__entries))
+            all_purpose_logger.debug(f"Evicting {name} from cdx cache")
+            self.__remove(self.cache_dir / name)
+
+
+class CDXCacheWriter:
+    """
+    Writes a response into a temporary file of the cache, which is moved
+    into place on `commit`. Uncommitted responses are discarded.
+    """
+
+    def __init__(self, cache: CDXResponseCache, cache_path: Path):
+        self.__cache = cache
+        self.__cache_path = cache_path
+        self.__tmp_path = cache_path.with_name(
+            f"{cache_path.name}.{uuid.uuid4().hex}{TMP_SUFFIX}"
+        )
+        self.__fp: Optional[IO[bytes]] = open(self.__tmp_path, "wb")
+
+    def write(self, data: bytes):
+        if self.__fp is not None:
+            self.__fp.write(data)
+
+    def commit(self):
+        if self.__fp is None:
+            return
+        self.__fp.close()
+        self.__fp = None
+        self.__cache._add(self.__tmp_path, self.__cache_path)
+
+    def discard(self):
+        if self.__fp is None:
+            return
+        self.__fp.close()
+        self.__fp = None
+        self.__tmp_path.unlink(missing_ok=True)
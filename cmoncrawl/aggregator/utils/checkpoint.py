@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import AbstractSet, Any, Dict, Set
+
+from cmoncrawl.common.loggers import all_purpose_logger
+
+TMP_SUFFIX = ".tmp"
+
+
+def crawl_key(cdx_server: str, url: str) -> str:
+    return f"{cdx_server} {url}"
+
+
+class AggregationCheckpoint:
+    """
+    Progress of an aggregation, persisted in a JSON state file, so that a crashed
+    or preempted run can be resumed instead of restarted from the first crawl.
+
+    It records finished crawls, the number of pages and the completed pages of each
+    crawl of GatewayAggregator and the finished crawl batches of AthenaAggregator.
+    A page or batch is completed only after all of its records were yielded,
+    so a resumed run starts at the first unfinished page. Records of pages, which were
+    being consumed during the crash, are yielded again (at-least-once).
+
+    The state is written at most once per `interval` seconds and when the iteration ends.
+    Writes are atomic, a crash during the write keeps the previous state.
+
+    Args:
+        path (Path): Path to the state file. If it exists, the progress is loaded from it.
+        interval (float, optional): Minimum number of seconds between two writes. Defaults to 30.
+    """
+
+    def __init__(self, path: Path, interval: float = 30.0):
+        self.path = path
+        self.interval = interval
+        self.last_save = time.monotonic()
+        self.state: Dict[str, Any] = {
+            "query": None,
+            "total": 0,
+            "crawls": {},
+            "batches_done": [],
+        }
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                self.state.update(json.load(f))
+            all_purpose_logger.info(f"Resuming aggregation from {self.path}")
+        self.__batches_done: Set[str] = set(self.state["batches_done"])
+        # Completed pages of every crawl, the state keeps them as a sorted list
+        self.__completed_pages: Dict[str, Set[int]] = {
+            key: set(crawl["completed"]) for key, crawl in self.state["crawls"].items()
+        }
+
+    def bind(self, query: Dict[str, Any]):
+        """
+        Ties the state to the query, resuming a different query from it raises ValueError.
+        """
+        query = json.loads(json.dumps(query, sort_keys=True, default=str))
+        if self.state["query"] is not None and self.state["query"] != query:
+            raise ValueError(
+                f"State file {self.path} belongs to a different query: {self.state['query']}"
+            )
+        self.state["query"] = query
+
+    @property
+    def total(self) -> int:
+        """
+        Number of records yielded so far
+        """
+        return self.state["total"]
+
+    @total.setter
+    def total(self, value: int):
+        self.state["total"] = value
+
+    def __crawl(self, cdx_server: str, url: str) -> Dict[str, Any]:
+        return self.state["crawls"].setdefault(
+            crawl_key(cdx_server, url),
+            {"num_pages": None, "completed": [], "done": False},
+        )
+
+    def is_crawl_done(self, cdx_server: str, url: str) -> bool:
+        crawl = self.state["crawls"].get(crawl_key(cdx_server, url))
+        return crawl is not None and crawl["done"]
+
+    def num_pages(self, cdx_server: str, url: str) -> int | None:
+        crawl = self.state["crawls"].get(crawl_key(cdx_server, url))
+        return crawl["num_pages"] if crawl is not None else None
+
+    def set_num_pages(self, cdx_server: str, url: str, num_pages: int):
+        crawl = self.__crawl(cdx_server, url)
+        crawl["num_pages"] = num_pages
+        crawl["done"] = len(self.completed_pages(cdx_server, url)) >= num_pages
+
+    def completed_pages(self, cdx_server: str, url: str) -> AbstractSet[int]:
+        return self.__completed_pages.get(crawl_key(cdx_server, url), set())
+
+    def complete_page(self, cdx_server: str, url: str, page: int):
+        crawl = self.__crawl(cdx_server, url)
+        completed = self.__completed_pages.setdefault(crawl_key(cdx_server, url), set())
+        completed.add(page)
+        if crawl["num_pages"] is not None:
+            crawl["done"] = len(completed) >= crawl["num_pages"]
+        self.maybe_save()
+
+    def is_batch_done(self, batch_id: str) -> bool:
+        return batch_id in self.__batches_done
+
+    def complete_batch(self, batch_id: str):
+        if batch_id not in self.__batches_done:
+            self.__batches_done.add(batch_id)
+            self.state["batches_done"].append(batch_id)
+        self.maybe_save()
+
+    def maybe_save(self):
+        if time.monotonic() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        """
+        Atomically writes the state file
+        """
+        for key, completed in self.__completed_pages.items():
+            self.state["crawls"][key]["completed"] = sorted(completed)
+        tmp_path = self.path.with_name(self.path.name + TMP_SUFFIX)
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.monotonic()
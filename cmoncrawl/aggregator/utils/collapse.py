@@ -0,0 +1,104 @@
+from typing import Generic, List, Optional, Set, Tuple, TypeVar
+
+from cmoncrawl.aggregator.utils.athena_query_maker import crawl_url_to_name
+from cmoncrawl.aggregator.utils.surt import url_to_surt
+from cmoncrawl.common.types import CollapseMode, DomainRecord
+
+T = TypeVar("T")
+
+
+def order_crawls(crawls: List[str], collapse: Optional[CollapseMode]) -> List[str]:
+    """
+    Orders the crawls from the oldest for FIRST and from the newest for LATEST,
+    so that the first crawl containing a url is the one to keep its capture from.
+    Crawl ids (CC-MAIN-YYYY-WW) sort chronologically.
+    """
+    match collapse:
+        case CollapseMode.FIRST:
+            return sorted(crawls, key=crawl_url_to_name)
+        case CollapseMode.LATEST:
+            return sorted(crawls, key=crawl_url_to_name, reverse=True)
+    return crawls
+
+
+class RecordCollapser(Generic[T]):
+    """
+    Client side part of the collapsing, for aggregators which can only collapse
+    the captures within a single response. The captures of each crawl must be added
+    in the index order (by url, then by timestamp), with the crawls in `order_crawls` order.
+
+    FIRST and PER_CRAWL keep the earliest capture of each url (per crawl for PER_CRAWL),
+    LATEST keeps the latest capture of the newest crawl containing the url, the same as
+    the queries of Athena and DuckDB. The latest capture is only known once the next url
+    is added, so the last one must be taken with `flush`.
+
+    Args:
+        collapse (CollapseMode): Collapse mode.
+    """
+
+    def __init__(self, collapse: CollapseMode):
+        self.collapse = collapse
+        self.__seen: Set[str] = set()
+        # Latest capture of the current url for LATEST, with its key and crawl
+        self.__pending: Tuple[T, str, str] | None = None
+
+    def __key(self, domain_record: DomainRecord, crawl: str) -> str:
+        key = url_to_surt(domain_record.url or "")
+        if self.collapse == CollapseMode.PER_CRAWL:
+            key = f"{crawl_url_to_name(crawl)} {key}"
+        return key
+
+    def add(
+        self, item: T, domain_record: DomainRecord, crawl: str
+    ) -> Tuple[List[T], List[T]]:
+        """
+        Adds the item carrying the capture of the crawl.
+        Returns the items, whose captures are kept, and the dropped items.
+        """
+        key = self.__key(domain_record, crawl)
+        if self.collapse != CollapseMode.LATEST:
+            if key in self.__seen:
+                return [], [item]
+            self.__seen.add(key)
+            return [item], []
+
+        kept: List[T] = []
+        dropped: List[T] = []
+        if self.__pending is not None:
+            pending, pending_key, pending_crawl = self.__pending
+            if (pending_key, pending_crawl) == (key, crawl):
+                # A later capture of the same url
+                dropped.append(pending)
+                self.__pending = None
+            else:
+                kept = self.flush()
+        if key in self.__seen:
+            # Kept from a newer crawl
+            dropped.append(item)
+        else:
+            self.__pending = (item, key, crawl)
+        return kept, dropped
+
+    def collapse_records(
+        self: "RecordCollapser[DomainRecord]",
+        domain_records: List[DomainRecord],
+        crawl: str,
+    ) -> List[DomainRecord]:
+        """
+        Adds the records of the crawl, returns the kept ones
+        """
+        kept: List[DomainRecord] = []
+        for domain_record in domain_records:
+            kept.extend(self.add(domain_record, domain_record, crawl)[0])
+        return kept
+
+    def flush(self) -> List[T]:
+        """
+        Returns the held latest capture, once no more captures will be added
+        """
+        if self.__pending is None:
+            return []
+        pending, key, _ = self.__pending
+        self.__pending = None
+        self.__seen.add(key)
+        return [pending]
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from aiohttp import ClientSession
+
+from cmoncrawl.aggregator.utils.cdx_cache import CDXResponseCache
+from cmoncrawl.aggregator.utils.helpers import crawl_to_year, get_collinfo
+
+
+@dataclass
+class CrawlInfo:
+    """
+    Metadata of a single crawl, as listed in collinfo.json.
+
+    Attributes:
+        id (str): Crawl id e.g. CC-MAIN-2023-23
+        cdx_api (str): Url of the crawl's cdx server e.g. https://index.commoncrawl.org/CC-MAIN-2023-23-index
+        since (datetime, optional): Time of the first capture in the crawl.
+        to (datetime, optional): Time of the last capture in the crawl.
+    """
+
+    id: str
+    cdx_api: str
+    since: Optional[datetime] = None
+    to: Optional[datetime] = None
+
+    @classmethod
+    def from_collinfo(cls, js: Dict[str, Any]) -> CrawlInfo:
+        return cls(
+            id=js["id"],
+            cdx_api=js["cdx-api"],
+            since=parse_collinfo_time(js.get("from")),
+            to=parse_collinfo_time(js.get("to")),
+        )
+
+    def overlaps(self, since: Optional[datetime], to: Optional[datetime]) -> bool:
+        """
+        Returns True if the capture window of the crawl overlaps [since, to].
+        If the window is unknown, only the crawl year is compared.
+        """
+        if self.since is None or self.to is None:
+            return crawl_year_in_range(self.cdx_api, since, to)
+
+        return (since is None or self.to >= since) and (to is None or self.since <= to)
+
+
+def parse_collinfo_time(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        # Stored as UTC without the timezone, same as the cdx timestamps
+        return datetime.fromisoformat(value.rstrip("Z")).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+def crawl_year_in_range(
+    crawl: str, since: Optional[datetime], to: Optional[datetime]
+) -> bool:
+    return (since is None or crawl_to_year(crawl) >= since.year) and (
+        to is None or crawl_to_year(crawl) <= to.year
+    )
+
+
+class CrawlCatalog:
+    """
+    Catalog of the Common Crawl crawls, built from collinfo.json.
+    It is used to skip crawls, whose capture window doesn't overlap the queried date range.
+
+    Args:
+        crawls (Iterable[CrawlInfo]): Crawls in the catalog, newest first as in collinfo.json.
+    """
+
+    def __init__(self, crawls: Iterable[CrawlInfo] = ()):
+        self.crawls: List[CrawlInfo] = list(crawls)
+        self.__by_key: Dict[str, CrawlInfo] = {}
+        for crawl in self.crawls:
+            self.__by_key[crawl.id] = crawl
+            self.__by_key[crawl.cdx_api] = crawl
+
+    @classmethod
+    def from_collinfo(cls, collinfo: List[Dict[str, Any]]) -> CrawlCatalog:
+        return cls(CrawlInfo.from_collinfo(js) for js in collinfo)
+
+    @property
+    def cdx_apis(self) -> List[str]:
+        return [crawl.cdx_api for crawl in self.crawls]
+
+    @property
+    def ids(self) -> List[str]:
+        return [crawl.id for crawl in self.crawls]
+
+    def __len__(self) -> int:
+        return len(self.crawls)
+
+    def get(self, crawl: str) -> Optional[CrawlInfo]:
+        """
+        Finds crawl either by its id or its cdx server url
+        """
+        return self.__by_key.get(crawl)
+
+    def overlaps(
+        self, crawl: str, since: Optional[datetime], to: Optional[datetime]
+    ) -> bool:
+        """
+        Returns True if the crawl (id or cdx server url) can contain captures from [since, to].
+        Crawls not present in the catalog are compared only by year.
+        """
+        info = self.get(crawl)
+        if info is None:
+            return crawl_year_in_range(crawl, since, to)
+        return info.overlaps(since, to)
+
+
+def crawl_in_date_range(
+    crawl: str,
+    since: Optional[datetime],
+    to: Optional[datetime],
+    crawl_catalog: Optional[CrawlCatalog] = None,
+) -> bool:
+    if crawl_catalog is None:
+        return crawl_year_in_range(crawl, since, to)
+    return crawl_catalog.overlaps(crawl, since, to)
+
+
+async def get_crawl_catalog(
+    client: ClientSession,
+    cdx_server: str,
+    cache: Optional[CDXResponseCache] = None,
+) -> CrawlCatalog:
+    """
+    Get the catalog of all CC crawls from a given CDX server
+    """
+    collinfo = await get_collinfo(client, cdx_server, cache)
+    return CrawlCatalog.from_collinfo(collinfo)
@@ -1,13 +1,19 @@
+from __future__ import annotations
+
 import asyncio
+import json
 import logging
 import re
-from datetime import datetime
-from typing import Any
+from contextlib import AsyncExitStack
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator
 from urllib.parse import urlparse
 
 import aioboto3
+from aiobotocore.config import AioConfig
 from aiohttp import (
     ClientError,
+    ClientResponse,
     ClientSession,
     ContentTypeError,
     ServerConnectionError,
@@ -21,8 +27,10 @@ from tenacity import (
 )
 
 from cmoncrawl.aggregator.utils import ndjson
+from cmoncrawl.aggregator.utils.cdx_cache import CDXCacheWriter, CDXResponseCache
 from cmoncrawl.common.loggers import all_purpose_logger
 from cmoncrawl.common.throttling import Throttler
+from cmoncrawl.common.types import RecordFilter
 
 ALLOWED_ERR_FOR_RETRIES = [500, 502, 503, 504]
 
@@ -59,9 +67,13 @@ def unify_url_id(url: str):
     return f"{netloc}{path_processed}"
 
 
-async def get_all_CC_indexes(client: ClientSession, cdx_server: str) -> list[str]:
+async def get_collinfo(
+    client: ClientSession,
+    cdx_server: str,
+    cache: CDXResponseCache | None = None,
+) -> list[dict[str, Any]]:
     """
-    Get all CC index servers from a given CDX server
+    Get the listing of all CC crawls (collinfo.json) from a given CDX server
     """
     try:
         response = await retrieve(
@@ -75,13 +87,23 @@ async def get_all_CC_indexes(client: ClientSession, cdx_server: str) -> list[str
                 "type": "CC index servers fetch",
                 "cdx_server": cdx_server,
             },
+            cache=cache,
+            cache_ttl=cache.collinfo_ttl if cache is not None else None,
         )
     except Exception as e:
         all_purpose_logger.error(
             f"Failed to get CC servers from {cdx_server} with reason: {e}"
         )
         return []
-    CC_servers = [js["cdx-api"] for js in response]
+    return response
+
+
+async def get_all_CC_indexes(client: ClientSession, cdx_server: str) -> list[str]:
+    """
+    Get all CC index servers from a given CDX server
+    """
+    collinfo = await get_collinfo(client, cdx_server)
+    CC_servers = [js["cdx-api"] for js in collinfo]
     return CC_servers
 
 
@@ -106,6 +128,14 @@ def log_after_retry(retry_state: RetryCallState):
         )
 
 
+def decode_content(body: bytes, content_type: str) -> Any:
+    if content_type == "text/x-ndjson":
+        return ndjson.loads(body)
+    elif content_type == "application/json":
+        return json.loads(body)
+    raise ValueError(f"Unknown content type: {content_type}")
+
+
 async def retrieve(
     client: ClientSession,
     cdx_server: str,
@@ -116,7 +146,14 @@ async def retrieve(
     allowed_status_errors: list[int] = ALLOWED_ERR_FOR_RETRIES,
     log_additional_info: dict[str, Any] = {},  # type: ignore
     throttler: Throttler | None = None,
+    cache: CDXResponseCache | None = None,
+    cache_ttl: timedelta | None = None,
 ):
+    if cache is not None:
+        cached = cache.get(cdx_server, params, cache_ttl)
+        if cached is not None:
+            return decode_content(cached, content_type)
+
     @retry(
         stop=stop_after_attempt(max_retry + 1),
         wait=wait_random_exponential(multiplier=5, exp_base=sleep_base, max=120),
@@ -147,12 +184,18 @@ async def retrieve(
                         raise ValueError(
                             f"Failed to download {cdx_server} with status {status} and reason {reason}"
                         )
+                    elif cache is not None:
+                        body = await response.read()
+                        content = decode_content(body, content_type)
+                        cache.set(cdx_server, params, body)
                     else:
                         if content_type == "text/x-ndjson":
-                            content = await response.json(
-                                content_type=content_type,
-                                loads=ndjson.Decoder().decode,
-                            )
+                            content = [
+                                js
+                                async for js in ndjson.iter_decode(
+                                    response.content.iter_any()
+                                )
+                            ]
                         elif content_type == "application/json":
                             content = await response.json(content_type=content_type)
                         else:
@@ -170,7 +213,8 @@ async def retrieve(
             return content
 
         if throttler is not None:
-            return await throttler.throttle(_request)
+            host_throttler = throttler.for_host(urlparse(cdx_server).netloc)
+            return await host_throttler.throttle(_request)
         else:
             return await _request()
 
@@ -184,6 +228,129 @@ async def retrieve(
     )
 
 
+async def retrieve_stream(
+    client: ClientSession,
+    cdx_server: str,
+    params: dict[str, Any],
+    max_retry: int,
+    sleep_base: float,
+    allowed_status_errors: list[int] = ALLOWED_ERR_FOR_RETRIES,
+    log_additional_info: dict[str, Any] = {},  # type: ignore
+    throttler: Throttler | None = None,
+    cache: CDXResponseCache | None = None,
+) -> AsyncIterator[Any]:
+    """
+    Streaming version of `retrieve` for ndjson responses.
+    Objects are yielded as soon as their line arrives, instead of after the whole body was read.
+
+    Opening of the response is retried the same way as in `retrieve`. If the connection
+    breaks mid-stream, the request is reissued and the already yielded objects are skipped,
+    up to `max_retry` times.
+
+    If cache is provided, the response is read from it when present, otherwise
+    the raw body is written to it while streaming and stored once complete.
+    """
+    if cache is not None:
+        cached_chunks = await cache.iter_chunks(cdx_server, params)
+        if cached_chunks is not None:
+            async for js in ndjson.iter_decode(cached_chunks):
+                yield js
+            return
+
+    async def _tee(chunks: AsyncIterator[bytes], writer: CDXCacheWriter):
+        async for chunk in chunks:
+            writer.write(chunk)
+            yield chunk
+
+    @retry(
+        stop=stop_after_attempt(max_retry + 1),
+        wait=wait_random_exponential(multiplier=5, exp_base=sleep_base, max=120),
+        retry=retry_if_exception_type(DownloadError),
+        reraise=True,
+        before_sleep=log_after_retry,
+    )
+    async def _open_with_throttling(
+        client: ClientSession,
+        cdx_server: str,
+        params: dict[str, Any],
+        allowed_status_errors: list[int],
+        log_additional_info: dict[str, Any],
+        stack: AsyncExitStack,
+    ) -> ClientResponse:
+        all_purpose_logger.debug(
+            f"Sending request to {cdx_server} with params: {params}"
+        )
+
+        async def _open():
+            try:
+                response = await client.get(cdx_server, params=params)
+            except (ClientError, TimeoutError, ServerConnectionError) as e:
+                raise DownloadError(f"{type(e)} {str(e)}", 500)
+
+            if not response.ok:
+                status = response.status
+                reason = str(response.reason) if response.reason else "Unknown"  # type: ignore
+                response.release()
+                if status in allowed_status_errors:
+                    raise DownloadError(reason, status)
+                raise ValueError(
+                    f"Failed to download {cdx_server} with status {status} and reason {reason}"
+                )
+            return response
+
+        if throttler is not None:
+            host_throttler = throttler.for_host(urlparse(cdx_server).netloc)
+            # The request stays in flight until the stream is consumed
+            return await stack.enter_async_context(
+                host_throttler.throttle_stream(_open)
+            )
+        else:
+            return await _open()
+
+    decoded = 0
+    failures = 0
+    while True:
+        async with AsyncExitStack() as stack:
+            response = await _open_with_throttling(
+                client=client,
+                cdx_server=cdx_server,
+                params=params,
+                allowed_status_errors=allowed_status_errors,
+                log_additional_info=log_additional_info,
+                stack=stack,
+            )
+            writer = cache.writer(cdx_server, params) if cache is not None else None
+            try:
+                chunks = response.content.iter_any()
+                if writer is not None:
+                    chunks = _tee(chunks, writer)
+
+                # Objects before `decoded` were already yielded by a broken stream
+                to_skip = decoded
+                async for js in ndjson.iter_decode(chunks):
+                    if to_skip > 0:
+                        to_skip -= 1
+                        continue
+                    decoded += 1
+                    yield js
+
+                if writer is not None:
+                    writer.commit()
+                return
+            except (ClientError, TimeoutError, ServerConnectionError) as e:
+                failures += 1
+                reason = f"{type(e)} {str(e)}"
+                if failures > max_retry:
+                    raise DownloadError(reason, 500)
+                all_purpose_logger.error(
+                    f"Stream from {cdx_server} broke with reason: '{reason}' after {decoded} objects, retry: {failures}, additional info: {log_additional_info}"
+                )
+            finally:
+                if writer is not None:
+                    writer.discard()
+                response.release()
+
+
 def crawl_to_year(crawl: str) -> int:
     year = re.search(r"(?:MAIN-)(\d{4})", crawl)
     if year is None:
@@ -200,7 +367,94 @@ def timestamp_to_datetime(timestamp: str) -> datetime:
     return datetime.strptime(timestamp, "%Y%m%d%H%M%S")
 
 
-async def remove_bucket_prefix(session: aioboto3.Session, prefix: str, folder: str):
+def record_filter_to_cdx_filters(record_filter: RecordFilter) -> list[str]:
+    """
+    Translates the record filter to values of the cdx server `filter` param.
+    The server matches the regex from the start of the field.
+    """
+
+    def any_of(values: list[str]) -> str:
+        return "(?:{})$".format("|".join(re.escape(value) for value in values))
+
+    filters: list[str] = []
+    if record_filter.statuses is not None:
+        filters.append(f"status:{any_of([str(s) for s in record_filter.statuses])}")
+    if record_filter.mimes is not None:
+        filters.append(f"mime-detected:{any_of(record_filter.mimes)}")
+    if record_filter.languages is not None:
+        languages = "|".join(re.escape(lang) for lang in record_filter.languages)
+        filters.append(f"languages:.*(?:{languages})")
+    if record_filter.url_regex is not None:
+        filters.append(f"url:.*(?:{record_filter.url_regex})")
+    if record_filter.digests is not None:
+        filters.append(f"digest:{any_of(record_filter.digests)}")
+    return filters
+
+
+class _SharedClient:
+    """
+    Context manager yielding an already opened client, without closing it on exit
+    """
+
+    def __init__(self, pool: AWSClientPool, service: str, kwargs: dict[str, Any]):
+        self.__pool = pool
+        self.__service = service
+        self.__kwargs = kwargs
+
+    async def __aenter__(self) -> Any:
+        return await self.__pool.get(self.__service, **self.__kwargs)
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        return None
+
+
+class AWSClientPool:
+    """
+    Long-lived AWS clients of a session, opened on first use and shared by all the calls,
+    so that the credentials resolution and the connection setup aren't repeated per request.
+    It can be used in place of the session: `async with pool.client("s3") as s3` yields
+    the shared client.
+
+    Args:
+        session (aioboto3.Session): Session to create the clients from.
+        max_pool_connections (int, optional): Size of the connection pool of every client. Defaults to 50.
+    """
+
+    def __init__(self, session: aioboto3.Session, max_pool_connections: int = 50):
+        self.session = session
+        self.config = AioConfig(max_pool_connections=max_pool_connections)
+        self.__exit_stack = AsyncExitStack()
+        self.__clients: dict[tuple[str, str | None], Any] = {}
+        self.__lock = asyncio.Lock()
+
+    @property
+    def region_name(self) -> str | None:
+        return self.session.region_name
+
+    def client(self, service: str, **kwargs: Any) -> _SharedClient:
+        return _SharedClient(self, service, kwargs)
+
+    async def get(self, service: str, region_name: str | None = None) -> Any:
+        # Calls without region use the one of the session, the client is the same
+        region_name = region_name or self.region_name
+        key = (service, region_name)
+        async with self.__lock:
+            if key not in self.__clients:
+                self.__clients[key] = await self.__exit_stack.enter_async_context(
+                    self.session.client(
+                        service, region_name=region_name, config=self.config
+                    )
+                )
+        return self.__clients[key]
+
+    async def aclose(self):
+        self.__clients.clear()
+        await self.__exit_stack.aclose()
+
+
+async def remove_bucket_prefix(
+    session: aioboto3.Session | AWSClientPool, prefix: str, folder: str
+):
     # remove all query results
     async with session.client("s3") as s3:
         paginator = s3.get_paginator("list_objects_v2")
@@ -212,8 +466,16 @@ async def remove_bucket_prefix(session: aioboto3.Session, prefix: str, folder: s
 
 
 async def run_athena_query(
-    session: aioboto3.Session, query_kwargs: dict[str, Any]
+    session: aioboto3.Session | AWSClientPool,
+    query_kwargs: dict[str, Any],
+    poll_min: float = 0.2,
+    poll_max: float = 5,
 ) -> str:
+    """
+    Runs the query and waits for it to finish, returns its execution id.
+    The status is polled with exponential backoff from `poll_min` to `poll_max` seconds,
+    so that short queries aren't delayed by a long polling interval.
+    """
     async with session.client(
         "athena",
         region_name=session.region_name
@@ -227,6 +489,7 @@ async def run_athena_query(
             raise Exception(f"Athena query failed: {query_result}")
 
         query_execution_id = query_result["QueryExecutionId"]
+        poll_interval = poll_min
         while True:
             response = await athena.get_query_execution(
                 QueryExecutionId=query_execution_id
@@ -238,5 +501,6 @@ async def run_athena_query(
             if status == "SUCCEEDED":
                 break
 
-            await asyncio.sleep(5)
+            await asyncio.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, poll_max)
     return query_execution_id
@@ -1,7 +1,46 @@
 import json
+from typing import Any, AsyncIterable, AsyncIterator, List
 
 
 class Decoder(json.JSONDecoder):
     def decode(self, s: str, *args, **kwargs):
         lines = f"[{','.join(s.splitlines())}]"
         return super(Decoder, self).decode(lines, *args, **kwargs)
+
+
+def loads(data: bytes, encoding: str = "utf-8") -> List[Any]:
+    """
+    Decodes whole ndjson document into a list of objects
+    """
+    return [
+        json.loads(line) for line in data.decode(encoding).splitlines() if line.strip()
+    ]
+
+
+async def iter_decode(
+    chunks: AsyncIterable[bytes], encoding: str = "utf-8"
+) -> AsyncIterator[Any]:
+    """
+    Incrementally decodes ndjson from an async stream of byte chunks.
+    Every object is yielded as soon as its line is complete, so only the
+    currently incomplete line is kept in memory.
+
+    Args:
+        chunks (AsyncIterable[bytes]): Stream of arbitrarily split byte chunks, e.g. `response.content.iter_any()`
+        encoding (str, optional): Encoding of the stream. Defaults to "utf-8".
+    """
+    remainder = b""
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        lines = (remainder + chunk).split(b"\n")
+        # Last part is either empty or an incomplete line
+        remainder = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if line:
+                yield json.loads(line.decode(encoding))
+
+    remainder = remainder.strip()
+    if remainder:
+        yield json.loads(remainder.decode(encoding))
@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import io
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from cmoncrawl.common.types import NO_TIMESTAMP, DomainRecordBatch
+
+# Same as the initial footer read of pyarrow, so opening the file needs a single request
+FOOTER_READ_SIZE = 64 * 1024
+PARQUET_MAGIC = b"PAR1"
+
+
+def arrow_to_domain_record_batch(batch: pa.RecordBatch) -> DomainRecordBatch:
+    """
+    Converts the result columns to DomainRecordBatch, without creating
+    a DomainRecord or datetime per row.
+    """
+    fetch_time = pc.cast(batch.column("fetch_time"), pa.timestamp("us"))
+    timestamps = pc.fill_null(pc.cast(fetch_time, pa.int64()), NO_TIMESTAMP)
+    return DomainRecordBatch.from_columns(
+        filenames=batch.column("warc_filename").to_pylist(),
+        urls=batch.column("url").to_pylist(),
+        offsets=batch.column("warc_record_offset").to_pylist(),
+        lengths=batch.column("warc_record_length").to_pylist(),
+        digests=batch.column("content_digest").to_pylist(),
+        timestamps=timestamps.to_pylist(),
+    )
+
+
+class ByteRangeFile(io.RawIOBase):
+    """
+    Read-only file of `size` bytes, which serves reads only from the ranges added
+    with `add_range`. It lets pyarrow decode a row group, while the bytes are fetched
+    asynchronously and only the footer and the current row group are kept in memory.
+
+    Args:
+        size (int): Size of the whole file.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.__ranges: Dict[int, bytes] = {}
+        self.__position = 0
+
+    def add_range(self, start: int, data: bytes):
+        self.__ranges[start] = data
+
+    def drop_range(self, start: int):
+        self.__ranges.pop(start, None)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.__position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        match whence:
+            case io.SEEK_SET:
+                self.__position = offset
+            case io.SEEK_CUR:
+                self.__position += offset
+            case io.SEEK_END:
+                self.__position = self.size + offset
+            case _:
+                raise ValueError(f"Invalid whence {whence}")
+        return self.__position
+
+    def readinto(self, buffer) -> int:
+        if self.__position >= self.size:
+            return 0
+        for start, data in self.__ranges.items():
+            if start <= self.__position < start + len(data):
+                chunk = data[self.__position - start :][: len(buffer)]
+                buffer[: len(chunk)] = chunk
+                self.__position += len(chunk)
+                return len(chunk)
+        raise ValueError(f"Bytes at {self.__position} were not fetched")
+
+
+def row_group_range(
+    metadata: pq.FileMetaData, row_group: int, columns: Optional[List[str]] = None
+) -> Tuple[int, int]:
+    """
+    Returns the [start, end) byte range of the column chunks of the row group
+    """
+    group = metadata.row_group(row_group)
+    start: Optional[int] = None
+    end = 0
+    for i in range(group.num_columns):
+        chunk = group.column(i)
+        if columns is not None and chunk.path_in_schema not in columns:
+            continue
+        chunk_start = (
+            chunk.dictionary_page_offset
+            if chunk.has_dictionary_page and chunk.dictionary_page_offset
+            else chunk.data_page_offset
+        )
+        start = chunk_start if start is None else min(start, chunk_start)
+        end = max(end, chunk_start + chunk.total_compressed_size)
+    return start or 0, end
+
+
+async def read_s3_range(s3, bucket: str, key: str, start: int, end: int) -> bytes:
+    response = await s3.get_object(
+        Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}"
+    )
+    return await response["Body"].read()
+
+
+async def read_s3_tail(s3, bucket: str, key: str, length: int) -> Tuple[bytes, int]:
+    """
+    Returns the last `length` bytes of the file and the size of the file
+    """
+    response = await s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=-{length}")
+    # bytes <start>-<end>/<size>
+    size = int(response["ContentRange"].rsplit("/", 1)[1])
+    return await response["Body"].read(), size
+
+
+async def iter_s3_parquet_row_groups(
+    s3, bucket: str, key: str, columns: Optional[List[str]] = None
+) -> AsyncIterator[pa.Table]:
+    """
+    Streams a parquet file from S3 row group by row group, using ranged reads.
+    Only the footer and the column chunks of the current row group are held in memory.
+
+    Args:
+        s3: aioboto3 S3 client.
+        bucket (str): Bucket of the file.
+        key (str): Key of the file.
+        columns (List[str], optional): Columns to read. Defaults to None (all columns).
+    """
+    tail, size = await read_s3_tail(s3, bucket, key, FOOTER_READ_SIZE)
+    tail_start = size - len(tail)
+    file = ByteRangeFile(size)
+    if tail[-4:] != PARQUET_MAGIC:
+        raise ValueError(f"{key} is not a parquet file")
+    footer_size = int.from_bytes(tail[-8:-4], "little") + 8
+    if footer_size > len(tail):
+        tail_start = size - footer_size
+        tail = await read_s3_range(s3, bucket, key, tail_start, size)
+    file.add_range(tail_start, tail)
+
+    parquet_file = pq.ParquetFile(file)
+    for row_group in range(parquet_file.metadata.num_row_groups):
+        start, end = row_group_range(parquet_file.metadata, row_group, columns)
+        # The chunks may be in the fetched footer range, in case of tiny files
+        fetched = start < tail_start
+        if fetched:
+            file.add_range(start, await read_s3_range(s3, bucket, key, start, end))
+        yield parquet_file.read_row_group(row_group, columns=columns)
+        if fetched:
+            file.drop_range(start)
@@ -0,0 +1,81 @@
+import asyncio
+import sys
+from collections import deque
+from typing import Deque, Generic, Tuple, TypeVar
+
+from cmoncrawl.common.types import DomainRecord
+
+T = TypeVar("T")
+
+# Rough per-object overhead of a DomainRecord (pydantic model, dict, ints, datetime)
+DOMAIN_RECORD_OVERHEAD = 600
+
+
+def estimate_record_size(domain_record: DomainRecord) -> int:
+    """
+    Cheap estimate of the memory used by a DomainRecord in bytes.
+    """
+    size = DOMAIN_RECORD_OVERHEAD
+    for value in (
+        domain_record.filename,
+        domain_record.url,
+        domain_record.digest,
+        domain_record.encoding,
+    ):
+        if value is not None:
+            size += sys.getsizeof(value)
+    return size
+
+
+class RecordBuffer(Generic[T]):
+    """
+    FIFO buffer bounded both by number of items and by their estimated size.
+    Producers wait in `put` until consumers free enough space, which provides
+    backpressure to the fetching side.
+
+    An item is always accepted into an empty buffer, so that a single item
+    larger than `max_bytes` can't block forever.
+
+    Args:
+        max_items (int): Maximum number of buffered items.
+        max_bytes (int): Maximum estimated size of buffered items in bytes.
+    """
+
+    def __init__(self, max_items: int, max_bytes: int):
+        if max_items <= 0 or max_bytes <= 0:
+            raise ValueError("Buffer bounds must be greater than 0")
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.__items: Deque[Tuple[T, int]] = deque()
+        self.__not_full = asyncio.Event()
+        self.__not_full.set()
+        self.__not_empty = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self.__items)
+
+    def full(self) -> bool:
+        return len(self.__items) >= self.max_items or self.bytes >= self.max_bytes
+
+    async def put(self, item: T, size: int):
+        while len(self.__items) > 0 and self.full():
+            self.__not_full.clear()
+            await self.__not_full.wait()
+        self.__items.append((item, size))
+        self.bytes += size
+        self.__not_empty.set()
+
+    def get_nowait(self) -> T:
+        item, size = self.__items.popleft()
+        self.bytes -= size
+        if not self.full():
+            self.__not_full.set()
+        if len(self.__items) == 0:
+            self.__not_empty.clear()
+        return item
+
+    async def get(self) -> T:
+        while len(self.__items) == 0:
+            await self.__not_empty.wait()
+        return self.get_nowait()
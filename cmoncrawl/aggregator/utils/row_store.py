@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import dataclasses
+import json
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from cmoncrawl.aggregator.utils.surt import surt_range, url_to_surt
+from cmoncrawl.common.loggers import all_purpose_logger
+from cmoncrawl.common.types import DomainRecord, MatchType, RecordFilter
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rows (
+    variant TEXT NOT NULL,
+    crawl TEXT NOT NULL,
+    urlkey TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    url TEXT,
+    filename TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    digest TEXT,
+    encoding TEXT,
+    UNIQUE (variant, crawl, filename, offset)
+);
+CREATE INDEX IF NOT EXISTS rows_urlkey ON rows (variant, crawl, urlkey);
+CREATE TABLE IF NOT EXISTS fetches (
+    id INTEGER PRIMARY KEY,
+    variant TEXT NOT NULL,
+    crawl TEXT NOT NULL,
+    key_start TEXT NOT NULL,
+    key_end TEXT NOT NULL,
+    since TEXT NOT NULL,
+    until TEXT NOT NULL,
+    num_pages INTEGER NOT NULL,
+    page_size INTEGER NOT NULL,
+    UNIQUE (variant, crawl, key_start, key_end, since, until, page_size)
+);
+CREATE TABLE IF NOT EXISTS fetched_pages (
+    fetch_id INTEGER NOT NULL,
+    page INTEGER NOT NULL,
+    PRIMARY KEY (fetch_id, page)
+);
+"""
+
+
+def row_key(domain_record: DomainRecord) -> str:
+    """
+    Key of the row in the same form as of zipnum index lines, "<surt> <timestamp>"
+    """
+    timestamp = (
+        domain_record.timestamp.strftime("%Y%m%d%H%M%S")
+        if domain_record.timestamp
+        else ""
+    )
+    return f"{url_to_surt(domain_record.url or '')} {timestamp}"
+
+
+def record_filter_variant(record_filter: Optional[RecordFilter]) -> str:
+    """
+    Rows fetched with different filters are kept apart, as the store can't evaluate
+    the filters itself (the trimmed rows lack status, mime and languages).
+    """
+    if record_filter is None:
+        return ""
+    return json.dumps(dataclasses.asdict(record_filter), sort_keys=True)
+
+
+class CDXRowStore:
+    """
+    Local SQLite store of the index rows fetched by the aggregators, keyed by SURT.
+
+    Next to the rows, it records which (crawl, SURT key range, date range, page size) queries were
+    fetched completely, so a later query with a narrower match type, date range or
+    a subset of the urls can be answered from the store without the index server,
+    see `covers` and RowStoreAggregator.
+
+    Args:
+        path (Path): Path to the SQLite database, created if it doesn't exist.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def begin_fetch(
+        self,
+        crawl: str,
+        url: str,
+        match_type: MatchType,
+        since: datetime,
+        to: datetime,
+        num_pages: int,
+        record_filter: Optional[RecordFilter] = None,
+        page_size: int | None = None,
+    ) -> int:
+        """
+        Registers a query of a crawl, whose `num_pages` pages of `page_size` are going to be stored.
+        Queries with a different page size are registered separately, as their page numbers differ.
+        Returns the id to pass to `add_page`.
+        """
+        key_start, key_end = surt_range(url, match_type)
+        params = (
+            record_filter_variant(record_filter),
+            crawl,
+            key_start,
+            key_end,
+            since.isoformat(),
+            to.isoformat(),
+            # 0 for the default page size of the server
+            page_size or 0,
+        )
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO fetches (variant, crawl, key_start, key_end, since, until, page_size, num_pages) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                params + (num_pages,),
+            )
+            row = self.connection.execute(
+                "SELECT id FROM fetches WHERE variant = ? AND crawl = ? AND key_start = ? AND key_end = ? AND since = ? AND until = ? AND page_size = ?",
+                params,
+            ).fetchone()
+        return row[0]
+
+    def add_page(
+        self, fetch_id: int, page: int, crawl: str, domain_records: List[DomainRecord]
+    ):
+        """
+        Stores the records of a completely fetched page
+        """
+        variant = self.connection.execute(
+            "SELECT variant FROM fetches WHERE id = ?", (fetch_id,)
+        ).fetchone()[0]
+        rows = [
+            (
+                variant,
+                crawl,
+                row_key(record),
+                record.timestamp.isoformat() if record.timestamp else "",
+                record.url,
+                record.filename,
+                record.offset,
+                record.length,
+                record.digest,
+                record.encoding,
+            )
+            for record in domain_records
+        ]
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO rows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self.connection.execute(
+                "INSERT OR IGNORE INTO fetched_pages VALUES (?, ?)", (fetch_id, page)
+            )
+
+    def covers(
+        self,
+        crawl: str,
+        url: str,
+        match_type: MatchType,
+        since: datetime,
+        to: datetime,
+        record_filter: Optional[RecordFilter] = None,
+    ) -> bool:
+        """
+        Returns True if all pages of a query, whose key and date ranges contain
+        the given ones, were stored.
+        """
+        key_start, key_end = surt_range(url, match_type)
+        row = self.connection.execute(
+            """
+            SELECT 1 FROM fetches AS f
+            WHERE f.variant = ? AND f.crawl = ?
+                AND f.key_start <= ? AND f.key_end >= ?
+                AND f.since <= ? AND f.until >= ?
+                AND f.num_pages = (SELECT COUNT(*) FROM fetched_pages AS p WHERE p.fetch_id = f.id)
+            LIMIT 1
+            """,
+            (
+                record_filter_variant(record_filter),
+                crawl,
+                key_start,
+                key_end,
+                since.isoformat(),
+                to.isoformat(),
+            ),
+        ).fetchone()
+        return row is not None
+
+    def crawls(self) -> List[str]:
+        """
+        Crawls with any stored query, newest first
+        """
+        rows = self.connection.execute(
+            "SELECT DISTINCT crawl FROM fetches ORDER BY crawl DESC"
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def query(
+        self,
+        crawl: str,
+        url: str,
+        match_type: MatchType,
+        since: datetime,
+        to: datetime,
+        record_filter: Optional[RecordFilter] = None,
+        batch_size: int = 10_000,
+    ) -> Iterator[List[DomainRecord]]:
+        """
+        Yields the stored records of the crawl matching the query, in SURT order,
+        in lists of at most `batch_size`.
+        """
+        key_range: Tuple[str, str] = surt_range(url, match_type)
+        cursor = self.connection.execute(
+            """
+            SELECT url, timestamp, filename, offset, length, digest, encoding FROM rows
+            WHERE variant = ? AND crawl = ? AND urlkey >= ? AND urlkey < ?
+                AND timestamp >= ? AND timestamp <= ?
+            ORDER BY urlkey
+            """,
+            (
+                record_filter_variant(record_filter),
+                crawl,
+                *key_range,
+                since.isoformat(),
+                to.isoformat(),
+            ),
+        )
+        found = 0
+        while rows := cursor.fetchmany(batch_size):
+            found += len(rows)
+            yield [
+                DomainRecord.construct_trusted(
+                    url=row[0],
+                    timestamp=datetime.fromisoformat(row[1]) if row[1] else None,
+                    filename=row[2],
+                    offset=row[3],
+                    length=row[4],
+                    digest=row[5],
+                    encoding=row[6],
+                )
+                for row in rows
+            ]
+        all_purpose_logger.info(f"Found {found} stored records for {url} in {crawl}")
@@ -0,0 +1,78 @@
+import re
+from typing import Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from cmoncrawl.common.types import MatchType
+
+www_re = re.compile(r"^www\d*\.")
+DEFAULT_PORTS = {"http": "80", "https": "443"}
+
+
+def host_to_surt(host: str) -> str:
+    """
+    Converts host to its SURT form e.g. www.example.com -> com,example
+    """
+    host = www_re.sub("", host.lower().strip("."))
+    return ",".join(reversed(host.split(".")))
+
+
+def url_to_surt(url: str) -> str:
+    """
+    Converts url to SURT key, in the same way as the urlkey of Common Crawl indexes.
+    e.g. https://www.Example.com/Path/?b=1&a=2 -> com,example)/path?a=2&b=1
+
+    Only the canonicalization needed for matching index keys is done:
+    lowercasing, www stripping, default port stripping, trailing slash stripping
+    and sorting of query params.
+    """
+    if "://" not in url:
+        url = f"http://{url}"
+    parsed = urlsplit(url.strip())
+    surt = host_to_surt(parsed.hostname or "")
+    port = str(parsed.port) if parsed.port is not None else None
+    if port is not None and port != DEFAULT_PORTS.get(parsed.scheme):
+        surt += f":{port}"
+
+    path = parsed.path or "/"
+    if len(path) > 1:
+        path = path.rstrip("/") or "/"
+    surt += f"){path}"
+
+    if parsed.query:
+        query = sorted(parse_qsl(parsed.query, keep_blank_values=True))
+        surt += f"?{urlencode(query)}"
+    return surt.lower()
+
+
+def next_key(key: str) -> str:
+    """
+    Returns the smallest key, which is greater than all keys starting with `key`
+    """
+    return key[:-1] + chr(ord(key[-1]) + 1)
+
+
+def surt_range(url: str, match_type: MatchType) -> Tuple[str, str]:
+    """
+    Returns a [start, end) range of SURT keys, which match the url with given match type.
+    """
+    surt = url_to_surt(url)
+    host_surt, path = surt.split(")", 1)
+    match match_type:
+        case MatchType.EXACT:
+            # Same key, any timestamp
+            return f"{surt} ", f"{surt}!"
+        case MatchType.PREFIX:
+            prefix = surt if path != "/" else f"{host_surt})/"
+            return prefix, next_key(prefix)
+        case MatchType.HOST:
+            # com,example)/...
+            return f"{host_surt})", f"{host_surt}*"
+        case MatchType.DOMAIN:
+            # com,example)/... and com,example,sub)/...
+            return f"{host_surt})", f"{host_surt}-"
+    raise ValueError("Invalid match type")
+
+
+def surt_in_range(surt: str, key_range: Tuple[str, str]) -> bool:
+    start, end = key_range
+    return start <= surt < end
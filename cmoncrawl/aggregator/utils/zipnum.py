@@ -0,0 +1,345 @@
+from __future__ import annotations
+
+import abc
+import json
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import (
+    AsyncContextManager,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+import aioboto3
+import aiofiles
+
+from cmoncrawl.aggregator.utils.helpers import timestamp_to_datetime
+from cmoncrawl.common.types import DomainRecord, RecordFilter
+
+CLUSTER_INDEX = "cluster.idx"
+# Every line of cluster.idx is much shorter, so a probe always contains a whole line
+PROBE_SIZE = 4096
+
+
+def crawl_index_path(crawl: str, filename: str) -> str:
+    """
+    Path of a file of the zipnum index relative to the collections root
+    e.g. CC-MAIN-2023-23/indexes/cluster.idx
+    """
+    return f"{crawl}/indexes/{filename}"
+
+
+class IByteRangeSource(AsyncContextManager, abc.ABC):
+    """
+    Random access to the files of the zipnum index.
+    Paths are relative to the root of collections (cc-index/collections on S3).
+    """
+
+    async def __aenter__(self) -> IByteRangeSource:
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        return None
+
+    @abc.abstractmethod
+    async def size(self, path: str) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def read(self, path: str, offset: int, length: int) -> bytes:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def list_crawls(self) -> List[str]:
+        """
+        Lists crawl ids available in the source, newest first.
+        """
+        raise NotImplementedError
+
+
+class LocalByteRangeSource(IByteRangeSource):
+    """
+    Reads the zipnum index from a local mirror of cc-index/collections.
+
+    Args:
+        root (Path): Directory containing <crawl>/indexes/cluster.idx and the cdx-*.gz shards.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    async def size(self, path: str) -> int:
+        return (self.root / path).stat().st_size
+
+    async def read(self, path: str, offset: int, length: int) -> bytes:
+        async with aiofiles.open(self.root / path, "rb") as afp:
+            await afp.seek(offset)
+            return await afp.read(length)
+
+    async def list_crawls(self) -> List[str]:
+        crawls = [
+            crawl_dir.name
+            for crawl_dir in self.root.iterdir()
+            if (crawl_dir / "indexes" / CLUSTER_INDEX).exists()
+        ]
+        return sorted(crawls, reverse=True)
+
+
+class S3ByteRangeSource(IByteRangeSource):
+    """
+    Reads the zipnum index directly from the commoncrawl S3 bucket, using ranged GETs.
+    Only usable from AWS credentials, which can access the bucket.
+
+    Args:
+        bucket (str, optional): Bucket with the index. Defaults to "commoncrawl".
+        prefix (str, optional): Prefix of the collections. Defaults to "cc-index/collections".
+        aws_profile (str, optional): The AWS profile to use. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        bucket: str = "commoncrawl",
+        prefix: str = "cc-index/collections",
+        aws_profile: Optional[str] = None,
+    ):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.aws_profile = aws_profile
+        self.__sizes: Dict[str, int] = {}
+
+    async def __aenter__(self) -> S3ByteRangeSource:
+        session = aioboto3.Session(
+            profile_name=self.aws_profile, region_name="us-east-1"
+        )
+        self.__client_ctx = session.client("s3")
+        self.__s3 = await self.__client_ctx.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.__client_ctx.__aexit__(exc_type, exc_value, traceback)
+
+    def __key(self, path: str) -> str:
+        return f"{self.prefix}/{path}"
+
+    async def size(self, path: str) -> int:
+        if path not in self.__sizes:
+            response = await self.__s3.head_object(
+                Bucket=self.bucket, Key=self.__key(path)
+            )
+            self.__sizes[path] = response["ContentLength"]
+        return self.__sizes[path]
+
+    async def read(self, path: str, offset: int, length: int) -> bytes:
+        if length <= 0:
+            return b""
+        response = await self.__s3.get_object(
+            Bucket=self.bucket,
+            Key=self.__key(path),
+            Range=f"bytes={offset}-{offset + length - 1}",
+        )
+        async with response["Body"] as body:
+            return await body.read()
+
+    async def list_crawls(self) -> List[str]:
+        crawls: List[str] = []
+        paginator = self.__s3.get_paginator("list_objects_v2")
+        async for page in paginator.paginate(
+            Bucket=self.bucket, Prefix=f"{self.prefix}/", Delimiter="/"
+        ):
+            for common_prefix in page.get("CommonPrefixes", []):
+                crawl = common_prefix["Prefix"].rstrip("/").split("/")[-1]
+                if crawl.startswith("CC-MAIN-"):
+                    crawls.append(crawl)
+        return sorted(crawls, reverse=True)
+
+
+@dataclass
+class ZipNumBlock:
+    """
+    A single gzip block of a cdx shard, as listed in cluster.idx.
+    Blocks are independent gzip members, so they can be decompressed separately.
+    """
+
+    key: str
+    filename: str
+    offset: int
+    length: int
+
+
+def parse_cluster_line(line: bytes) -> ZipNumBlock:
+    # <surt> <timestamp>\t<filename>\t<offset>\t<length>\t<cluster id>
+    key, filename, offset, length = line.decode("utf-8").split("\t")[:4]
+    return ZipNumBlock(key, filename, int(offset), int(length))
+
+
+def cluster_line_key(line: bytes) -> bytes:
+    return line.split(b"\t", 1)[0]
+
+
+class ClusterIndex:
+    """
+    Secondary index (cluster.idx) of a single crawl.
+
+    The file is never downloaded whole, instead it's binary searched with small
+    ranged reads, so that a lookup costs only ~log2(size / probe_size) reads.
+
+    Args:
+        source (IByteRangeSource): Source of the index files.
+        crawl (str): Crawl id e.g. CC-MAIN-2023-23
+        probe_size (int, optional): Number of bytes read per bisection step. Defaults to 4096.
+    """
+
+    def __init__(
+        self, source: IByteRangeSource, crawl: str, probe_size: int = PROBE_SIZE
+    ):
+        self.source = source
+        self.crawl = crawl
+        self.path = crawl_index_path(crawl, CLUSTER_INDEX)
+        self.probe_size = probe_size
+        self.__size: Optional[int] = None
+
+    async def size(self) -> int:
+        if self.__size is None:
+            self.__size = await self.source.size(self.path)
+        return self.__size
+
+    async def bisect_left(self, target: bytes) -> int:
+        """
+        Returns the offset of the first line, whose key is >= target,
+        or the size of the file if there is no such line.
+        """
+        size = await self.size()
+        # The first line with key >= target starts in (lo, hi], lo = 0 is a line start too
+        lo, hi = 0, size
+        while hi - lo > 2 * self.probe_size:
+            mid = (lo + hi) // 2
+            data = await self.source.read(self.path, mid, 2 * self.probe_size)
+            line_start = data.find(b"\n") + 1
+            line_end = data.find(b"\n", line_start)
+            if line_end == -1 and mid + len(data) >= size:
+                # Last line without trailing newline
+                line_end = len(data)
+            if line_start == 0 or line_end == -1:
+                raise ValueError(f"Line of {self.path} is longer than probe size")
+
+            if cluster_line_key(data[line_start:line_end]) < target:
+                lo = mid + line_start
+            else:
+                hi = mid + line_start
+
+        data = await self.source.read(self.path, lo, hi - lo)
+        offset = lo
+        for line in data.split(b"\n"):
+            if offset >= hi:
+                break
+            if line and cluster_line_key(line) >= target:
+                return offset
+            offset += len(line) + 1
+        return hi
+
+    async def __previous_line_start(self, offset: int) -> int:
+        if offset == 0:
+            return 0
+        start = max(0, offset - self.probe_size)
+        data = await self.source.read(self.path, start, offset - start)
+        # data ends with the newline of the previous line
+        return start + data.rfind(b"\n", 0, len(data) - 1) + 1
+
+    async def find_blocks(self, start: str, end: str) -> List[ZipNumBlock]:
+        """
+        Returns blocks, which can contain keys from [start, end).
+        """
+        start_offset = await self.bisect_left(start.encode("utf-8"))
+        end_offset = await self.bisect_left(end.encode("utf-8"))
+        # The block before the first key >= start can still contain keys >= start
+        start_offset = await self.__previous_line_start(start_offset)
+        if end_offset <= start_offset:
+            return []
+
+        data = await self.source.read(
+            self.path, start_offset, end_offset - start_offset
+        )
+        return [parse_cluster_line(line) for line in data.split(b"\n") if line]
+
+
+def merge_blocks(
+    blocks: List[ZipNumBlock], max_range_size: int
+) -> List[Tuple[str, int, int]]:
+    """
+    Merges adjacent blocks of the same shard into (filename, offset, length) ranges,
+    so that they can be fetched with a single read.
+    """
+    ranges: List[Tuple[str, int, int]] = []
+    for block in blocks:
+        if ranges:
+            filename, offset, length = ranges[-1]
+            if (
+                filename == block.filename
+                and offset + length == block.offset
+                and length + block.length <= max_range_size
+            ):
+                ranges[-1] = (filename, offset, length + block.length)
+                continue
+        ranges.append((block.filename, block.offset, block.length))
+    return ranges
+
+
+def decompress_blocks(data: bytes) -> Iterator[bytes]:
+    """
+    Decompresses concatenated gzip members, yielding each member separately.
+    """
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        yield decompressor.decompress(data) + decompressor.flush()
+        data = decompressor.unused_data
+
+
+def decode_blocks(
+    data: bytes,
+    key_range: Tuple[str, str],
+    since: Optional[datetime] = None,
+    to: Optional[datetime] = None,
+    record_filter: Optional[RecordFilter] = None,
+) -> List[DomainRecord]:
+    """
+    Decodes cdx lines from the gzip blocks, keeping only the ones in key_range and [since, to],
+    which match the record_filter.
+    """
+    start, end = (key.encode("utf-8") for key in key_range)
+    domain_records: List[DomainRecord] = []
+    for block in decompress_blocks(data):
+        for line in block.split(b"\n"):
+            if not line:
+                continue
+            # <surt> <timestamp> <json>
+            surt, timestamp_raw, js_raw = line.split(b" ", 2)
+            key = surt + b" " + timestamp_raw
+            if key < start or key >= end:
+                continue
+
+            timestamp = timestamp_to_datetime(timestamp_raw.decode("utf-8"))
+            if (since is not None and timestamp < since) or (
+                to is not None and timestamp > to
+            ):
+                continue
+
+            js = json.loads(js_raw)
+            if record_filter is not None and not record_filter.matches(js):
+                continue
+            domain_records.append(
+                DomainRecord.construct_trusted(
+                    filename=js["filename"],
+                    offset=int(js["offset"]),
+                    length=int(js["length"]),
+                    url=js.get("url", ""),
+                    encoding=js.get("encoding"),
+                    digest=js.get("digest"),
+                    timestamp=timestamp,
+                )
+            )
+    return domain_records
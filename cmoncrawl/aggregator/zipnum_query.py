@@ -0,0 +1,286 @@
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from datetime import datetime
+from typing import (
+    AsyncIterator,
+    Deque,
+    List,
+    Optional,
+    Tuple,
+)
+
+from cmoncrawl.aggregator.base import IAggregator
+from cmoncrawl.aggregator.utils.athena_query_maker import crawl_url_to_name
+from cmoncrawl.aggregator.utils.collapse import RecordCollapser, order_crawls
+from cmoncrawl.aggregator.utils.crawl_catalog import (
+    CrawlCatalog,
+    crawl_in_date_range,
+)
+from cmoncrawl.aggregator.utils.surt import surt_range
+from cmoncrawl.aggregator.utils.zipnum import (
+    ClusterIndex,
+    IByteRangeSource,
+    S3ByteRangeSource,
+    crawl_index_path,
+    decode_blocks,
+    merge_blocks,
+)
+from cmoncrawl.common.loggers import all_purpose_logger
+from cmoncrawl.common.types import CollapseMode, DomainRecord, MatchType, RecordFilter
+
+# (crawl, key range, (shard filename, offset, length))
+BlockRange = Tuple[str, Tuple[str, str], Tuple[str, int, int]]
+
+
+class ZipNumAggregator(IAggregator):
+    """
+    This class is responsible for aggregating the index files from commoncrawl
+    by reading the zipnum cdx index (cluster.idx and cdx-*.gz shards) directly.
+    It is an async context manager which can then be used as an async iterator
+    which yields DomainRecord objects, found in the index files of commoncrawl.
+
+    For every crawl, the cluster.idx is binary searched for the SURT key range of the urls
+    and only the gzip blocks, which can contain the keys, are read and decompressed.
+    The index server is not used at all.
+
+    Args:
+        urls (List[str]): A list of urls to search for.
+        match_type (MatchType, optional): Match type for the urls. Defaults to MatchType.EXACT.
+        cc_servers (List[str], optional): Crawls to query, either crawl ids (CC-MAIN-2023-23) or cdx server urls. If None, all crawls of the source are used. Defaults to None.
+        since (datetime, optional): The start date for the search. Defaults to datetime.min.
+        to (datetime, optional): The end date for the search. Defaults to datetime.max.
+        limit (int, optional): The maximum number of results to return. Defaults to None.
+        prefetch_size (int, optional): The number of block ranges fetched concurrently. Defaults to 3.
+        source (IByteRangeSource, optional): Where to read the index from, e.g. LocalByteRangeSource for a local mirror. Defaults to S3ByteRangeSource.
+        aws_profile (str, optional): The AWS profile to use for the default S3 source. Defaults to None.
+        max_range_size (int, optional): Maximum number of bytes of adjacent blocks fetched in a single read. Defaults to 1 MiB.
+        crawl_catalog (CrawlCatalog, optional): Catalog used to skip crawls outside of the date range. Defaults to None.
+        record_filter (RecordFilter, optional): Filter on the index records, applied while decoding the blocks. Defaults to None.
+        collapse (CollapseMode, optional): Keep only a single capture of every url (per crawl for PER_CRAWL). The crawls are read from the oldest for FIRST and from the newest for LATEST, LATEST keeps the latest capture of the newest crawl containing the url. Defaults to None (all captures).
+
+    Examples:
+        >>> async with ZipNumAggregator(["example.com"], source=LocalByteRangeSource(Path("collections"))) as aggregator:
+        >>>     async for domain_record in aggregator:
+        >>>         print(domain_record)
+
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        match_type: MatchType = MatchType.EXACT,
+        cc_servers: Optional[List[str]] = None,
+        since: datetime = datetime.min,
+        to: datetime = datetime.max,
+        limit: int | None = None,
+        prefetch_size: int = 3,
+        source: Optional[IByteRangeSource] = None,
+        aws_profile: Optional[str] = None,
+        max_range_size: int = 1024 * 1024,
+        crawl_catalog: Optional[CrawlCatalog] = None,
+        record_filter: Optional[RecordFilter] = None,
+        collapse: Optional[CollapseMode] = None,
+    ) -> None:
+        self.urls = urls
+        self.match_type = match_type
+        self.cc_servers = cc_servers
+        self.since = since
+        self.to = to
+        self.limit = limit
+        self.prefetch_size = prefetch_size
+        self.max_range_size = max_range_size
+        self.crawl_catalog = crawl_catalog
+        self.record_filter = record_filter
+        self.collapse = collapse
+        self.source = (
+            source if source is not None else S3ByteRangeSource(aws_profile=aws_profile)
+        )
+
+    async def __aenter__(self) -> ZipNumAggregator:
+        return await self.aopen()
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.aclose()
+
+    async def aopen(self) -> ZipNumAggregator:
+        await self.source.__aenter__()
+        if not self.cc_servers:
+            if self.crawl_catalog is not None:
+                self.cc_servers = self.crawl_catalog.ids
+            else:
+                self.cc_servers = await self.source.list_crawls()
+        return self
+
+    async def aclose(self) -> ZipNumAggregator:
+        await self.source.__aexit__(None, None, None)
+        return self
+
+    class ZipNumAggregatorIterator(AsyncIterator[DomainRecord]):
+        def __init__(
+            self,
+            source: IByteRangeSource,
+            urls: List[str],
+            cc_servers: List[str],
+            match_type: MatchType,
+            since: Optional[datetime],
+            to: Optional[datetime],
+            limit: int | None,
+            prefetch_size: int,
+            max_range_size: int,
+            crawl_catalog: Optional[CrawlCatalog] = None,
+            record_filter: Optional[RecordFilter] = None,
+            collapse: Optional[CollapseMode] = None,
+        ):
+            self.__source = source
+            self.__urls = urls
+            self.__match_type = match_type
+            self.__since = since
+            self.__to = to
+            self.__limit = limit
+            self.__max_range_size = max_range_size
+            self.__crawl_catalog = crawl_catalog
+            self.__record_filter = record_filter
+            # Don't prefetch if limit is set to avoid overfetching
+            self.__prefetch_size = prefetch_size if limit is None else 1
+            self.__total = 0
+            self.__crawls_remaining = self.init_crawls_queue(
+                order_crawls(cc_servers, collapse)
+            )
+            self.__collapser: Optional[RecordCollapser[DomainRecord]] = (
+                RecordCollapser(collapse) if collapse is not None else None
+            )
+            self.__domain_records: Deque[DomainRecord] = deque()
+            self.__prefetch_queue: Deque[
+                asyncio.Task[Tuple[str, List[DomainRecord]]]
+            ] = deque()
+            self.__block_ranges = self.__iter_block_ranges()
+            self.__block_ranges_exhausted = False
+
+        def init_crawls_queue(self, cc_servers: List[str]) -> List[str]:
+            return [
+                crawl_url_to_name(crawl)
+                for crawl in cc_servers
+                if crawl_in_date_range(
+                    crawl, self.__since, self.__to, self.__crawl_catalog
+                )
+            ]
+
+        async def __iter_block_ranges(self) -> AsyncIterator[BlockRange]:
+            """
+            Looks up the blocks of every crawl and url, lazily as they are needed.
+            """
+            for crawl in self.__crawls_remaining:
+                cluster_index = ClusterIndex(self.__source, crawl)
+                for url in self.__urls:
+                    key_range = surt_range(url, self.__match_type)
+                    try:
+                        blocks = await cluster_index.find_blocks(*key_range)
+                    except Exception as e:
+                        all_purpose_logger.error(
+                            f"Failed to search cluster index of {crawl} for {url} with reason {e}"
+                        )
+                        continue
+
+                    all_purpose_logger.info(
+                        f"Found {len(blocks)} blocks for {url} in {crawl}"
+                    )
+                    for block_range in merge_blocks(blocks, self.__max_range_size):
+                        yield crawl, key_range, block_range
+
+        async def __fetch_block_range(
+            self, block_range: BlockRange
+        ) -> Tuple[str, List[DomainRecord]]:
+            crawl, key_range, (filename, offset, length) = block_range
+            data = await self.__source.read(
+                crawl_index_path(crawl, filename), offset, length
+            )
+            # Decompression and parsing is cpu bound, don't block the event loop
+            return crawl, await asyncio.to_thread(
+                decode_blocks,
+                data,
+                key_range,
+                self.__since,
+                self.__to,
+                self.__record_filter,
+            )
+
+        async def __prefetch_next_block_ranges(self):
+            while (
+                not self.__block_ranges_exhausted
+                and len(self.__prefetch_queue) < self.__prefetch_size
+            ):
+                try:
+                    block_range = await self.__block_ranges.__anext__()
+                except StopAsyncIteration:
+                    self.__block_ranges_exhausted = True
+                    break
+                self.__prefetch_queue.append(
+                    asyncio.create_task(self.__fetch_block_range(block_range))
+                )
+
+        async def __await_next_prefetch(self):
+            """
+            Waits for the oldest block range, so that records keep the index order
+            """
+            await self.__prefetch_next_block_ranges()
+            if len(self.__prefetch_queue) == 0:
+                return
+
+            task = self.__prefetch_queue.popleft()
+            try:
+                crawl, domain_records = await task
+            except Exception as e:
+                all_purpose_logger.error(f"Failed to read index blocks {str(e)}")
+                return
+
+            if self.__collapser is not None:
+                domain_records = self.__collapser.collapse_records(
+                    domain_records, crawl
+                )
+            self.__domain_records.extend(domain_records)
+
+        async def __anext__(self) -> DomainRecord:
+            # Stop if we fetched everything or reached limit
+            if self.__limit is not None and self.__total >= self.__limit:
+                self.clean()
+                raise StopAsyncIteration
+
+            while len(self.__domain_records) == 0:
+                await self.__await_next_prefetch()
+                if (
+                    len(self.__domain_records) == 0
+                    and len(self.__prefetch_queue) == 0
+                    and self.__block_ranges_exhausted
+                ):
+                    if self.__collapser is not None:
+                        self.__domain_records.extend(self.__collapser.flush())
+                    if len(self.__domain_records) == 0:
+                        # No more data to fetch
+                        raise StopAsyncIteration
+
+            self.__total += 1
+            return self.__domain_records.popleft()
+
+        def clean(self):
+            for task in self.__prefetch_queue:
+                task.cancel()
+
+    def __aiter__(self) -> AsyncIterator[DomainRecord]:
+        if not self.cc_servers:
+            raise ValueError("cc_servers must be initialized before iterating")
+        return ZipNumAggregator.ZipNumAggregatorIterator(
+            source=self.source,
+            urls=self.urls,
+            cc_servers=self.cc_servers,
+            match_type=self.match_type,
+            since=self.since,
+            to=self.to,
+            limit=self.limit,
+            prefetch_size=self.prefetch_size,
+            max_range_size=self.max_range_size,
+            crawl_catalog=self.crawl_catalog,
+            record_filter=self.record_filter,
+            collapse=self.collapse,
+        )
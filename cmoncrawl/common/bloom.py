@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import math
+import os
+from pathlib import Path
+from typing import Iterator, List
+
+from cmoncrawl.common.loggers import all_purpose_logger
+
+BLOOM_FILE_VERSION = 1
+TMP_SUFFIX = ".tmp"
+
+
+class BloomSlice:
+    """
+    Fixed size Bloom filter, sized for `capacity` keys at `error_rate` false positives.
+
+    Args:
+        capacity (int): Number of keys the filter is sized for.
+        error_rate (float): False positive rate at full capacity.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = BloomSlice.num_bits_for(capacity, error_rate)
+        self.num_hashes = max(1, math.ceil(-math.log2(error_rate)))
+        self.count = 0
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    @staticmethod
+    def num_bits_for(capacity: int, error_rate: float) -> int:
+        """
+        Optimal number of bits for the `capacity` and `error_rate`
+        """
+        return max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+
+    def __positions(self, key: str) -> Iterator[int]:
+        # Double hashing, k positions from two 64 bit hashes
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.__positions(key)
+        )
+
+    def add(self, key: str):
+        for pos in self.__positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+
+class ScalableBloomFilter:
+    """
+    Set of strings with bounded memory and a configurable false positive rate,
+    membership tests can return false positives, but never false negatives.
+
+    It's a scalable Bloom filter: once the current slice is full, a new one
+    `growth` times larger with `tightening` times lower error rate is added,
+    so the compound false positive rate stays below `error_rate`.
+    If the next slice would exceed `max_bytes`, the oldest slices are dropped,
+    so the filter forgets the oldest keys instead of raising the false positive rate.
+
+    The filter can be persisted with `save` and restored with `load`.
+
+    Args:
+        initial_capacity (int, optional): Number of keys of the first slice. Defaults to 100_000.
+        error_rate (float, optional): Upper bound of the false positive rate. Defaults to 0.001.
+        max_bytes (int, optional): Memory budget of the bit arrays. Defaults to None (unbounded).
+        growth (int, optional): Capacity multiplier of each next slice. Defaults to 2.
+        tightening (float, optional): Error rate multiplier of each next slice. Defaults to 0.5.
+    """
+
+    def __init__(
+        self,
+        initial_capacity: int = 100_000,
+        error_rate: float = 0.001,
+        max_bytes: int | None = None,
+        growth: int = 2,
+        tightening: float = 0.5,
+    ):
+        if initial_capacity < 1:
+            raise ValueError("initial_capacity must be at least 1")
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        if not 0 < tightening < 1:
+            raise ValueError("tightening must be between 0 and 1")
+
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.max_bytes = max_bytes
+        self.growth = growth
+        self.tightening = tightening
+        self.slices: List[BloomSlice] = []
+        self.__budget_reached = False
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Size of all bit arrays in bytes
+        """
+        return sum(len(s.bits) for s in self.slices)
+
+    def __len__(self) -> int:
+        return sum(s.count for s in self.slices)
+
+    def __contains__(self, key: str) -> bool:
+        return any(key in s for s in self.slices)
+
+    def __add_slice(self):
+        if len(self.slices) == 0:
+            capacity = self.initial_capacity
+            # The series of slice error rates sums up to error_rate
+            error_rate = self.error_rate * (1 - self.tightening)
+        else:
+            capacity = self.slices[-1].capacity * self.growth
+            error_rate = self.slices[-1].error_rate * self.tightening
+
+        if self.max_bytes is not None:
+            size = (BloomSlice.num_bits_for(capacity, error_rate) + 7) // 8
+            if len(self.slices) > 0 and self.nbytes + size > self.max_bytes:
+                # Once the budget is reached, the slices are a ring, the oldest one
+                # is replaced by a slice of the same capacity and error rate,
+                # so the compound error rate and the size stay the same
+                dropped = self.slices.pop(0)
+                capacity, error_rate = dropped.capacity, dropped.error_rate
+                if not self.__budget_reached:
+                    all_purpose_logger.warning(
+                        "Bloom filter reached memory budget, the oldest keys are going to be forgotten"
+                    )
+                self.__budget_reached = True
+                all_purpose_logger.debug(
+                    f"Bloom filter forgot {dropped.count} oldest keys"
+                )
+            elif size > self.max_bytes:
+                # Largest slice fitting the budget
+                capacity = max(
+                    1,
+                    int(self.max_bytes * 8 * math.log(2) ** 2 / -math.log(error_rate)),
+                )
+
+        self.slices.append(BloomSlice(capacity, error_rate))
+
+    def add(self, key: str) -> bool:
+        """
+        Adds the key, returns True if it was (probably) already present.
+        """
+        if key in self:
+            return True
+        if len(self.slices) == 0 or self.slices[-1].full():
+            self.__add_slice()
+        self.slices[-1].add(key)
+        return False
+
+    def save(self, path: Path):
+        """
+        Atomically writes the filter to the `path`
+        """
+        header = {
+            "version": BLOOM_FILE_VERSION,
+            "initial_capacity": self.initial_capacity,
+            "error_rate": self.error_rate,
+            "max_bytes": self.max_bytes,
+            "growth": self.growth,
+            "tightening": self.tightening,
+            "slices": [
+                {"capacity": s.capacity, "error_rate": s.error_rate, "count": s.count}
+                for s in self.slices
+            ],
+        }
+        tmp_path = path.with_name(path.name + TMP_SUFFIX)
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            for s in self.slices:
+                f.write(s.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> ScalableBloomFilter:
+        """
+        Reads the filter written by `save`
+        """
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != BLOOM_FILE_VERSION:
+                raise ValueError(f"Unsupported bloom filter file {path}")
+            bloom = cls(
+                initial_capacity=header["initial_capacity"],
+                error_rate=header["error_rate"],
+                max_bytes=header["max_bytes"],
+                growth=header["growth"],
+                tightening=header["tightening"],
+            )
+            for slice_header in header["slices"]:
+                s = BloomSlice(slice_header["capacity"], slice_header["error_rate"])
+                s.count = slice_header["count"]
+                s.bits = bytearray(f.read(len(s.bits)))
+                bloom.slices.append(s)
+        return bloom
@@ -1,9 +1,27 @@
 import asyncio
+import multiprocessing
 import time
-from typing import Any, Callable, Coroutine, TypeVar
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Coroutine, Dict, Optional, TypeVar
 
 T = TypeVar("T")
 
+# Statuses signaling that the server is overloaded
+OVERLOAD_STATUSES = {429, 500, 502, 503, 504}
+_MISSING = object()
+
+
+def is_overload_error(e: BaseException) -> bool:
+    """
+    Returns True if the exception means that the server is overloaded:
+    a timeout, an error with overload status, or an error without status
+    (the connection failed before any response).
+    """
+    if isinstance(e, (TimeoutError, asyncio.TimeoutError)):
+        return True
+    status = getattr(e, "status", _MISSING)
+    return status is None or status in OVERLOAD_STATUSES
+
 
 class Throttler:
     """
@@ -18,6 +36,16 @@ class Throttler:
         self.last_call = 0
         self.semaphore = asyncio.Semaphore(1)
 
+    async def wait(self):
+        """
+        Waits until the next call is allowed.
+        """
+        async with self.semaphore:
+            elapsed = time.time() - self.last_call
+            if elapsed < self.milliseconds / 1000:
+                await asyncio.sleep((self.milliseconds / 1000) - elapsed)
+            self.last_call = time.time()
+
     async def throttle(
         self,
         func: Callable[..., Coroutine[Any, Any, T]],
@@ -35,9 +63,256 @@ class Throttler:
         Returns:
             T: The return type of the function.
         """
-        async with self.semaphore:
-            elapsed = time.time() - self.last_call
-            if elapsed < self.milliseconds / 1000:
-                await asyncio.sleep((self.milliseconds / 1000) - elapsed)
-            self.last_call = time.time()
+        await self.wait()
         return await func(*args, **kwargs)
+
+    @asynccontextmanager
+    async def throttle_stream(
+        self,
+        func: Callable[..., Coroutine[Any, Any, T]],
+        *args: Any,
+        **kwargs: Any,
+    ) -> AsyncIterator[T]:
+        """
+        Throttles the call opening a stream, e.g. a streamed response, and yields its result.
+        Unlike `throttle`, the call counts as in flight until the context is exited,
+        so that the stream is consumed within the in-flight cap.
+        """
+        yield await self.throttle(func, *args, **kwargs)
+
+    def for_host(self, host: str) -> "Throttler":
+        """
+        Returns the throttler to use for requests to the `host`.
+        By default all hosts share the same throttler.
+        """
+        return self
+
+
+class TokenBucketThrottler(Throttler):
+    """
+    Token bucket throttler, which allows short bursts of calls and caps the number of calls in flight.
+
+    The bucket holds at most `burst` tokens and is refilled at `requests_per_second`.
+    Every call takes a token, and waits only if there is none left, so unlike Throttler
+    the callers are not serialized while sleeping. Independently of the rate, at most
+    `max_in_flight` calls run at once, so that slow responses can't pile up.
+
+    Each host gets its own bucket and in-flight cap with the same settings, see `for_host`.
+
+    Args:
+        requests_per_second (float): Sustained rate of calls.
+        burst (int, optional): Max number of calls, which can start at once after idle period. Defaults to 1.
+        max_in_flight (int, optional): Max number of calls running at once. Defaults to None (unlimited).
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float,
+        burst: int = 1,
+        max_in_flight: Optional[int] = None,
+    ):
+        if requests_per_second <= 0:
+            raise ValueError("Rate must be greater than 0")
+        if burst < 1:
+            raise ValueError("burst must be at least 1")
+        if max_in_flight is not None and max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+
+        super().__init__(int(1000 / requests_per_second))
+        self.rate = requests_per_second
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.in_flight = (
+            asyncio.Semaphore(max_in_flight) if max_in_flight is not None else None
+        )
+        self.__hosts: Dict[str, TokenBucketThrottler] = {}
+
+    async def wait(self):
+        """
+        Takes a token, waiting until one is available.
+        """
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.last_refill) * self.rate
+        )
+        self.last_refill = now
+        # The token is reserved right away, so concurrent callers queue up behind it
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    async def throttle(
+        self,
+        func: Callable[..., Coroutine[Any, Any, T]],
+        *args: Any,
+        **kwargs: Any,
+    ) -> T:
+        if self.in_flight is None:
+            await self.wait()
+            return await func(*args, **kwargs)
+
+        async with self.in_flight:
+            await self.wait()
+            return await func(*args, **kwargs)
+
+    @asynccontextmanager
+    async def throttle_stream(
+        self,
+        func: Callable[..., Coroutine[Any, Any, T]],
+        *args: Any,
+        **kwargs: Any,
+    ) -> AsyncIterator[T]:
+        if self.in_flight is None:
+            await self.wait()
+            yield await func(*args, **kwargs)
+            return
+
+        async with self.in_flight:
+            await self.wait()
+            yield await func(*args, **kwargs)
+
+    def for_host(self, host: str) -> "TokenBucketThrottler":
+        if host not in self.__hosts:
+            self.__hosts[host] = TokenBucketThrottler(
+                self.rate, self.burst, self.max_in_flight
+            )
+        return self.__hosts[host]
+
+
+class SharedTokenBucketThrottler(TokenBucketThrottler):
+    """
+    Token bucket throttler, whose bucket lives in shared memory, so that multiple
+    processes draw from the same request budget and `requests_per_second` is a global cap.
+
+    The bucket is created once by the parent process with `new_bucket` and handed to
+    the worker processes on their creation (e.g. by Pool initializer), each of them then
+    creates its own throttler over it. The in-flight cap is per process.
+
+    Args:
+        requests_per_second (float): Sustained rate of calls over all processes.
+        bucket (Any): Shared bucket created by `new_bucket`.
+        burst (int, optional): Max number of calls, which can start at once after idle period. Must be same as for `new_bucket`. Defaults to 1.
+        max_in_flight (int, optional): Max number of calls running at once in this process. Defaults to None (unlimited).
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float,
+        bucket: Any,
+        burst: int = 1,
+        max_in_flight: Optional[int] = None,
+    ):
+        super().__init__(requests_per_second, burst, max_in_flight)
+        self.bucket = bucket
+
+    @staticmethod
+    def new_bucket(burst: int = 1) -> Any:
+        """
+        Creates a full shared bucket, holding the number of tokens and the time of the last refill.
+        """
+        return multiprocessing.Array("d", [float(burst), time.monotonic()])
+
+    async def wait(self):
+        with self.bucket.get_lock():
+            tokens, last_refill = self.bucket[0], self.bucket[1]
+            now = time.monotonic()
+            tokens = min(self.burst, tokens + (now - last_refill) * self.rate) - 1
+            self.bucket[0], self.bucket[1] = tokens, now
+        if tokens < 0:
+            await asyncio.sleep(-tokens / self.rate)
+
+    def for_host(self, host: str) -> "SharedTokenBucketThrottler":
+        # The budget is global, not per host
+        return self
+
+
+class AdaptiveThrottler(Throttler):
+    """
+    Throttler, which adapts the rate of calls to the health of the server (AIMD).
+
+    Every successful call increases the rate, so that it grows by about `increase`
+    requests per second each second. A call failing with an overload error
+    (5xx, 429, timeout, connection error) multiplies the rate by `decrease_factor`.
+    Failures of calls, which were in flight together, are counted as a single decrease,
+    by allowing at most one decrease per `cooldown` seconds.
+
+    A single instance can be shared by multiple clients, so that they all back off together.
+
+    Args:
+        requests_per_second (float): Initial rate.
+        min_requests_per_second (float, optional): Lowest allowed rate. Defaults to 0.5.
+        max_requests_per_second (float, optional): Highest allowed rate. Defaults to 4 * requests_per_second.
+        increase (float, optional): Additive increase of the rate per second of healthy responses. Defaults to 1.0.
+        decrease_factor (float, optional): Multiplicative decrease of the rate on overload. Defaults to 0.5.
+        cooldown (float, optional): Minimum number of seconds between two decreases. Defaults to 1.0.
+        is_overload (Callable[[BaseException], bool], optional): Decides which exceptions mean overload. Defaults to is_overload_error.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: float,
+        min_requests_per_second: float = 0.5,
+        max_requests_per_second: Optional[float] = None,
+        increase: float = 1.0,
+        decrease_factor: float = 0.5,
+        cooldown: float = 1.0,
+        is_overload: Callable[[BaseException], bool] = is_overload_error,
+    ):
+        if requests_per_second <= 0 or min_requests_per_second <= 0:
+            raise ValueError("Rate must be greater than 0")
+        if not 0 < decrease_factor < 1:
+            raise ValueError("decrease_factor must be between 0 and 1")
+
+        self.min_rate = min_requests_per_second
+        self.max_rate = (
+            max_requests_per_second
+            if max_requests_per_second is not None
+            else 4 * requests_per_second
+        )
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.is_overload = is_overload
+        self.last_decrease = 0.0
+        self.__rate = min(max(requests_per_second, self.min_rate), self.max_rate)
+        super().__init__(int(1000 / self.__rate))
+
+    @property
+    def rate(self) -> float:
+        """
+        Current number of allowed requests per second
+        """
+        return self.__rate
+
+    def __set_rate(self, rate: float):
+        self.__rate = min(max(rate, self.min_rate), self.max_rate)
+        self.milliseconds = 1000 / self.__rate
+
+    def record_success(self):
+        # Called about `rate` times per second, so the rate grows by `increase` per second
+        self.__set_rate(self.__rate + self.increase / self.__rate)
+
+    def record_overload(self):
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self.__set_rate(self.__rate * self.decrease_factor)
+
+    async def throttle(
+        self,
+        func: Callable[..., Coroutine[Any, Any, T]],
+        *args: Any,
+        **kwargs: Any,
+    ) -> T:
+        await self.wait()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            if self.is_overload(e):
+                self.record_overload()
+            raise
+        self.record_success()
+        return result
@@ -1,8 +1,12 @@
+from __future__ import annotations
+
+import re
+from array import array
 from dataclasses import dataclass, field
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import Enum
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 from urllib.parse import urlparse
 
 from pydantic import BaseModel, Field, validator
@@ -38,6 +42,258 @@ class DomainRecord(BaseModel):
     def parse_timestamp(cls, v: Optional[str]) -> Optional[datetime]:
         return parse_timestamp(v)
 
+    @classmethod
+    def construct_trusted(
+        cls,
+        filename: str,
+        url: str | None,
+        offset: int,
+        length: int,
+        digest: str | None = None,
+        encoding: str | None = None,
+        timestamp: Optional[datetime] = None,
+    ) -> DomainRecord:
+        """
+        Creates the record without validation, for sources which already
+        provide correct types (cdx server, Athena, parquet), e.g. timestamp must be a datetime.
+        """
+        return cls.model_construct(
+            filename=filename,
+            url=url,
+            offset=offset,
+            length=length,
+            digest=digest,
+            encoding=encoding,
+            timestamp=timestamp,
+        )
+
+
+EPOCH = datetime(1970, 1, 1)
+NO_TIMESTAMP = -(2**63)
+
+
+def datetime_to_micros(timestamp: Optional[datetime]) -> int:
+    if timestamp is None:
+        return NO_TIMESTAMP
+    return (timestamp.replace(tzinfo=None) - EPOCH) // timedelta(microseconds=1)
+
+
+def micros_to_datetime(micros: int) -> Optional[datetime]:
+    if micros == NO_TIMESTAMP:
+        return None
+    return EPOCH + timedelta(microseconds=micros)
+
+
+class InternTable:
+    """
+    Stores every distinct value once, values are referenced by their id.
+    """
+
+    __slots__ = ("values", "_ids")
+
+    def __init__(self):
+        self.values: List[Optional[str]] = []
+        self._ids: Dict[Optional[str], int] = {}
+
+    def intern(self, value: Optional[str]) -> int:
+        value_id = self._ids.get(value)
+        if value_id is None:
+            value_id = len(self.values)
+            self._ids[value] = value_id
+            self.values.append(value)
+        return value_id
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class DomainRecordView:
+    """
+    Read-only view of a single record of DomainRecordBatch.
+    Has the same attributes as DomainRecord, but doesn't copy any data.
+    """
+
+    __slots__ = ("batch", "index")
+
+    def __init__(self, batch: DomainRecordBatch, index: int):
+        self.batch = batch
+        self.index = index
+
+    @property
+    def filename(self) -> str:
+        return self.batch.filenames.values[self.batch.filename_ids[self.index]]  # type: ignore
+
+    @property
+    def url(self) -> str | None:
+        return self.batch.urls.values[self.batch.url_ids[self.index]]
+
+    @property
+    def offset(self) -> int:
+        return self.batch.offsets[self.index]
+
+    @property
+    def length(self) -> int:
+        return self.batch.lengths[self.index]
+
+    @property
+    def digest(self) -> str | None:
+        return self.batch.digests[self.index]
+
+    @property
+    def encoding(self) -> str | None:
+        return self.batch.encodings.values[self.batch.encoding_ids[self.index]]
+
+    @property
+    def timestamp(self) -> Optional[datetime]:
+        return micros_to_datetime(self.batch.timestamps[self.index])
+
+    def to_domain_record(self) -> DomainRecord:
+        return DomainRecord.construct_trusted(
+            filename=self.filename,
+            url=self.url,
+            offset=self.offset,
+            length=self.length,
+            digest=self.digest,
+            encoding=self.encoding,
+            timestamp=self.timestamp,
+        )
+
+    def __repr__(self) -> str:
+        return f"DomainRecordView({self.to_domain_record()!r})"
+
+
+class DomainRecordBatch:
+    """
+    Columnar batch of domain records.
+
+    Offsets, lengths and timestamps (microseconds since epoch) are kept in
+    parallel arrays, filenames, urls and encodings in intern tables, so that
+    a record costs a few machine words instead of a pydantic model.
+    Records are accessed either as DomainRecordView (`batch[i]`, iteration)
+    or materialized with `domain_records()`.
+    """
+
+    def __init__(self):
+        self.offsets = array("q")
+        self.lengths = array("q")
+        self.timestamps = array("q")
+        self.filenames = InternTable()
+        self.filename_ids = array("L")
+        self.urls = InternTable()
+        self.url_ids = array("L")
+        self.encodings = InternTable()
+        self.encoding_ids = array("L")
+        self.digests: List[Optional[str]] = []
+
+    @classmethod
+    def from_domain_records(
+        cls, domain_records: Iterable[DomainRecord]
+    ) -> DomainRecordBatch:
+        batch = cls()
+        for domain_record in domain_records:
+            batch.append_record(domain_record)
+        return batch
+
+    @classmethod
+    def from_columns(
+        cls,
+        filenames: List[str],
+        urls: List[str | None],
+        offsets: Iterable[int],
+        lengths: Iterable[int],
+        digests: Optional[List[str | None]] = None,
+        encodings: Optional[List[str | None]] = None,
+        timestamps: Optional[Iterable[int]] = None,
+    ) -> DomainRecordBatch:
+        """
+        Creates the batch from whole columns, timestamps are in microseconds since epoch
+        (NO_TIMESTAMP for missing ones).
+        """
+        batch = cls()
+        batch.filename_ids.extend(batch.filenames.intern(f) for f in filenames)
+        batch.url_ids.extend(batch.urls.intern(url) for url in urls)
+        batch.offsets.extend(offsets)
+        batch.lengths.extend(lengths)
+        size = len(batch.offsets)
+        batch.digests = list(digests) if digests is not None else [None] * size
+        batch.encoding_ids.extend(
+            batch.encodings.intern(encoding) for encoding in encodings or [None] * size
+        )
+        batch.timestamps.extend(
+            timestamps if timestamps is not None else [NO_TIMESTAMP] * size
+        )
+        if not (
+            len(batch.filename_ids)
+            == len(batch.url_ids)
+            == len(batch.lengths)
+            == len(batch.digests)
+            == len(batch.encoding_ids)
+            == len(batch.timestamps)
+            == size
+        ):
+            raise ValueError("All columns must have the same length")
+        return batch
+
+    def append(
+        self,
+        filename: str,
+        url: str | None,
+        offset: int,
+        length: int,
+        digest: str | None = None,
+        encoding: str | None = None,
+        timestamp: Optional[datetime] = None,
+    ):
+        self.filename_ids.append(self.filenames.intern(filename))
+        self.url_ids.append(self.urls.intern(url))
+        self.encoding_ids.append(self.encodings.intern(encoding))
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.timestamps.append(datetime_to_micros(timestamp))
+        self.digests.append(digest)
+
+    def append_record(self, domain_record: DomainRecord):
+        self.append(
+            filename=domain_record.filename,
+            url=domain_record.url,
+            offset=domain_record.offset,
+            length=domain_record.length,
+            digest=domain_record.digest,
+            encoding=domain_record.encoding,
+            timestamp=domain_record.timestamp,
+        )
+
+    def truncate(self, size: int):
+        """
+        Keeps only the first `size` records
+        """
+        for column in (
+            self.offsets,
+            self.lengths,
+            self.timestamps,
+            self.filename_ids,
+            self.url_ids,
+            self.encoding_ids,
+            self.digests,
+        ):
+            del column[size:]
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, index: int) -> DomainRecordView:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("DomainRecordBatch index out of range")
+        return DomainRecordView(self, index)
+
+    def __iter__(self) -> Iterator[DomainRecordView]:
+        return (DomainRecordView(self, i) for i in range(len(self)))
+
+    def domain_records(self) -> Iterator[DomainRecord]:
+        return (view.to_domain_record() for view in self)
+
 
 @dataclass
 class PipeMetadata:
@@ -101,6 +357,50 @@ class DomainCrawl:
     page: int = 0
 
 
+@dataclass
+class RecordFilter:
+    """
+    Predicate on the index records, which aggregators translate to their native form
+    (CDX filter params, SQL conditions), so that the discarded records never leave the index
+    and their WARC records are never downloaded.
+
+    All of the set conditions must hold, a list condition holds if any of its values matches.
+
+    Args:
+        statuses (List[int], optional): HTTP statuses of the capture. Defaults to None.
+        mimes (List[str], optional): Detected MIME types e.g. "text/html". Defaults to None.
+        languages (List[str], optional): Detected languages as ISO 639-3 codes e.g. "ces", record matches if it has any of them. Defaults to None.
+        url_regex (str, optional): Regex, which must match anywhere in the url. Defaults to None.
+        digests (List[str], optional): Content digests. Defaults to None.
+    """
+
+    statuses: Optional[List[int]] = None
+    mimes: Optional[List[str]] = None
+    languages: Optional[List[str]] = None
+    url_regex: Optional[str] = None
+    digests: Optional[List[str]] = None
+
+    def matches(self, js: Dict[str, Any]) -> bool:
+        """
+        Evaluates the filter on a raw cdx json object
+        """
+        if self.statuses is not None and int(js.get("status", 0)) not in self.statuses:
+            return False
+        if self.mimes is not None and js.get("mime-detected") not in self.mimes:
+            return False
+        if self.languages is not None:
+            record_languages = js.get("languages", "").split(",")
+            if not any(language in record_languages for language in self.languages):
+                return False
+        if self.url_regex is not None and not re.search(
+            self.url_regex, js.get("url", "")
+        ):
+            return False
+        if self.digests is not None and js.get("digest") not in self.digests:
+            return False
+        return True
+
+
 # ===============================================================================
 # Extractor config
 
@@ -159,3 +459,20 @@ class MatchType(Enum):
 
     def __str__(self):
         return self.value
+
+
+class CollapseMode(Enum):
+    """
+    Which captures of the same url are kept by the aggregators.
+
+    FIRST: only the oldest capture of the url
+    LATEST: only the newest capture of the url
+    PER_CRAWL: only the first capture of the url in each crawl
+    """
+
+    FIRST = "first"
+    LATEST = "latest"
+    PER_CRAWL = "per_crawl"
+
+    def __str__(self):
+        return self.value
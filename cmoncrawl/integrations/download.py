@@ -6,10 +6,19 @@ from pathlib import Path
 from typing import Any, List
 
 from cmoncrawl.aggregator.athena_query import AthenaAggregator
+from cmoncrawl.aggregator.base import IAggregator
 from cmoncrawl.aggregator.gateway_query import GatewayAggregator
-from cmoncrawl.common.types import MatchType
+from cmoncrawl.aggregator.row_store_query import RowStoreAggregator
+from cmoncrawl.aggregator.utils.cdx_cache import CDXResponseCache
+from cmoncrawl.aggregator.utils.checkpoint import AggregationCheckpoint
+from cmoncrawl.aggregator.utils.row_store import CDXRowStore
+from cmoncrawl.aggregator.utils.zipnum import LocalByteRangeSource
+from cmoncrawl.aggregator.zipnum_query import ZipNumAggregator
+from cmoncrawl.common.bloom import ScalableBloomFilter
+from cmoncrawl.common.throttling import Throttler
+from cmoncrawl.common.types import CollapseMode, MatchType, RecordFilter
 from cmoncrawl.config import CONFIG
-from cmoncrawl.integrations.utils import DAOname, get_dao
+from cmoncrawl.integrations.utils import DAOname, get_dao, get_throttler
 from cmoncrawl.middleware.synchronized import query_and_extract
 from cmoncrawl.processor.dao.base import ICC_Dao
 from cmoncrawl.processor.pipeline.downloader import (
@@ -39,6 +48,9 @@ class DownloadOutputFormat(Enum):
 class Aggregator(Enum):
     ATHENA = "athena"
     GATEWAY = "gateway"
+    ZIPNUM = "zipnum"
+    DUCKDB = "duckdb"
+    LOCAL = "local"
 
     def __str__(self):
         return self.value
@@ -124,6 +136,24 @@ def add_args(subparser: Any):
         default=10,
         help="Max number of requests per second",
     )
+    parser.add_argument(
+        "--adaptive_rate",
+        action="store_true",
+        default=False,
+        help="Adapt the request rate to the responses of Common Crawl servers, up to max_requests_per_second. The rate is lowered on 5xx responses and timeouts and slowly raised while the responses are healthy",
+    )
+    parser.add_argument(
+        "--burst",
+        type=int,
+        default=1,
+        help="Max number of requests, which can be sent at once above max_requests_per_second after an idle period",
+    )
+    parser.add_argument(
+        "--max_in_flight",
+        type=int,
+        default=None,
+        help="Max number of concurrent requests per host",
+    )
     # Add option to output to either json or html
     parser.add_argument(
         "--match_type",
@@ -142,13 +172,46 @@ def add_args(subparser: Any):
         "--filter_non_200",
         action="store_true",
         default=True,
-        help="Filter out non 200 status code",
+        help="Filter out non 200 status code (default)",
+    )
+    parser.add_argument(
+        "--no_filter_non_200",
+        dest="filter_non_200",
+        action="store_false",
+        help="Keep records with non 200 status code",
+    )
+    parser.add_argument(
+        "--mime",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Only records with one of the detected MIME types e.g. text/html, filtered in the index",
+    )
+    parser.add_argument(
+        "--language",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Only records with one of the detected languages as ISO 639-3 codes e.g. ces, filtered in the index",
+    )
+    parser.add_argument(
+        "--url_regex",
+        type=str,
+        default=None,
+        help="Only records whose url matches the regex, filtered in the index",
+    )
+    parser.add_argument(
+        "--collapse",
+        type=CollapseMode,
+        choices=list(CollapseMode),
+        default=None,
+        help="Keep only the first or the latest capture of every url, or the first capture of every url in each crawl, so that the same page is not downloaded multiple times",
     )
     parser.add_argument(
         "--aggregator",
         type=Aggregator,
         choices=list(Aggregator),
-        help="Athena is fast, but cost a few dollars, Gateway is incredibly slow, but free",
+        help="Athena is fast, but cost a few dollars, Gateway is incredibly slow, but free, Zipnum reads the index files directly from S3 or a local mirror, DuckDB queries the columnar index locally, Local answers from the row store filled by previous Gateway runs",
         default=Aggregator.GATEWAY,
     )
     parser.add_argument(
@@ -157,6 +220,84 @@ def add_args(subparser: Any):
         default=None,
         help="S3 bucket to use for Athena. If set, the query results will be stored in the bucket and reused for later queries. Make sure to delete the bucket afterwards.",
     )
+    parser.add_argument(
+        "--athena_unload",
+        action="store_true",
+        default=False,
+        help="Write the Athena query results as parquet files with UNLOAD and stream them from S3, instead of downloading the whole CSV. Requires pyarrow",
+    )
+    parser.add_argument(
+        "--athena_materialize_subset",
+        action="store_true",
+        default=False,
+        help="Copy the captures of the urls to a small table in the S3 bucket first and run the Athena queries against it. Re-runs with the same urls and bucket reuse the table",
+    )
+    parser.add_argument(
+        "--athena_split_queries",
+        type=int,
+        default=1,
+        help="Split every Athena query into up to this many queries over SURT key ranges of the urls, which run in parallel. Useful for huge DOMAIN matches",
+    )
+    parser.add_argument(
+        "--cdx_cache_dir",
+        type=Path,
+        default=None,
+        help="Directory for caching Common Crawl index responses of Gateway aggregator, re-runs and overlapping queries will be answered from it",
+    )
+    parser.add_argument(
+        "--cdx_cache_size",
+        type=int,
+        default=1024,
+        help="Max size of the index responses cache in MB, least recently used responses are evicted first",
+    )
+    parser.add_argument(
+        "--cdx_page_size",
+        type=int,
+        default=None,
+        help="Number of index blocks per page of Gateway aggregator, larger pages need fewer requests",
+    )
+    parser.add_argument(
+        "--zipnum_path",
+        type=Path,
+        default=None,
+        help="Local mirror of cc-index/collections for Zipnum aggregator, if not set the index is read from the commoncrawl S3 bucket",
+    )
+    parser.add_argument(
+        "--columnar_index_path",
+        type=str,
+        default=None,
+        help="Local directory or s3:// url of the columnar index (cc-index/table/cc-main/warc) for DuckDB aggregator, if not set the commoncrawl S3 bucket is used",
+    )
+    parser.add_argument(
+        "--state_file",
+        type=Path,
+        default=None,
+        help="File to checkpoint the progress of Gateway or Athena aggregator to, re-running with the same file resumes at the first unfinished index page",
+    )
+    parser.add_argument(
+        "--row_store",
+        type=Path,
+        default=None,
+        help="SQLite file, which Gateway aggregator stores the fetched index rows to and Local aggregator answers the queries from",
+    )
+    parser.add_argument(
+        "--dedup_file",
+        type=Path,
+        default=None,
+        help="File with content digests of the processed records, records with an already processed digest are skipped before download. Created if it doesn't exist, updated after the run",
+    )
+    parser.add_argument(
+        "--dedup_error_rate",
+        type=float,
+        default=0.001,
+        help="Max rate of records wrongly skipped as duplicates, used when creating the dedup file",
+    )
+    parser.add_argument(
+        "--dedup_max_memory",
+        type=int,
+        default=256,
+        help="Max size of the dedup file in MB, used when creating it, the oldest digests are forgotten once it's reached",
+    )
     mode_subparser = parser.add_subparsers(
         dest="mode", required=True, help="Download mode"
     )
@@ -208,6 +349,7 @@ def get_download_downloader(
     sleep_base: float,
     max_requests_per_second: int,
     dao: ICC_Dao | None,
+    throttler: Throttler | None = None,
 ):
     match output_format:
         case DownloadOutputFormat.HTML:
@@ -219,6 +361,7 @@ def get_download_downloader(
                 sleep_base=sleep_base,
                 dao=dao,
                 max_requests_per_second=max_requests_per_second,
+                throttler=throttler,
             )
         case DownloadOutputFormat.RECORD:
             return DummyDownloader()
@@ -236,7 +379,20 @@ def get_aggregator(
     sleep_base: float,
     max_requests_per_second: int,
     s3_bucket: str | None,
-) -> GatewayAggregator | AthenaAggregator:
+    cdx_cache_dir: Path | None = None,
+    cdx_cache_size: int = 1024,
+    zipnum_path: Path | None = None,
+    columnar_index_path: str | None = None,
+    throttler: Throttler | None = None,
+    state_file: Path | None = None,
+    cdx_page_size: int | None = None,
+    record_filter: RecordFilter | None = None,
+    collapse: CollapseMode | None = None,
+    row_store: Path | None = None,
+    athena_unload: bool = False,
+    athena_materialize_subset: bool = False,
+    athena_split_queries: int = 1,
+) -> IAggregator:
     if len(urls) == 0:
         raise ValueError("At least one URL must be specified")
     if limit <= 0:
@@ -245,6 +401,29 @@ def get_aggregator(
         raise ValueError("'max_retry' must be greater than 0")
     if sleep_base <= 0:
         raise ValueError("'sleep_base' must be greater than 0")
+    if state_file is not None and aggregator not in (
+        Aggregator.GATEWAY,
+        Aggregator.ATHENA,
+    ):
+        raise ValueError(
+            "State file can be specified only for Gateway and Athena aggregators"
+        )
+    checkpoint = AggregationCheckpoint(state_file) if state_file is not None else None
+    if row_store is not None and aggregator not in (
+        Aggregator.GATEWAY,
+        Aggregator.LOCAL,
+    ):
+        raise ValueError(
+            "Row store can be specified only for Gateway and Local aggregators"
+        )
+    if athena_unload and aggregator != Aggregator.ATHENA:
+        raise ValueError("Unload can be specified only for Athena aggregator")
+    if athena_materialize_subset and aggregator != Aggregator.ATHENA:
+        raise ValueError(
+            "Subset materialization can be specified only for Athena aggregator"
+        )
+    if athena_split_queries != 1 and aggregator != Aggregator.ATHENA:
+        raise ValueError("Query splitting can be specified only for Athena aggregator")
 
     match aggregator:
         case Aggregator.GATEWAY:
@@ -253,6 +432,11 @@ def get_aggregator(
                     "S3 bucket can be specified only for Athena aggregator"
                 )
 
+            cdx_cache = (
+                CDXResponseCache(cdx_cache_dir, max_size=cdx_cache_size * 1024 * 1024)
+                if cdx_cache_dir is not None
+                else None
+            )
             return GatewayAggregator(
                 cc_servers=cc_servers,
                 urls=urls,
@@ -263,6 +447,13 @@ def get_aggregator(
                 max_retry=max_retry,
                 sleep_base=sleep_base,
                 max_requests_per_second=max_requests_per_second,
+                cdx_cache=cdx_cache,
+                throttler=throttler,
+                checkpoint=checkpoint,
+                page_size=cdx_page_size,
+                record_filter=record_filter,
+                collapse=collapse,
+                row_store=CDXRowStore(row_store) if row_store is not None else None,
             )
         case Aggregator.ATHENA:
             return AthenaAggregator(
@@ -276,9 +467,85 @@ def get_aggregator(
                 sleep_base=sleep_base,
                 bucket_name=s3_bucket,
                 aws_profile=CONFIG.AWS_PROFILE,
+                checkpoint=checkpoint,
+                record_filter=record_filter,
+                collapse=collapse,
+                unload=athena_unload,
+                materialize_subset=athena_materialize_subset,
+                split_queries=athena_split_queries,
+            )
+        case Aggregator.ZIPNUM:
+            if s3_bucket is not None:
+                raise ValueError(
+                    "S3 bucket can be specified only for Athena aggregator"
+                )
+
+            return ZipNumAggregator(
+                cc_servers=cc_servers,
+                urls=urls,
+                match_type=match_type,
+                since=since,
+                to=to,
+                limit=limit,
+                source=LocalByteRangeSource(zipnum_path)
+                if zipnum_path is not None
+                else None,
+                aws_profile=CONFIG.AWS_PROFILE,
+                record_filter=record_filter,
+                collapse=collapse,
+            )
+        case Aggregator.DUCKDB:
+            if s3_bucket is not None:
+                raise ValueError(
+                    "S3 bucket can be specified only for Athena aggregator"
+                )
+            # Optional dependency, only needed for this aggregator
+            from cmoncrawl.aggregator.duckdb_query import (
+                CC_INDEX_TABLE_PATH,
+                DuckDBAggregator,
+            )
+
+            return DuckDBAggregator(
+                cc_servers=cc_servers,
+                urls=urls,
+                match_type=match_type,
+                since=since,
+                to=to,
+                limit=limit,
+                index_path=columnar_index_path or CC_INDEX_TABLE_PATH,
+                aws_profile=CONFIG.AWS_PROFILE,
+                record_filter=record_filter,
+                collapse=collapse,
+            )
+        case Aggregator.LOCAL:
+            if row_store is None:
+                raise ValueError("Row store must be specified for Local aggregator")
+
+            return RowStoreAggregator(
+                cc_servers=cc_servers,
+                urls=urls,
+                store_path=row_store,
+                match_type=match_type,
+                since=since,
+                to=to,
+                limit=limit,
+                record_filter=record_filter,
+                collapse=collapse,
             )
 
 
+def get_digest_filter(
+    dedup_file: Path | None, error_rate: float, max_memory: int
+) -> ScalableBloomFilter | None:
+    if dedup_file is None:
+        return None
+    if dedup_file.exists():
+        return ScalableBloomFilter.load(dedup_file)
+    return ScalableBloomFilter(
+        error_rate=error_rate, max_bytes=max_memory * 1024 * 1024
+    )
+
+
 async def url_download(
     urls: list[str],
     match_type: MatchType,
@@ -298,12 +565,36 @@ async def url_download(
     download_method: DAOname | None,
     aggregator_type: Aggregator,
     s3_bucket: str | None,
+    cdx_cache_dir: Path | None = None,
+    cdx_cache_size: int = 1024,
+    zipnum_path: Path | None = None,
+    columnar_index_path: str | None = None,
+    adaptive_rate: bool = False,
+    burst: int = 1,
+    max_in_flight: int | None = None,
+    state_file: Path | None = None,
+    cdx_page_size: int | None = None,
+    mimes: List[str] | None = None,
+    languages: List[str] | None = None,
+    url_regex: str | None = None,
+    collapse: CollapseMode | None = None,
+    dedup_file: Path | None = None,
+    dedup_error_rate: float = 0.001,
+    dedup_max_memory: int = 256,
+    row_store: Path | None = None,
+    athena_unload: bool = False,
+    athena_materialize_subset: bool = False,
+    athena_split_queries: int = 1,
 ):
     outstreamer = url_download_prepare_streamer(
         mode, output, max_directory_size, max_crawls_per_file
     )
     router = url_download_prepare_router(mode, filter_non_200, encoding)
     dao = get_dao(download_method)
+    # Shared, so that the index queries and downloads back off together
+    throttler = get_throttler(
+        max_requests_per_second, adaptive_rate, burst, max_in_flight
+    )
     aggregator = get_aggregator(
         aggregator_type,
         cc_server,
@@ -316,20 +607,43 @@ async def url_download(
         sleep_base,
         max_requests_per_second,
         s3_bucket,
+        cdx_cache_dir,
+        cdx_cache_size,
+        zipnum_path,
+        columnar_index_path,
+        throttler,
+        state_file,
+        cdx_page_size,
+        # Records, which would be filtered after download, are filtered in the index
+        RecordFilter(
+            statuses=[200] if filter_non_200 else None,
+            mimes=mimes,
+            languages=languages,
+            url_regex=url_regex,
+        ),
+        collapse,
+        row_store,
+        athena_unload,
+        athena_materialize_subset,
+        athena_split_queries,
     )
 
+    digest_filter = get_digest_filter(dedup_file, dedup_error_rate, dedup_max_memory)
+
     try:
         if dao is not None:
             await dao.__aenter__()
 
         downloader = get_download_downloader(
-            mode, max_retry, sleep_base, max_requests_per_second, dao
+            mode, max_retry, sleep_base, max_requests_per_second, dao, throttler
         )
         pipeline = ProcessorPipeline(router, downloader, outstreamer)
-        await query_and_extract(aggregator, pipeline)
+        await query_and_extract(aggregator, pipeline, digest_filter=digest_filter)
     finally:
         if dao is not None:
             await dao.__aexit__(None, None, None)
+        if dedup_file is not None and digest_filter is not None:
+            digest_filter.save(dedup_file)
 
 
 def run_download(args: argparse.Namespace):
@@ -363,5 +677,25 @@ def run_download(args: argparse.Namespace):
             filter_non_200=args.filter_non_200,
             download_method=download_method,
             s3_bucket=args.s3_bucket,
+            cdx_cache_dir=args.cdx_cache_dir,
+            cdx_cache_size=args.cdx_cache_size,
+            zipnum_path=args.zipnum_path,
+            columnar_index_path=args.columnar_index_path,
+            adaptive_rate=args.adaptive_rate,
+            burst=args.burst,
+            max_in_flight=args.max_in_flight,
+            state_file=args.state_file,
+            cdx_page_size=args.cdx_page_size,
+            mimes=args.mime,
+            languages=args.language,
+            url_regex=args.url_regex,
+            collapse=args.collapse,
+            dedup_file=args.dedup_file,
+            dedup_error_rate=args.dedup_error_rate,
+            dedup_max_memory=args.dedup_max_memory,
+            row_store=args.row_store,
+            athena_unload=args.athena_unload,
+            athena_materialize_subset=args.athena_materialize_subset,
+            athena_split_queries=args.athena_split_queries,
         )
     )
@@ -9,10 +9,11 @@ from typing import Any, Dict, List, Tuple
 
 from tqdm import tqdm
 
-from cmoncrawl.common.loggers import setup_loggers
+from cmoncrawl.common.loggers import all_purpose_logger, setup_loggers
+from cmoncrawl.common.throttling import SharedTokenBucketThrottler, Throttler
 from cmoncrawl.common.types import DomainRecord, ExtractConfig
 from cmoncrawl.config import CONFIG
-from cmoncrawl.integrations.utils import DAOname, get_dao
+from cmoncrawl.integrations.utils import DAOname, get_dao, get_throttler
 from cmoncrawl.middleware.synchronized import extract
 from cmoncrawl.processor.dao.base import ICC_Dao
 from cmoncrawl.processor.pipeline.downloader import (
@@ -45,7 +46,25 @@ def add_mode_args(subparser: Any):
         "--max_requests_per_second",
         type=int,
         default=10,
-        help="Max number of requests per second",
+        help="Max number of requests per second, shared by all processes",
+    )
+    record_parser.add_argument(
+        "--adaptive_rate",
+        action="store_true",
+        default=False,
+        help="Adapt the request rate to the responses of Common Crawl servers, up to max_requests_per_second",
+    )
+    record_parser.add_argument(
+        "--burst",
+        type=int,
+        default=1,
+        help="Max number of requests, which can be sent at once above max_requests_per_second after an idle period",
+    )
+    record_parser.add_argument(
+        "--max_in_flight",
+        type=int,
+        default=None,
+        help="Max number of concurrent requests per host",
     )
     record_parser.add_argument(
         "--download_method",
@@ -128,6 +147,10 @@ def get_extract_downloader(
     max_requests_per_second: int,
     sleep_base: float,
     dao: ICC_Dao | None,
+    adaptive_rate: bool = False,
+    burst: int = 1,
+    max_in_flight: int | None = None,
+    throttler: Throttler | None = None,
 ):
     match mode:
         case ExtractMode.HTML:
@@ -141,6 +164,13 @@ def get_extract_downloader(
                 sleep_base=sleep_base,
                 dao=dao,
                 max_requests_per_second=max_requests_per_second,
+                throttler=(
+                    throttler
+                    if throttler is not None
+                    else get_throttler(
+                        max_requests_per_second, adaptive_rate, burst, max_in_flight
+                    )
+                ),
             )
 
 
@@ -179,7 +209,7 @@ def load_config(config_path: Path) -> ExtractConfig:
             config = json.load(f)
     except Exception as e:
         raise ValueError(
-            f"Failed to load extractor config. Ensure it's valid JSON."
+            "Failed to load extractor config. Ensure it's valid JSON."
         ) from e
     return ExtractConfig.model_validate(config)
 
@@ -204,6 +234,10 @@ async def extract_from_files(
     max_requests_per_second: int,
     sleep_base: float,
     download_method: DAOname | None,
+    adaptive_rate: bool = False,
+    burst: int = 1,
+    max_in_flight: int | None = None,
+    throttler: Throttler | None = None,
 ):
     router = create_router(config)
     outstreamer = StreamerFileJSON(output_path, max_directory_size, max_crawls_per_file)
@@ -212,7 +246,18 @@ async def extract_from_files(
         if dao is not None:
             await dao.__aenter__()
         downloader = get_extract_downloader(
-            mode, files, url, date, max_retry, max_requests_per_second, sleep_base, dao
+            mode,
+            files,
+            url,
+            date,
+            max_retry,
+            max_requests_per_second,
+            sleep_base,
+            dao,
+            adaptive_rate,
+            burst,
+            max_in_flight,
+            throttler,
         )
         pipeline = ProcessorPipeline(router, downloader, outstreamer)
         for path in files:
@@ -227,6 +272,15 @@ async def extract_from_files(
             await dao.__aexit__(None, None, None)
 
 
+# Request budget shared by all worker processes, set by _init_worker
+_shared_bucket: Any = None
+
+
+def _init_worker(shared_bucket: Any):
+    global _shared_bucket
+    _shared_bucket = shared_bucket
+
+
 def _extract_task(
     output_path: Path,
     config: ExtractConfig,
@@ -252,6 +306,14 @@ def _extract_task(
     download_method = (
         DAOname(args.download_method) if mode == ExtractMode.RECORD else None
     )
+    adaptive_rate = args.adaptive_rate if mode == ExtractMode.RECORD else False
+    burst = args.burst if mode == ExtractMode.RECORD else 1
+    max_in_flight = args.max_in_flight if mode == ExtractMode.RECORD else None
+    throttler = None
+    if _shared_bucket is not None:
+        throttler = SharedTokenBucketThrottler(
+            max_requests_per_second, _shared_bucket, burst, max_in_flight
+        )
 
     asyncio.run(
         extract_from_files(
@@ -267,13 +329,27 @@ def _extract_task(
             max_requests_per_second=max_requests_per_second,
             sleep_base=sleep_base,
             download_method=download_method,
+            adaptive_rate=adaptive_rate,
+            burst=burst,
+            max_in_flight=max_in_flight,
+            throttler=throttler,
         )
     )
 
 
 def run_extract(args: argparse.Namespace):
     config = load_config(args.config_path)
-    pool = multiprocessing.Pool(args.n_proc)
+    shared_bucket = None
+    if ExtractMode(args.mode) == ExtractMode.RECORD and args.n_proc != 1:
+        # Processes share the budget, so that max_requests_per_second is a global cap
+        if args.adaptive_rate:
+            all_purpose_logger.warning(
+                "Adaptive rate is not supported with multiple processes, using shared fixed rate"
+            )
+        shared_bucket = SharedTokenBucketThrottler.new_bucket(args.burst)
+    pool = multiprocessing.Pool(
+        args.n_proc, initializer=_init_worker, initargs=(shared_bucket,)
+    )
     pool.starmap(
         _extract_task,
         [
@@ -1,5 +1,6 @@
 from enum import Enum
 
+from cmoncrawl.common.throttling import AdaptiveThrottler, TokenBucketThrottler
 from cmoncrawl.config import CONFIG
 from cmoncrawl.processor.dao.api import CCAPIGatewayDAO
 from cmoncrawl.processor.dao.s3 import S3Dao
@@ -21,3 +22,27 @@ def get_dao(download_method: DAOname | None):
             return CCAPIGatewayDAO()
         case None:
             return None
+
+
+def get_throttler(
+    max_requests_per_second: int,
+    adaptive_rate: bool,
+    burst: int = 1,
+    max_in_flight: int | None = None,
+):
+    """
+    With adaptive rate, returns a throttler, which starts at half of max_requests_per_second
+    and adapts to the server responses up to max_requests_per_second.
+    With burst or max_in_flight, returns a per host token bucket throttler.
+    Otherwise returns None, letting every component use its own fixed rate throttler.
+    """
+    if adaptive_rate:
+        return AdaptiveThrottler(
+            max_requests_per_second / 2,
+            max_requests_per_second=max_requests_per_second,
+        )
+    if burst > 1 or max_in_flight is not None:
+        return TokenBucketThrottler(
+            max_requests_per_second, burst=burst, max_in_flight=max_in_flight
+        )
+    return None
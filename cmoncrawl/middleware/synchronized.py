@@ -6,6 +6,7 @@ from tqdm import tqdm
 
 from cmoncrawl.aggregator.base import IAggregator
 from cmoncrawl.aggregator.utils.helpers import unify_url_id
+from cmoncrawl.common.bloom import ScalableBloomFilter
 from cmoncrawl.common.loggers import all_purpose_logger, metadata_logger
 from cmoncrawl.common.types import DomainRecord
 from cmoncrawl.processor.pipeline.pipeline import ProcessorPipeline
@@ -15,6 +16,7 @@ async def query_and_extract(
     index_agg: IAggregator,
     pipeline: ProcessorPipeline,
     filter_non_unique_url: bool = False,
+    digest_filter: ScalableBloomFilter | None = None,
 ):
     """
     Query the index and extracts the results using the pipeline
@@ -25,20 +27,31 @@ async def query_and_extract(
         filter_non_unique_url (bool, optional): Filter non unique urls.
             if True, only first successful extraction of a url will be processed,
             the rest will be skipped. Defaults to False.
+        digest_filter (ScalableBloomFilter, optional): Digests of already processed records.
+            Records with a digest in the filter are skipped before download, as their
+            content was already processed, digests of processed records are added to it.
+            Defaults to None.
 
     """
     processed_urls: Set[str] = set()
     total_extracted: int = 0
+    total_duplicates: int = 0
 
     async with index_agg:
         async for domain_record in index_agg:
             url = domain_record.url or ""
             if filter_non_unique_url and unify_url_id(url) in processed_urls:
                 continue
+            digest = domain_record.digest
+            if digest_filter is not None and digest and digest in digest_filter:
+                total_duplicates += 1
+                continue
             try:
                 await pipeline.process_domain_record(domain_record, {})
                 total_extracted += 1
                 processed_urls.add(unify_url_id(url))
+                if digest_filter is not None and digest:
+                    digest_filter.add(digest)
             except KeyboardInterrupt:
                 break
 
@@ -47,6 +60,10 @@ async def query_and_extract(
                     f"Failed to process {domain_record.url} with {e}"
                 )
     all_purpose_logger.info(f"Extracted {total_extracted} urls")
+    if digest_filter is not None:
+        all_purpose_logger.info(
+            f"Skipped {total_duplicates} records with already processed content"
+        )
     return processed_urls
 
 
@@ -1,4 +1,5 @@
-from typing import Any
+from typing import Any, Optional
+from urllib.parse import urlparse
 
 from aiohttp import (
     ClientError,
@@ -7,6 +8,7 @@ from aiohttp import (
     ServerConnectionError,
 )
 
+from cmoncrawl.common.throttling import Throttler
 from cmoncrawl.common.types import DomainRecord
 from cmoncrawl.processor.dao.base import DownloadError, ICC_Dao
 
@@ -22,6 +24,7 @@ class CCAPIGatewayDAO(ICC_Dao):
 
     Args:
         base_url (str): The base URL of the Common Crawl API Gateway. Defaults to "https://data.commoncrawl.org/".
+        throttler (Throttler, optional): Throttler for the requests. Leave it unset when the DAO is used by AsyncDownloader, which already throttles the fetches. Defaults to None.
 
     Methods:
         aopen: Asynchronously opens a connection to the API Gateway.
@@ -34,8 +37,9 @@ class CCAPIGatewayDAO(ICC_Dao):
         >>>     data = await dao.fetch(domain_record)
     """
 
-    def __init__(self, base_url: str = BASE_URL):
+    def __init__(self, base_url: str = BASE_URL, throttler: Optional[Throttler] = None):
         self.BASE_URL = base_url
+        self.throttler = throttler
 
     async def aopen(self) -> "CCAPIGatewayDAO":
         self.client: ClientSession = ClientSession()
@@ -51,7 +55,17 @@ class CCAPIGatewayDAO(ICC_Dao):
     async def __aexit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
         await self.aclose()
 
+    @property
+    def host(self) -> str:
+        return urlparse(self.BASE_URL).netloc
+
     async def fetch(self, domain_record: DomainRecord) -> bytes:
+        if self.throttler is not None:
+            throttler = self.throttler.for_host(self.host)
+            return await throttler.throttle(self.__fetch, domain_record)
+        return await self.__fetch(domain_record)
+
+    async def __fetch(self, domain_record: DomainRecord) -> bytes:
         headers = {
             "Range": "bytes={}-{}".format(
                 domain_record.offset,
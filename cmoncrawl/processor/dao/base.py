@@ -13,6 +13,13 @@ class ICC_Dao(AsyncContextManager):
 
     """
 
+    @property
+    def host(self) -> str:
+        """
+        Host the data is fetched from, the fetches are throttled per host.
+        """
+        return ""
+
     async def fetch(self, domain_record: DomainRecord) -> bytes:
         raise NotImplementedError
 
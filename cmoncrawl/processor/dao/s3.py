@@ -62,6 +62,10 @@ class S3Dao(ICC_Dao):
         if self.client is not None:
             await self.client.__aexit__(exc_type, exc, tb)  # type: ignore
 
+    @property
+    def host(self) -> str:
+        return f"{self.bucket_name}.s3.amazonaws.com"
+
     async def fetch(self, domain_record: DomainRecord) -> bytes:
         """
         Downloads a warc file from commoncrawl bucket using s3 and returns its bytes.
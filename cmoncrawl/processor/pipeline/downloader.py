@@ -75,6 +75,7 @@ class AsyncDownloader(IDownloader):
         sleep_base (float, optional): Base sleep time for exponential backoff in retries. Defaults to 1.5.
         max_requests_per_second (int, optional): Maximum number of requests per second. Defaults to 20.
         encoding: Default encoding to be used
+        throttler (Throttler, optional): Throttler for the downloads, e.g. AdaptiveThrottler shared with the aggregator. Defaults to Throttler with max_requests_per_second.
     """
 
     def __init__(
@@ -85,6 +86,7 @@ class AsyncDownloader(IDownloader):
         sleep_base: float = 1.3,
         max_requests_per_second: int = 20,
         encoding: str = "latin-1",
+        throttler: Optional[Throttler] = None,
     ):
         if max_requests_per_second > 500:
             logging.warning(
@@ -94,7 +96,11 @@ class AsyncDownloader(IDownloader):
         self.download_client = dao
         self.__max_retry = max_retry
         self.__sleep_base = sleep_base
-        self.throttler = Throttler(int(1000 / max_requests_per_second))
+        self.throttler = (
+            throttler
+            if throttler is not None
+            else Throttler(int(1000 / max_requests_per_second))
+        )
         self.encoding = encoding
 
     async def download(self, domain_record: DomainRecord | None):
@@ -113,7 +119,8 @@ class AsyncDownloader(IDownloader):
             before_sleep=log_after_retry,
         )
         async def download_throttled(domain_record: DomainRecord):
-            warc_bytes: bytes = await self.throttler.throttle(
+            throttler = self.throttler.for_host(self.download_client.host)
+            warc_bytes: bytes = await throttler.throttle(
                 self.download_client.fetch, domain_record
             )
             return self.unwrap(warc_bytes, domain_record)
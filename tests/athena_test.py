@@ -1,15 +1,22 @@
+import asyncio
+import io
+import tempfile
 import textwrap
 import unittest
 from datetime import datetime
+from pathlib import Path
 from typing import List
-from unittest.mock import patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import aioboto3
 import boto3
+from botocore.exceptions import ClientError
 from moto import mock_athena, mock_s3
 
 from cmoncrawl.aggregator.athena_query import (
     QUERIES_SUBFOLDER,
+    SUBSET_TABLES_SUBFOLDER,
+    UNLOADED_SUBFOLDER,
     AthenaAggregator,
     DomainRecord,
     MatchType,
@@ -18,11 +25,35 @@ from cmoncrawl.aggregator.utils.athena_query_maker import (
     crawl_query,
     date_to_sql_format,
     prepare_athena_sql_query,
+    prepare_athena_subset_query,
+    record_filter_conditions,
+    split_url_key_ranges,
+    unload_query,
+    url_key_ranges,
     url_query_based_on_match_type,
     url_query_date_range,
+    url_table_columns,
+    url_table_rows,
 )
+from cmoncrawl.aggregator.utils.checkpoint import AggregationCheckpoint
+from cmoncrawl.aggregator.utils.crawl_catalog import CrawlCatalog, CrawlInfo
+from cmoncrawl.aggregator.utils.surt import url_to_surt
+from cmoncrawl.common.types import CollapseMode, DomainRecordBatch, RecordFilter
 from tests.utils import MotoMock, MySQLRecordsDB
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    from cmoncrawl.aggregator.utils.parquet_stream import iter_s3_parquet_row_groups
+except ImportError:
+    pa = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
 
 class TestAthenaQueryCreation(unittest.IsolatedAsyncioTestCase, MotoMock):
     def setUp(self) -> None:
@@ -54,6 +85,7 @@ class TestAthenaQueryCreation(unittest.IsolatedAsyncioTestCase, MotoMock):
                 """\
             SELECT cc.url,
                     cc.fetch_time,
+                    cc.content_digest,
                     cc.warc_filename,
                     cc.warc_record_offset,
                     cc.warc_record_length
@@ -62,6 +94,185 @@ class TestAthenaQueryCreation(unittest.IsolatedAsyncioTestCase, MotoMock):
             ),
         )
 
+    def test_prepare_athena_sql_query_collapse(self):
+        query = prepare_athena_sql_query(
+            ["seznam.cz"],
+            None,
+            None,
+            self.CC_SERVERS[:1],
+            match_type=MatchType.EXACT,
+            database="commoncrawl",
+            table="ccindex",
+            collapse=CollapseMode.LATEST,
+        )
+        self.assertEqual(
+            query,
+            textwrap.dedent(
+                """\
+            SELECT url, fetch_time, content_digest, warc_filename, warc_record_offset, warc_record_length
+            FROM (
+            SELECT cc.url,
+            cc.fetch_time,
+            cc.content_digest,
+            cc.warc_filename,
+            cc.warc_record_offset,
+            cc.warc_record_length,
+            ROW_NUMBER() OVER (PARTITION BY cc.url_surtkey ORDER BY cc.fetch_time DESC) AS collapse_rank
+            FROM "commoncrawl"."ccindex" AS cc
+            WHERE (cc.crawl = 'CC-MAIN-2022-05') AND (cc.fetch_status = 200) AND (cc.subset = 'warc') AND ((cc.url = 'seznam.cz'))
+            )
+            WHERE collapse_rank = 1;"""
+            ),
+        )
+        query = prepare_athena_sql_query(
+            ["seznam.cz"],
+            None,
+            None,
+            self.CC_SERVERS[:1],
+            match_type=MatchType.EXACT,
+            database="commoncrawl",
+            table="ccindex",
+            collapse=CollapseMode.PER_CRAWL,
+        )
+        self.assertIn(
+            "PARTITION BY cc.url_surtkey, cc.crawl ORDER BY cc.fetch_time ASC", query
+        )
+
+    def test_prepare_athena_sql_query_url_table(self):
+        query = prepare_athena_sql_query(
+            ["seznam.cz", "idnes.cz"],
+            None,
+            None,
+            self.CC_SERVERS[:1],
+            match_type=MatchType.DOMAIN,
+            database="commoncrawl",
+            table="ccindex",
+            url_table="ccindex_urls_0123",
+        )
+        self.assertEqual(
+            query,
+            textwrap.dedent(
+                """\
+            SELECT cc.url,
+                    cc.fetch_time,
+                    cc.content_digest,
+                    cc.warc_filename,
+                    cc.warc_record_offset,
+                    cc.warc_record_length
+            FROM "commoncrawl"."ccindex" AS cc
+            JOIN "commoncrawl"."ccindex_urls_0123" AS u
+            ON cc.url_surtkey >= u.key_start AND cc.url_surtkey < u.key_end
+            WHERE (cc.crawl = 'CC-MAIN-2022-05') AND (cc.fetch_status = 200) AND (cc.subset = 'warc') AND (cc.url_surtkey >= 'cz,idnes)' AND cc.url_surtkey < 'cz,seznam-');"""
+            ),
+        )
+
+    @unittest.skipIf(duckdb is None, "duckdb is not installed")
+    def test_url_table_exact_match(self):
+        # Runs the queries on an in-memory copy of the index
+        connection = duckdb.connect()
+        connection.execute("CREATE SCHEMA commoncrawl")
+        connection.execute(
+            "CREATE TABLE commoncrawl.ccindex (url VARCHAR, url_surtkey VARCHAR, crawl VARCHAR, "
+            "subset VARCHAR, fetch_status INTEGER, fetch_time TIMESTAMP, content_digest VARCHAR, "
+            "warc_filename VARCHAR, warc_record_offset INTEGER, warc_record_length INTEGER)"
+        )
+        index_urls = [
+            "https://seznam.cz/",
+            "http://seznam.cz/",
+            "https://www.seznam.cz/",
+            "https://seznam.cz/a",
+            "https://idnes.cz/",
+        ]
+        for i, url in enumerate(index_urls):
+            connection.execute(
+                "INSERT INTO commoncrawl.ccindex VALUES "
+                "(?, ?, 'CC-MAIN-2022-05', 'warc', 200, '2022-01-01', 'DIGEST', 'f', ?, 100)",
+                [url, url_to_surt(url), i],
+            )
+        urls = ["https://seznam.cz/", "https://idnes.cz/"]
+        columns = ", ".join(
+            f"{column} VARCHAR" for column in url_table_columns(MatchType.EXACT)
+        )
+        connection.execute(f"CREATE TABLE commoncrawl.ccindex_urls ({columns})")
+        connection.executemany(
+            "INSERT INTO commoncrawl.ccindex_urls VALUES (?)",
+            url_table_rows(urls, MatchType.EXACT),
+        )
+
+        results = [
+            sorted(
+                row[0]
+                for row in connection.execute(
+                    prepare_athena_sql_query(
+                        urls,
+                        None,
+                        None,
+                        self.CC_SERVERS[:1],
+                        database="commoncrawl",
+                        table="ccindex",
+                        match_type=MatchType.EXACT,
+                        url_table=url_table,
+                    )
+                ).fetchall()
+            )
+            for url_table in [None, "ccindex_urls"]
+        ]
+        self.assertEqual(results[0], sorted(urls))
+        self.assertEqual(results[1], results[0])
+
+    def test_prepare_athena_subset_query(self):
+        query = prepare_athena_subset_query(
+            ["seznam.cz"],
+            self.CC_SERVERS[:2],
+            "commoncrawl",
+            "ccindex",
+            MatchType.DOMAIN,
+        )
+        self.assertEqual(
+            query,
+            'SELECT cc.*\nFROM "commoncrawl"."ccindex" AS cc\n'
+            "WHERE (cc.crawl = 'CC-MAIN-2022-05' OR cc.crawl = 'CC-MAIN-2021-09') AND (cc.subset = 'warc') "
+            "AND ((cc.url_host_name LIKE '%.seznam.cz' OR cc.url_host_name = 'seznam.cz'))",
+        )
+
+    def test_url_key_ranges(self):
+        self.assertEqual(
+            url_key_ranges(
+                ["https://www.seznam.cz/a", "seznam.cz/", "idnes.cz"], MatchType.PREFIX
+            ),
+            [("cz,idnes)/", "cz,idnes)0"), ("cz,seznam)/", "cz,seznam)0")],
+        )
+        self.assertEqual(
+            url_key_ranges(["seznam.cz/a", "seznam.cz/a"], MatchType.EXACT),
+            [("cz,seznam)/a", "cz,seznam)/a ")],
+        )
+
+    def test_split_url_key_ranges(self):
+        # The domain itself and its subdomains by the first character
+        self.assertEqual(
+            split_url_key_ranges(["seznam.cz"], MatchType.DOMAIN, 3),
+            [
+                ("cz,seznam)", "cz,seznam,"),
+                ("cz,seznam,", "cz,seznam,i"),
+                ("cz,seznam,i", "cz,seznam-"),
+            ],
+        )
+        self.assertEqual(
+            split_url_key_ranges(["seznam.cz"], MatchType.HOST, 2),
+            [("cz,seznam)", "cz,seznam)/i"), ("cz,seznam)/i", "cz,seznam*")],
+        )
+        # Exact urls can't be split, many urls are grouped
+        self.assertEqual(
+            split_url_key_ranges(["seznam.cz/a"], MatchType.EXACT, 4),
+            [("cz,seznam)/a", "cz,seznam)/a ")],
+        )
+        self.assertEqual(
+            split_url_key_ranges(
+                ["seznam.cz/a", "seznam.cz/b", "idnes.cz/a"], MatchType.EXACT, 2
+            ),
+            [("cz,idnes)/a", "cz,idnes)/a "), ("cz,seznam)/a", "cz,seznam)/b ")],
+        )
+
     def test_prefix_match_type(self):
         url = "arxiv.org/abs/1905.00075"
         for prefix in ["http://", "https://", "https://www.", "", "www."]:
@@ -147,6 +358,66 @@ class TestAthenaQueryCreation(unittest.IsolatedAsyncioTestCase, MotoMock):
         expected = "cc.crawl = 'CC-MAIN-2021-09'"
         self.assertEqual(crawl_query(self.CC_SERVERS, since, to), expected)
 
+    def test_crawl_query_with_catalog(self):
+        crawl_catalog = CrawlCatalog.from_collinfo(
+            [
+                {
+                    "id": "CC-MAIN-2022-05",
+                    "cdx-api": self.CC_SERVERS[0],
+                    "from": "2022-01-16T09:55:21",
+                    "to": "2022-01-29T18:33:30",
+                },
+                {
+                    "id": "CC-MAIN-2021-09",
+                    "cdx-api": self.CC_SERVERS[1],
+                    "from": "2021-02-24T11:05:19",
+                    "to": "2021-03-09T10:51:49",
+                },
+            ]
+        )
+        since = datetime(2021, 3, 1)
+        to = datetime(2021, 12, 31)
+        # CC-MAIN-2020-50 is not in the catalog, so it's filtered by year only
+        expected = "cc.crawl = 'CC-MAIN-2021-09'"
+        self.assertEqual(
+            crawl_query(self.CC_SERVERS, since, to, crawl_catalog), expected
+        )
+        # Same year, but outside of the capture window
+        self.assertEqual(
+            crawl_query(self.CC_SERVERS, datetime(2021, 6, 1), to, crawl_catalog),
+            "",
+        )
+
+    def test_record_filter_conditions(self):
+        record_filter = RecordFilter(
+            statuses=[200, 404],
+            mimes=["text/html"],
+            languages=["ces", "slk"],
+            url_regex="/article/",
+        )
+        self.assertEqual(
+            record_filter_conditions(record_filter),
+            [
+                "cc.fetch_status IN (200, 404)",
+                "cc.content_mime_detected IN ('text/html')",
+                "cc.content_languages LIKE '%ces%' OR cc.content_languages LIKE '%slk%'",
+                "regexp_like(cc.url, '/article/')",
+            ],
+        )
+        query = prepare_athena_sql_query(
+            ["seznam.cz"],
+            None,
+            None,
+            self.CC_SERVERS,
+            match_type=MatchType.EXACT,
+            database="commoncrawl",
+            table="ccindex",
+            record_filter=record_filter,
+        )
+        # Statuses of the filter replace the default 200 status
+        self.assertNotIn("cc.fetch_status = 200", query)
+        self.assertIn("(cc.fetch_status IN (200, 404))", query)
+
 
 class TestAthenaAggregator(unittest.IsolatedAsyncioTestCase, MotoMock):
     def setUp(self) -> None:  #         MotoMock.setUp(self)
@@ -167,12 +438,14 @@ class TestAthenaAggregator(unittest.IsolatedAsyncioTestCase, MotoMock):
             # Create a bucket called test-bucket
             await s3_client.create_bucket(Bucket="test-bucket")
         with patch(
-            "cmoncrawl.aggregator.athena_query.get_all_CC_indexes"
-        ) as mock_get_all_CC_indexes, patch(
+            "cmoncrawl.aggregator.athena_query.get_crawl_catalog"
+        ) as mock_get_crawl_catalog, patch(
             "cmoncrawl.aggregator.athena_query.AthenaAggregator._AthenaAggregator__commoncrawl_database_and_table_exists"
         ) as mock_commoncrawl_database_and_table_exists:
             mock_commoncrawl_database_and_table_exists.return_value = False
-            mock_get_all_CC_indexes.return_value = expected_CC_indexes
+            mock_get_crawl_catalog.return_value = CrawlCatalog(
+                [CrawlInfo("CC-MAIN-2022-05", expected_CC_indexes[0])]
+            )
             domains = ["test.com"]
             aggregator = AthenaAggregator(domains, bucket_name="test-bucket")
             # Create a bucket called test-bucket
@@ -183,8 +456,9 @@ class TestAthenaAggregator(unittest.IsolatedAsyncioTestCase, MotoMock):
         # were sent to Athena
         async with aggregator.aws_client.client("athena") as athena_client:
             queries = await athena_client.list_query_executions()
-            # We should have one query for db creation, table creation and one for repair
-            self.assertEqual(len(queries["QueryExecutionIds"]), 3)
+            # We should have one query for db creation and one for table creation,
+            # partitions are projected, so there is no repair
+            self.assertEqual(len(queries["QueryExecutionIds"]), 2)
 
         # Check that the s3 bucket is cleaned up
         async with aggregator.aws_client.client("s3") as s3_client:
@@ -210,15 +484,65 @@ class TestAthenaAggregator(unittest.IsolatedAsyncioTestCase, MotoMock):
             object_keys = [obj["Key"] for obj in objects.get("Contents", [])]
             self.assertIn("test-key", object_keys)
 
+    async def test_materialize_subset(self):
+        # More crawls than a single CTAS can write partitions for
+        crawls = [f"CC-MAIN-2000-{i:03d}" for i in range(150)]
+        async with aioboto3.Session().client("s3") as s3_client:
+            await s3_client.create_bucket(Bucket="test-bucket")
+        with patch(
+            "cmoncrawl.aggregator.athena_query.AthenaAggregator._AthenaAggregator__commoncrawl_database_and_table_exists"
+        ) as mock_commoncrawl_database_and_table_exists:
+            mock_commoncrawl_database_and_table_exists.return_value = False
+            aggregator = AthenaAggregator(
+                ["test.com"],
+                cc_servers=crawls,
+                bucket_name="test-bucket",
+                materialize_subset=True,
+            )
+            await aggregator.aopen()
+
+        self.assertIsNotNone(aggregator.subset_table)
+        self.assertTrue(aggregator.subset_table.startswith("ccindex_subset_"))
+        async with aggregator.aws_client.client("athena") as athena_client:
+            queries = await athena_client.list_query_executions()
+            query_strings = [
+                (
+                    await athena_client.get_query_execution(
+                        QueryExecutionId=query_execution_id
+                    )
+                )["QueryExecution"]["Query"]
+                for query_execution_id in queries["QueryExecutionIds"]
+            ]
+        # db, table, CTAS of the first 100 crawls and INSERT INTO of the rest
+        self.assertEqual(len(query_strings), 4)
+        ctas = [query for query in query_strings if query.startswith("CREATE TABLE")]
+        self.assertEqual(len(ctas), 1)
+        self.assertIn("partitioned_by = ARRAY['crawl', 'subset']", ctas[0])
+        self.assertIn(
+            f"s3://test-bucket/{SUBSET_TABLES_SUBFOLDER}/{aggregator.subset_table}/",
+            ctas[0],
+        )
+        self.assertEqual(
+            len([query for query in query_strings if query.startswith("INSERT INTO")]),
+            1,
+        )
+        # Queries run against the subset table
+        iterator = aggregator.__aiter__()
+        query, _ = iterator._AthenaAggregatorIterator__crawl_batch_query(crawls[:1])
+        self.assertIn(f'"commoncrawl"."{aggregator.subset_table}"', query)
+        await aggregator.aclose()
+
     async def test_athena_aggregator_lifecycle_new_bucket(self):
         expected_CC_indexes = ["https://index.commoncrawl.org/CC-MAIN-2022-05-index"]
         with patch(
-            "cmoncrawl.aggregator.athena_query.get_all_CC_indexes"
-        ) as mock_get_all_CC_indexes, patch(
+            "cmoncrawl.aggregator.athena_query.get_crawl_catalog"
+        ) as mock_get_crawl_catalog, patch(
             "cmoncrawl.aggregator.athena_query.AthenaAggregator._AthenaAggregator__commoncrawl_database_and_table_exists"
         ) as mock_commoncrawl_database_and_table_exists:
             mock_commoncrawl_database_and_table_exists.return_value = False
-            mock_get_all_CC_indexes.return_value = expected_CC_indexes
+            mock_get_crawl_catalog.return_value = CrawlCatalog(
+                [CrawlInfo("CC-MAIN-2022-05", expected_CC_indexes[0])]
+            )
             domains = ["test.com"]
             aggregator = AthenaAggregator(domains)
             # Create a bucket called test-bucket
@@ -238,8 +562,27 @@ class TestAthenaAggregator(unittest.IsolatedAsyncioTestCase, MotoMock):
         # were sent to Athena
         async with aggregator.aws_client.client("athena") as athena_client:
             queries = await athena_client.list_query_executions()
-            # We should have one query for db creation, table creation and one for repair
-            self.assertEqual(len(queries["QueryExecutionIds"]), 3)
+            # We should have one query for db creation and one for table creation,
+            # partitions are projected, so there is no repair
+            self.assertEqual(len(queries["QueryExecutionIds"]), 2)
+            query_strings = [
+                (
+                    await athena_client.get_query_execution(
+                        QueryExecutionId=query_execution_id
+                    )
+                )["QueryExecution"]["Query"]
+                for query_execution_id in queries["QueryExecutionIds"]
+            ]
+            create_table_query = next(
+                query for query in query_strings if "CREATE EXTERNAL TABLE" in query
+            )
+            self.assertIn(
+                "'projection.crawl.values' = 'CC-MAIN-2022-05'", create_table_query
+            )
+            self.assertIn(
+                "'storage.location.template' = 's3://commoncrawl/cc-index/table/cc-main/warc/crawl=${crawl}/subset=${subset}/'",
+                create_table_query,
+            )
 
         # Check that the s3 bucket is cleaned up
         async with aggregator.aws_client.client("s3") as s3_client:
@@ -504,3 +847,351 @@ class TestAthenaAggregatorIterator(
             records.append(record)
 
         self.assertEqual(len(records), 1)
+
+
+@unittest.skipIf(pa is None, "pyarrow is not installed")
+class TestAthenaUnload(unittest.IsolatedAsyncioTestCase, MotoMock):
+    bucket_name = "test-bucket"
+
+    def setUp(self) -> None:
+        MotoMock.setUp(self)
+        self.mock_s3 = mock_s3()
+        self.mock_s3.start()
+        self.aws_client = aioboto3.Session()
+        self.mock_athena_query = patch(
+            "cmoncrawl.aggregator.athena_query.AthenaAggregator.AthenaAggregatorIterator._AthenaAggregatorIterator__await_athena_query"
+        )
+        self.mock_await_athena_query = self.mock_athena_query.start()
+        self.mock_await_athena_query.side_effect = self.mocked_await_athena_query
+
+    async def asyncSetUp(self):
+        async with self.aws_client.client("s3") as s3_client:
+            await s3_client.create_bucket(Bucket=self.bucket_name)
+
+    def tearDown(self) -> None:
+        MotoMock.tearDown(self)
+        self.mock_s3.stop()
+        self.mock_athena_query.stop()
+
+    def parquet_file(self, crawl: str, rows: int) -> bytes:
+        table = pa.table(
+            {
+                "url": [f"https://seznam.cz/{i}" for i in range(rows)],
+                "fetch_time": pa.array(
+                    [datetime(2022, 1, 1, 0, 0, i) for i in range(rows)],
+                    pa.timestamp("ms"),
+                ),
+                "content_digest": [f"DIGEST{i}" for i in range(rows)],
+                "warc_filename": [f"crawl-data/{crawl}/warc-{i}" for i in range(rows)],
+                "warc_record_offset": pa.array(range(rows), pa.int32()),
+                "warc_record_length": pa.array([100] * rows, pa.int32()),
+            }
+        )
+        sink = io.BytesIO()
+        pq.write_table(table, sink, row_group_size=3)
+        return sink.getvalue()
+
+    async def mocked_await_athena_query(self, query: str, result_name: str) -> str:
+        # Two files per query, as Athena splits the UNLOAD output
+        s3 = boto3.client("s3")
+        locations = []
+        for part in range(2):
+            key = f"{UNLOADED_SUBFOLDER}/{result_name}/part-{part}.parquet"
+            s3.put_object(
+                Body=self.parquet_file(result_name[:15], 5),
+                Bucket=self.bucket_name,
+                Key=key,
+            )
+            locations.append(f"s3://{self.bucket_name}/{key}")
+        manifest_key = f"{QUERIES_SUBFOLDER}/{result_name}-manifest.csv"
+        s3.put_object(
+            Body="\n".join(locations) + "\n", Bucket=self.bucket_name, Key=manifest_key
+        )
+        return manifest_key
+
+    def iterator(self, cc_servers=None, match_type=MatchType.EXACT, **kwargs):
+        return AthenaAggregator.AthenaAggregatorIterator(
+            aws_client=self.aws_client,
+            urls=["seznam.cz"],
+            cc_servers=cc_servers or ["CC-MAIN-2022-05", "CC-MAIN-2021-05"],
+            since=None,
+            to=None,
+            match_type=match_type,
+            extra_sql_where_clause=None,
+            database_name="commoncrawl",
+            table_name="ccindex",
+            bucket_name=self.bucket_name,
+            prefetch_size=1,
+            sleep_base=1.2,
+            max_retry=1,
+            batch_size=1,
+            unload=True,
+            **kwargs,
+        )
+
+    def test_unload_query(self):
+        query = unload_query("SELECT 1;\n", "s3://bucket/unloaded/q/")
+        self.assertEqual(
+            query,
+            "UNLOAD (SELECT 1)\nTO 's3://bucket/unloaded/q/'\nWITH (format = 'PARQUET', compression = 'SNAPPY')",
+        )
+
+    async def test_row_groups(self):
+        s3 = boto3.client("s3")
+        s3.put_object(
+            Body=self.parquet_file("CC-MAIN-2022-05", 8),
+            Bucket=self.bucket_name,
+            Key="file.parquet",
+        )
+        async with self.aws_client.client("s3") as s3_client:
+            tables = [
+                table
+                async for table in iter_s3_parquet_row_groups(
+                    s3_client, self.bucket_name, "file.parquet", columns=["url"]
+                )
+            ]
+        self.assertEqual([table.num_rows for table in tables], [3, 3, 2])
+        self.assertEqual(tables[0].column_names, ["url"])
+        self.assertEqual(tables[2].column("url").to_pylist()[-1], "https://seznam.cz/7")
+
+    async def test_stream_records(self):
+        records = [record async for record in self.iterator(limit=None)]
+        # 2 crawls * 2 files * 5 rows
+        self.assertEqual(len(records), 20)
+        self.assertEqual(records[0].url, "https://seznam.cz/0")
+        self.assertEqual(records[4].timestamp, datetime(2022, 1, 1, 0, 0, 4))
+        self.assertEqual(records[4].digest, "DIGEST4")
+        self.assertEqual(self.mock_await_athena_query.call_count, 2)
+
+        # Manifests are cached
+        records = [record async for record in self.iterator(limit=7)]
+        self.assertEqual(len(records), 7)
+        self.assertEqual(self.mock_await_athena_query.call_count, 2)
+
+    async def test_concurrent_queries(self):
+        running = 0
+        max_running = 0
+        mocked_await_athena_query = self.mocked_await_athena_query
+
+        async def slow_athena_query(query: str, result_name: str) -> str:
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.05)
+            running -= 1
+            return await mocked_await_athena_query(query, result_name)
+
+        self.mock_await_athena_query.side_effect = slow_athena_query
+        crawls = [f"CC-MAIN-2022-{i:02d}" for i in range(6)]
+        records = [
+            record
+            async for record in self.iterator(
+                cc_servers=crawls, limit=None, max_concurrent_queries=3
+            )
+        ]
+        self.assertEqual(len(records), 60)
+        self.assertEqual(self.mock_await_athena_query.call_count, 6)
+        # All batches are dispatched at once, but only 3 run against Athena
+        self.assertEqual(max_running, 3)
+
+    async def test_split_queries(self):
+        records = [
+            record
+            async for record in self.iterator(
+                limit=None, match_type=MatchType.DOMAIN, split_queries=3
+            )
+        ]
+        # Every crawl is queried once per key range
+        self.assertEqual(len(records), 60)
+        self.assertEqual(self.mock_await_athena_query.call_count, 6)
+        queries = [call.args[0] for call in self.mock_await_athena_query.call_args_list]
+        self.assertEqual(len(set(queries)), 6)
+        for key_range in split_url_key_ranges(["seznam.cz"], MatchType.DOMAIN, 3):
+            condition = f"cc.url_surtkey >= '{key_range[0]}' AND cc.url_surtkey < '{key_range[1]}'"
+            self.assertEqual(sum(condition in query for query in queries), 2)
+
+    async def test_batches(self):
+        aggregator = AthenaAggregator(
+            ["seznam.cz"],
+            cc_servers=["CC-MAIN-2022-05", "CC-MAIN-2021-05"],
+            bucket_name=self.bucket_name,
+            batch_size=1,
+            limit=17,
+            unload=True,
+        )
+        aggregator.aws_clients = self.aws_client
+        with patch.object(DomainRecordBatch, "domain_records") as domain_records:
+            batches = [batch async for batch in aggregator.batches()]
+        # Row groups of 3 and 2 rows, the last one is cut by the limit
+        self.assertEqual([len(batch) for batch in batches], [3, 2, 3, 2, 3, 2, 2])
+        self.assertEqual(batches[0][1].url, "https://seznam.cz/1")
+        self.assertEqual(batches[1][1].timestamp, datetime(2022, 1, 1, 0, 0, 4))
+        # The records are never materialized
+        domain_records.assert_not_called()
+
+    async def test_failed_read_keeps_batch_unfinished(self):
+        mocked_await_athena_query = self.mocked_await_athena_query
+
+        async def broken_athena_query(query: str, result_name: str) -> str:
+            manifest_key = await mocked_await_athena_query(query, result_name)
+            if result_name.startswith("CC-MAIN-2022-05"):
+                # The second file of the result is corrupted
+                boto3.client("s3").put_object(
+                    Body=b"not a parquet file",
+                    Bucket=self.bucket_name,
+                    Key=f"{UNLOADED_SUBFOLDER}/{result_name}/part-1.parquet",
+                )
+            return manifest_key
+
+        self.mock_await_athena_query.side_effect = broken_athena_query
+        checkpoint = AggregationCheckpoint(
+            Path(tempfile.mkdtemp()) / "state.json", interval=0
+        )
+        records = [
+            record async for record in self.iterator(limit=None, checkpoint=checkpoint)
+        ]
+        # The records of the first file are yielded, the rest of the stream is lost
+        self.assertEqual(len(records), 15)
+        for call in self.mock_await_athena_query.call_args_list:
+            result_name = call.args[1]
+            self.assertEqual(
+                checkpoint.is_batch_done(result_name),
+                not result_name.startswith("CC-MAIN-2022-05"),
+            )
+
+
+class TestAthenaDirectResults(unittest.IsolatedAsyncioTestCase):
+    HEADER = [
+        "url",
+        "fetch_time",
+        "content_digest",
+        "warc_filename",
+        "warc_record_offset",
+        "warc_record_length",
+    ]
+    ROWS = [
+        ["https://seznam.cz/", "2022-01-01 00:00:00.000", "DIGEST0", "f0", "10", "100"],
+        [
+            "https://seznam.cz/a",
+            "2022-01-02 00:00:00.000",
+            "DIGEST1",
+            "f1",
+            "10",
+            "100",
+        ],
+    ]
+
+    def setUp(self) -> None:
+        self.athena = MagicMock()
+        self.s3 = MagicMock()
+        self.s3.exceptions.ClientError = ClientError
+        self.s3.head_object = AsyncMock(
+            side_effect=ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        )
+        self.s3.copy_object = AsyncMock()
+        self.s3.delete_object = AsyncMock()
+        self.s3.download_file = AsyncMock(side_effect=self.download_file)
+
+        pages = [self.page([self.HEADER, *self.ROWS[:1]]), self.page(self.ROWS[1:])]
+
+        async def paginate(**kwargs):
+            for page in pages:
+                yield page
+
+        self.athena.get_paginator.return_value.paginate = paginate
+        self.aws_client = MagicMock()
+        self.aws_client.region_name = "us-east-1"
+        self.aws_client.client.side_effect = self.client
+        self.mock_run_athena_query = patch(
+            "cmoncrawl.aggregator.athena_query.run_athena_query",
+            AsyncMock(return_value="query-id"),
+        )
+        self.mock_run_athena_query.start()
+
+    def tearDown(self) -> None:
+        self.mock_run_athena_query.stop()
+
+    def client(self, service: str, **kwargs):
+        context = MagicMock()
+        context.__aenter__ = AsyncMock(
+            return_value=self.athena if service == "athena" else self.s3
+        )
+        context.__aexit__ = AsyncMock(return_value=None)
+        return context
+
+    def page(self, rows):
+        return {
+            "ResultSet": {
+                "Rows": [
+                    {"Data": [{"VarCharValue": value} for value in row]} for row in rows
+                ],
+                "ResultSetMetadata": {
+                    "ColumnInfo": [{"Name": column} for column in self.HEADER]
+                },
+            }
+        }
+
+    async def download_file(self, bucket: str, key: str, filename: str):
+        with open(filename, "w") as f:
+            f.write("\n".join(",".join(row) for row in [self.HEADER, *self.ROWS]))
+
+    def statistics(self, output_rows: int):
+        self.athena.get_query_runtime_statistics = AsyncMock(
+            return_value={
+                "QueryRuntimeStatistics": {"Rows": {"OutputRows": output_rows}}
+            }
+        )
+
+    def iterator(self, **kwargs):
+        return AthenaAggregator.AthenaAggregatorIterator(
+            aws_client=self.aws_client,
+            urls=["seznam.cz"],
+            cc_servers=["CC-MAIN-2022-05"],
+            since=None,
+            to=None,
+            limit=None,
+            prefetch_size=1,
+            sleep_base=1.2,
+            max_retry=1,
+            batch_size=1,
+            match_type=MatchType.EXACT,
+            extra_sql_where_clause=None,
+            bucket_name="test-bucket",
+            database_name="commoncrawl",
+            table_name="ccindex",
+            max_direct_result_rows=100,
+            **kwargs,
+        )
+
+    async def records(self):
+        return [record async for record in self.iterator()]
+
+    async def test_small_result(self):
+        self.statistics(2)
+        records = await self.records()
+        self.assertEqual([record.url for record in records], [r[0] for r in self.ROWS])
+        self.assertEqual(records[1].timestamp, datetime(2022, 1, 2))
+        self.assertEqual(records[1].offset, 10)
+        self.s3.download_file.assert_not_called()
+        # Still moved to be cached
+        self.s3.copy_object.assert_called_once()
+
+    async def test_large_result(self):
+        self.statistics(1000)
+        records = await self.records()
+        self.assertEqual([record.url for record in records], [r[0] for r in self.ROWS])
+        self.s3.download_file.assert_called_once()
+        self.athena.get_paginator.assert_not_called()
+
+    async def test_csv_batches(self):
+        self.statistics(1000)
+        iterator = self.iterator(record_batch_size=1)
+        with patch.object(DomainRecordBatch, "domain_records") as domain_records:
+            batches = []
+            while (batch := await iterator.next_record_batch()) is not None:
+                batches.append(batch)
+        self.assertEqual([len(batch) for batch in batches], [1, 1])
+        self.assertEqual(batches[1][0].url, "https://seznam.cz/a")
+        self.assertEqual(batches[1][0].timestamp, datetime(2022, 1, 2))
+        # The CSV rows are decoded straight into the batches
+        domain_records.assert_not_called()
@@ -0,0 +1,252 @@
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+from urllib.parse import urlparse
+
+from cmoncrawl.aggregator.row_store_query import RowStoreAggregator
+from cmoncrawl.aggregator.utils.row_store import CDXRowStore
+from cmoncrawl.aggregator.utils.surt import url_to_surt
+from cmoncrawl.aggregator.utils.zipnum import LocalByteRangeSource
+from cmoncrawl.aggregator.zipnum_query import ZipNumAggregator
+from cmoncrawl.common.types import (
+    CollapseMode,
+    DomainRecord,
+    MatchType,
+    RecordFilter,
+)
+from tests.zipnum_test import build_zipnum_index
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    from cmoncrawl.aggregator.duckdb_query import DuckDBAggregator
+except ImportError:
+    DuckDBAggregator = None
+
+
+def build_columnar_index(root: Path, crawl: str, urls, statuses=None):
+    """
+    Builds a single parquet file of the columnar index, laid out same as cc-index/table/cc-main/warc
+    """
+    rows = sorted(
+        (url_to_surt(url), url, timestamp, (statuses or {}).get(url, 200))
+        for url, timestamp in urls
+    )
+    table = pa.table(
+        {
+            "url_surtkey": [row[0] for row in rows],
+            "url": [row[1] for row in rows],
+            "url_host_name": [urlparse(row[1]).hostname for row in rows],
+            "url_path": [urlparse(row[1]).path for row in rows],
+            "fetch_time": pa.array([row[2] for row in rows], pa.timestamp("ms")),
+            "fetch_status": pa.array([row[3] for row in rows], pa.int16()),
+            "content_digest": [f"DIGEST{i}" for i in range(len(rows))],
+            "warc_filename": [f"crawl-data/{crawl}/warc-{i}" for i in range(len(rows))],
+            "warc_record_offset": pa.array(
+                [i * 100 for i in range(len(rows))], pa.int32()
+            ),
+            "warc_record_length": pa.array([100] * len(rows), pa.int32()),
+        }
+    )
+    partition = root / f"crawl={crawl}" / "subset=warc"
+    partition.mkdir(parents=True)
+    pq.write_table(table, partition / "part-00000.parquet", row_group_size=4)
+
+
+@unittest.skipIf(DuckDBAggregator is None, "duckdb or pyarrow is not installed")
+class TestDuckDBAggregator(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.root = Path(tempfile.mkdtemp())
+        for crawl, base in [
+            ("CC-MAIN-2021-04", datetime(2021, 1, 20)),
+            ("CC-MAIN-2022-05", datetime(2022, 1, 20)),
+        ]:
+            urls = [
+                (f"https://{host}/page{i}", base + timedelta(days=i))
+                for host in ["aaa.com", "example.com", "www.example.com", "zzz.org"]
+                for i in range(3)
+            ]
+            build_columnar_index(
+                self.root,
+                crawl,
+                urls,
+                statuses={"https://example.com/page2": 404},
+            )
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.root)
+
+    async def query(self, url: str, match_type: MatchType, **kwargs):
+        async with DuckDBAggregator(
+            [url], match_type=match_type, index_path=str(self.root), **kwargs
+        ) as aggregator:
+            return [record async for record in aggregator]
+
+    async def test_host(self):
+        records = await self.query("example.com", MatchType.HOST, batch_size=2)
+        # page2 of example.com is 404
+        self.assertEqual(len(records), 10)
+        self.assertTrue(all("example.com" in record.url for record in records))
+
+    async def test_exact(self):
+        records = await self.query("https://example.com/page1", MatchType.EXACT)
+        self.assertEqual(len(records), 2)
+        self.assertTrue(all(record.digest is not None for record in records))
+
+    async def test_crawl_and_date(self):
+        records = await self.query(
+            "example.com",
+            MatchType.DOMAIN,
+            cc_servers=["https://index.commoncrawl.org/CC-MAIN-2022-05-index"],
+            since=datetime(2022, 1, 21),
+        )
+        self.assertEqual(len(records), 3)
+        self.assertTrue(
+            all(
+                record.filename.startswith("crawl-data/CC-MAIN-2022-05")
+                for record in records
+            )
+        )
+
+    async def test_no_crawl_in_range(self):
+        records = await self.query(
+            "example.com",
+            MatchType.DOMAIN,
+            cc_servers=["CC-MAIN-2021-04"],
+            since=datetime(2022, 1, 1),
+        )
+        self.assertEqual(records, [])
+
+    async def test_record_filter(self):
+        records = await self.query(
+            "example.com",
+            MatchType.HOST,
+            record_filter=RecordFilter(statuses=[404], url_regex="page[0-9]$"),
+        )
+        self.assertEqual(len(records), 2)
+        self.assertTrue(all(record.url.endswith("page2") for record in records))
+
+    async def test_collapse(self):
+        records = await self.query(
+            "example.com", MatchType.HOST, collapse=CollapseMode.LATEST
+        )
+        self.assertEqual(len(records), 3)
+        self.assertTrue(all(record.timestamp.year == 2022 for record in records))
+
+        records = await self.query(
+            "example.com", MatchType.HOST, collapse=CollapseMode.FIRST
+        )
+        self.assertEqual(len(records), 3)
+        self.assertTrue(all(record.timestamp.year == 2021 for record in records))
+
+        records = await self.query(
+            "example.com", MatchType.HOST, collapse=CollapseMode.PER_CRAWL
+        )
+        self.assertEqual(len(records), 6)
+
+    async def test_limit(self):
+        records = await self.query("example.com", MatchType.DOMAIN, limit=3)
+        self.assertEqual(len(records), 3)
+
+    async def test_batches(self):
+        async with DuckDBAggregator(
+            ["example.com"], match_type=MatchType.HOST, index_path=str(self.root)
+        ) as aggregator:
+            batches = [batch async for batch in aggregator.batches(batch_size=4)]
+        self.assertEqual([len(batch) for batch in batches], [4, 4, 2])
+        self.assertTrue(all(view.timestamp is not None for view in batches[0]))
+
+
+@unittest.skipIf(DuckDBAggregator is None, "duckdb or pyarrow is not installed")
+class TestCollapseAgreement(unittest.IsolatedAsyncioTestCase):
+    """
+    All aggregators keep the same capture of every url
+    """
+
+    CRAWLS = {
+        "CC-MAIN-2021-04": datetime(2021, 1, 20),
+        "CC-MAIN-2022-05": datetime(2022, 1, 20),
+    }
+
+    def setUp(self) -> None:
+        self.root = Path(tempfile.mkdtemp())
+        self.captures = {}
+        for crawl, base in self.CRAWLS.items():
+            # 3 captures per url, spanning the zipnum blocks, page3 only in the older crawl
+            pages = 4 if crawl == "CC-MAIN-2021-04" else 3
+            self.captures[crawl] = [
+                (f"https://example.com/page{i}", base + timedelta(days=day, hours=i))
+                for i in range(pages)
+                for day in range(3)
+            ]
+            build_columnar_index(self.root / "columnar", crawl, self.captures[crawl])
+            build_zipnum_index(self.root / "zipnum", crawl, self.captures[crawl])
+
+        store = CDXRowStore(self.root / "rows.sqlite")
+        for crawl, captures in self.captures.items():
+            fetch_id = store.begin_fetch(
+                crawl, "example.com", MatchType.HOST, datetime.min, datetime.max, 1
+            )
+            records = [
+                DomainRecord(
+                    filename=f"{crawl}-{i}",
+                    url=url,
+                    offset=i,
+                    length=1,
+                    timestamp=timestamp,
+                )
+                for i, (url, timestamp) in enumerate(captures)
+            ]
+            store.add_page(fetch_id, 0, crawl, records)
+        store.close()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.root)
+
+    async def collapsed(self, aggregator):
+        async with aggregator:
+            return sorted(
+                [(record.url, record.timestamp) async for record in aggregator]
+            )
+
+    async def test_collapse(self):
+        captures = [
+            c for crawl_captures in self.captures.values() for c in crawl_captures
+        ]
+        expected = {
+            CollapseMode.FIRST: min,
+            CollapseMode.LATEST: max,
+        }
+        for collapse in CollapseMode:
+            kwargs = dict(
+                urls=["example.com"],
+                match_type=MatchType.HOST,
+                cc_servers=list(self.CRAWLS),
+                collapse=collapse,
+            )
+            results = [
+                await self.collapsed(
+                    DuckDBAggregator(index_path=str(self.root / "columnar"), **kwargs)
+                ),
+                await self.collapsed(
+                    ZipNumAggregator(
+                        source=LocalByteRangeSource(self.root / "zipnum"), **kwargs
+                    )
+                ),
+                await self.collapsed(
+                    RowStoreAggregator(store_path=self.root / "rows.sqlite", **kwargs)
+                ),
+            ]
+            if collapse in expected:
+                urls = sorted({url for url, _ in captures})
+                results.append(
+                    [
+                        (url, expected[collapse](t for u, t in captures if u == url))
+                        for url in urls
+                    ]
+                )
+            for result in results[1:]:
+                self.assertEqual(result, results[0], collapse)
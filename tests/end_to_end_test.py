@@ -1,12 +1,16 @@
 import json
 import shutil
+import tempfile
 import unittest
 from datetime import datetime
 from pathlib import Path
+from unittest.mock import patch
 
 from parameterized import parameterized
 
 from cmoncrawl.common.types import ExtractConfig
+from cmoncrawl.integrations.commands import get_args
+from cmoncrawl.integrations.download import run_download
 from cmoncrawl.integrations.extract import (
     ExtractMode,
     extract_from_files,
@@ -99,3 +103,30 @@ class ExtractFiles(unittest.IsolatedAsyncioTestCase):
         )
 
     # TODO Add test for download
+
+
+class DownloadArgs(unittest.TestCase):
+    """
+    CLI Testing of download arguments
+    """
+
+    def record_filter(self, *args: str):
+        # The aggregator isn't created, only its arguments are checked
+        with tempfile.TemporaryDirectory() as output, patch(
+            "cmoncrawl.integrations.download.get_aggregator",
+            side_effect=RuntimeError,
+        ) as get_aggregator:
+            parsed = get_args().parse_args(
+                ["download", *args, output, "seznam.cz", "record"]
+            )
+            with self.assertRaises(RuntimeError):
+                run_download(parsed)
+        # record_filter argument
+        return get_aggregator.call_args.args[18]
+
+    def test_filter_non_200(self):
+        self.assertEqual(self.record_filter().statuses, [200])
+        self.assertEqual(self.record_filter("--filter_non_200").statuses, [200])
+
+    def test_no_filter_non_200(self):
+        self.assertIsNone(self.record_filter("--no_filter_non_200").statuses)
@@ -1,15 +1,25 @@
+import asyncio
+import json
+import shutil
+import tempfile
 import unittest
 from datetime import datetime
+from pathlib import Path
 from typing import List
+from unittest.mock import patch
 
 from cmoncrawl.aggregator.athena_query import (
     DomainRecord,
     MatchType,
 )
 from cmoncrawl.aggregator.gateway_query import GatewayAggregator
+from cmoncrawl.aggregator.row_store_query import RowStoreAggregator
+from cmoncrawl.aggregator.utils.checkpoint import AggregationCheckpoint
 from cmoncrawl.aggregator.utils.constants import CC_INDEXES_SERVER
 from cmoncrawl.aggregator.utils.helpers import get_all_CC_indexes, unify_url_id
+from cmoncrawl.aggregator.utils.row_store import CDXRowStore
 from cmoncrawl.common.throttling import Throttler
+from cmoncrawl.common.types import CollapseMode, RecordFilter
 
 
 class TestIndexerAsync(unittest.IsolatedAsyncioTestCase):
@@ -149,3 +159,316 @@ class TestIndexerAsync(unittest.IsolatedAsyncioTestCase):
         ]
         for i, url in enumerate(urls):
             self.assertEqual(unify_url_id(url), urls_ids[i])
+
+
+class TestGatewayIteratorScheduling(unittest.IsolatedAsyncioTestCase):
+    """
+    Offline tests of page scheduling, index server responses are mocked
+    """
+
+    async def asyncSetUp(self) -> None:
+        self.CC_SERVERS = [
+            f"https://index.commoncrawl.org/CC-MAIN-2022-{week:02d}-index"
+            for week in range(1, 9)
+        ]
+        self.running_discoveries = 0
+        self.max_running_discoveries = 0
+        self.discovery_params = []
+        self.page_params = []
+        # Urls of the records of a crawl, shifted by 3 for each next crawl
+        self.distinct_urls = False
+        self.retrieve_patch = patch(
+            "cmoncrawl.aggregator.gateway_query.retrieve", self.mocked_retrieve
+        )
+        self.retrieve_stream_patch = patch(
+            "cmoncrawl.aggregator.gateway_query.retrieve_stream",
+            self.mocked_retrieve_stream,
+        )
+        self.retrieve_patch.start()
+        self.retrieve_stream_patch.start()
+
+    async def asyncTearDown(self) -> None:
+        self.retrieve_patch.stop()
+        self.retrieve_stream_patch.stop()
+
+    async def mocked_retrieve(self, client, cdx_server, params, content_type, **kwargs):
+        self.discovery_params.append(params)
+        self.running_discoveries += 1
+        self.max_running_discoveries = max(
+            self.max_running_discoveries, self.running_discoveries
+        )
+        await asyncio.sleep(0.01)
+        self.running_discoveries -= 1
+        return [{"pages": 3}]
+
+    async def mocked_retrieve_stream(self, client, cdx_server, params, **kwargs):
+        self.page_params.append(params)
+        for i in range(min(5, params.get("limit", 5))):
+            await asyncio.sleep(0)
+            url = params["url"]
+            if self.distinct_urls:
+                shift = self.CC_SERVERS.index(cdx_server) * 3
+                url = f"{url}/{params['page'] * 5 + i + shift}"
+            yield {
+                "filename": cdx_server,
+                "offset": params["page"] * 5 + i,
+                "length": 1,
+                "url": url,
+                "timestamp": f"202201{params['page'] + 1:02d}00000{i}",
+            }
+
+    async def test_all_pages_are_fetched(self):
+        async with GatewayAggregator(
+            ["idnes.cz"],
+            cc_servers=self.CC_SERVERS,
+            prefetch_size=4,
+            max_inflight_pages=2,
+            max_buffered_records=3,
+            max_requests_per_second=1000,
+        ) as aggregator:
+            records = [record async for record in aggregator]
+
+        self.assertEqual(len(records), len(self.CC_SERVERS) * 3 * 5)
+        self.assertEqual(
+            len({(record.filename, record.offset) for record in records}),
+            len(records),
+        )
+        # Number of pages is looked up concurrently for upcoming crawls
+        self.assertEqual(self.max_running_discoveries, 4)
+
+    async def test_resume_from_checkpoint(self):
+        state_file = Path(tempfile.mkdtemp()) / "state.json"
+        first_run = []
+        async with GatewayAggregator(
+            ["idnes.cz"],
+            cc_servers=self.CC_SERVERS,
+            max_requests_per_second=1000,
+            max_inflight_pages=1,
+            checkpoint=AggregationCheckpoint(state_file, interval=0),
+        ) as aggregator:
+            async for record in aggregator:
+                first_run.append(record)
+                if len(first_run) == 37:
+                    break
+
+        checkpoint = AggregationCheckpoint(state_file)
+        self.assertEqual(checkpoint.total, 36)
+        async with GatewayAggregator(
+            ["idnes.cz"],
+            cc_servers=self.CC_SERVERS,
+            max_requests_per_second=1000,
+            checkpoint=checkpoint,
+        ) as aggregator:
+            second_run = [record async for record in aggregator]
+
+        all_records = {(r.filename, r.offset) for r in first_run + second_run}
+        self.assertEqual(len(all_records), len(self.CC_SERVERS) * 3 * 5)
+        # 7 pages were fully consumed, the 8th one is fetched again
+        self.assertEqual(len(second_run), len(self.CC_SERVERS) * 3 * 5 - 7 * 5)
+        shutil.rmtree(state_file.parent)
+
+    def test_checkpoint_completed_pages(self):
+        state_file = Path(tempfile.mkdtemp()) / "state.json"
+        checkpoint = AggregationCheckpoint(state_file, interval=0)
+        checkpoint.set_num_pages("cdx", "idnes.cz", 4)
+        for page in [2, 0, 2, 1]:
+            checkpoint.complete_page("cdx", "idnes.cz", page)
+        self.assertEqual(checkpoint.completed_pages("cdx", "idnes.cz"), {0, 1, 2})
+        self.assertFalse(checkpoint.is_crawl_done("cdx", "idnes.cz"))
+        with open(state_file) as f:
+            self.assertEqual(
+                json.load(f)["crawls"]["cdx idnes.cz"]["completed"], [0, 1, 2]
+            )
+
+        checkpoint = AggregationCheckpoint(state_file, interval=0)
+        self.assertEqual(checkpoint.completed_pages("cdx", "idnes.cz"), {0, 1, 2})
+        checkpoint.complete_page("cdx", "idnes.cz", 3)
+        self.assertTrue(checkpoint.is_crawl_done("cdx", "idnes.cz"))
+        shutil.rmtree(state_file.parent)
+
+    async def test_checkpoint_of_different_query(self):
+        state_file = Path(tempfile.mkdtemp()) / "state.json"
+        async with GatewayAggregator(
+            ["idnes.cz"],
+            cc_servers=self.CC_SERVERS,
+            checkpoint=AggregationCheckpoint(state_file),
+        ) as aggregator:
+            async for _ in aggregator:
+                break
+
+        async with GatewayAggregator(
+            ["example.com"],
+            cc_servers=self.CC_SERVERS,
+            checkpoint=AggregationCheckpoint(state_file),
+        ) as aggregator:
+            with self.assertRaises(ValueError):
+                aiter(aggregator)
+        shutil.rmtree(state_file.parent)
+
+    async def test_response_trimming(self):
+        async with GatewayAggregator(
+            ["idnes.cz"],
+            cc_servers=self.CC_SERVERS,
+            limit=7,
+            page_size=2,
+            max_requests_per_second=1000,
+        ) as aggregator:
+            records = [record async for record in aggregator]
+
+        self.assertEqual(len(records), 7)
+        self.assertTrue(all(p["pageSize"] == 2 for p in self.discovery_params))
+        self.assertTrue(all(p["pageSize"] == 2 for p in self.page_params))
+        self.assertTrue(all("fl" in p for p in self.page_params))
+        # Server is asked only for the remaining number of records
+        self.assertEqual([p["limit"] for p in self.page_params], [7, 2])
+
+    async def test_record_filter_pushdown(self):
+        async with GatewayAggregator(
+            ["idnes.cz"],
+            cc_servers=self.CC_SERVERS[:1],
+            max_requests_per_second=1000,
+            record_filter=RecordFilter(statuses=[200], mimes=["text/html"]),
+        ) as aggregator:
+            [record async for record in aggregator]
+
+        self.assertTrue(
+            all(
+                p["filter"] == ["status:(?:200)$", "mime-detected:(?:text/html)$"]
+                for p in self.page_params
+            )
+        )
+
+    async def test_collapse(self):
+        # All records of the mocked pages have the same url
+        async with GatewayAggregator(
+            ["idnes.cz"],
+            cc_servers=self.CC_SERVERS,
+            max_requests_per_second=1000,
+            collapse=CollapseMode.LATEST,
+        ) as aggregator:
+            records = [record async for record in aggregator]
+
+        # The latest capture of the newest crawl
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].filename, self.CC_SERVERS[-1])
+        self.assertEqual(records[0].timestamp, datetime(2022, 1, 3, 0, 0, 4))
+        # The server would keep the first capture
+        self.assertTrue(all("collapse" not in p for p in self.page_params))
+
+        self.page_params = []
+        async with GatewayAggregator(
+            ["idnes.cz"],
+            cc_servers=self.CC_SERVERS,
+            max_requests_per_second=1000,
+            collapse=CollapseMode.FIRST,
+        ) as aggregator:
+            records = [record async for record in aggregator]
+
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].filename, self.CC_SERVERS[0])
+        self.assertEqual(records[0].timestamp, datetime(2022, 1, 1))
+        self.assertTrue(all(p["collapse"] == "urlkey" for p in self.page_params))
+
+        async with GatewayAggregator(
+            ["idnes.cz"],
+            cc_servers=self.CC_SERVERS,
+            max_requests_per_second=1000,
+            collapse=CollapseMode.PER_CRAWL,
+        ) as aggregator:
+            records = [record async for record in aggregator]
+
+        self.assertEqual(
+            sorted(record.filename for record in records), sorted(self.CC_SERVERS)
+        )
+
+    async def test_collapse_limit(self):
+        self.distinct_urls = True
+        async with GatewayAggregator(
+            ["idnes.cz"],
+            cc_servers=self.CC_SERVERS[:2],
+            limit=17,
+            max_requests_per_second=1000,
+            collapse=CollapseMode.FIRST,
+        ) as aggregator:
+            records = [record async for record in aggregator]
+
+        # Duplicates of the newer crawl don't count towards the limit
+        self.assertEqual(
+            [record.url for record in records], [f"idnes.cz/{i}" for i in range(17)]
+        )
+        self.assertTrue(all("limit" not in p for p in self.page_params))
+
+    async def test_row_store(self):
+        store_path = Path(tempfile.mkdtemp()) / "rows.sqlite"
+        self.addCleanup(shutil.rmtree, store_path.parent)
+        async with GatewayAggregator(
+            ["idnes.cz"],
+            match_type=MatchType.DOMAIN,
+            cc_servers=self.CC_SERVERS[:2],
+            max_requests_per_second=1000,
+            row_store=CDXRowStore(store_path),
+        ) as aggregator:
+            fetched = [record async for record in aggregator]
+        self.assertEqual(len(fetched), 2 * 3 * 5)
+        num_requests = len(self.page_params)
+
+        async def query(**kwargs):
+            async with RowStoreAggregator(
+                ["https://www.idnes.cz/"], store_path=store_path, **kwargs
+            ) as aggregator:
+                return [record async for record in aggregator]
+
+        # Exact url is contained in the domain query
+        stored = await query(match_type=MatchType.EXACT)
+        self.assertEqual(
+            {(r.filename, r.offset) for r in stored},
+            {(r.filename, r.offset) for r in fetched},
+        )
+        self.assertEqual(
+            len(await query(match_type=MatchType.HOST, since=datetime(2022, 6, 1))),
+            0,
+        )
+        # Crawls which weren't fetched are skipped
+        self.assertEqual(len(await query(cc_servers=self.CC_SERVERS[1:])), 15)
+        self.assertEqual(len(self.page_params), num_requests)
+
+
+class TestCDXRowStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store_path = Path(tempfile.mkdtemp()) / "rows.sqlite"
+        self.store = CDXRowStore(self.store_path)
+
+    def tearDown(self) -> None:
+        self.store.close()
+        shutil.rmtree(self.store_path.parent)
+
+    def test_page_size(self):
+        def begin_fetch(num_pages: int, page_size: int):
+            return self.store.begin_fetch(
+                "CC-MAIN-2022-05",
+                "idnes.cz",
+                MatchType.DOMAIN,
+                datetime.min,
+                datetime.max,
+                num_pages,
+                page_size=page_size,
+            )
+
+        def covers():
+            return self.store.covers(
+                "CC-MAIN-2022-05",
+                "idnes.cz",
+                MatchType.HOST,
+                datetime.min,
+                datetime.max,
+            )
+
+        large_pages = begin_fetch(2, page_size=10)
+        self.store.add_page(large_pages, 0, "CC-MAIN-2022-05", [])
+        # Pages of a smaller page size don't complete the query of the large ones
+        small_pages = begin_fetch(4, page_size=5)
+        self.assertNotEqual(small_pages, large_pages)
+        self.store.add_page(small_pages, 1, "CC-MAIN-2022-05", [])
+        self.assertFalse(covers())
+        self.store.add_page(large_pages, 1, "CC-MAIN-2022-05", [])
+        self.assertTrue(covers())
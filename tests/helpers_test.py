@@ -1,7 +1,26 @@
+import asyncio
+import os
+import shutil
+import tempfile
 import unittest
-from unittest.mock import AsyncMock, MagicMock
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock, patch
 
-from cmoncrawl.aggregator.utils.helpers import all_purpose_logger, retrieve
+from aiohttp import ClientPayloadError
+
+from cmoncrawl.aggregator.utils import ndjson
+from cmoncrawl.aggregator.utils.cdx_cache import CDXResponseCache, cdx_cache_key
+from cmoncrawl.aggregator.utils.helpers import (
+    AWSClientPool,
+    all_purpose_logger,
+    retrieve,
+    retrieve_stream,
+)
+from cmoncrawl.aggregator.utils.record_buffer import RecordBuffer
+from cmoncrawl.common.bloom import ScalableBloomFilter
+from cmoncrawl.common.types import DomainRecord, DomainRecordBatch
+from cmoncrawl.middleware.synchronized import query_and_extract
 
 
 class TestRetrieve(unittest.IsolatedAsyncioTestCase):
@@ -69,3 +88,303 @@ class TestRetrieve(unittest.IsolatedAsyncioTestCase):
                 self.assertEqual(len(cm.records), 3)
                 self.assertIn(expected_log_message, cm.records[2].message)
                 self.assertIn(str(expect_additional_info), cm.records[2].message)
+
+
+async def _chunks(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+async def _records(records):
+    for record in records:
+        yield record
+
+
+class TestNdjsonStream(unittest.IsolatedAsyncioTestCase):
+    async def test_iter_decode_split_lines(self):
+        stream = _chunks(b'{"a": 1}\n{"a"', b": 2}\n\n", b'{"a": 3}')
+        decoded = [js async for js in ndjson.iter_decode(stream)]
+        self.assertEqual(decoded, [{"a": 1}, {"a": 2}, {"a": 3}])
+
+    async def test_retrieve_stream_resumes_after_broken_stream(self):
+        async def broken_stream():
+            yield b'{"a": 1}\n'
+            raise ClientPayloadError("broken")
+
+        responses = []
+        for chunks in [broken_stream(), _chunks(b'{"a": 1}\n{"a": 2}\n')]:
+            response = MagicMock()
+            response.ok = True
+            response.content.iter_any.return_value = chunks
+            responses.append(response)
+
+        mock_client = MagicMock()
+        mock_client.get = AsyncMock(side_effect=responses)
+
+        decoded = [
+            js
+            async for js in retrieve_stream(
+                mock_client, "http://test.com", {}, max_retry=1, sleep_base=1.0
+            )
+        ]
+        self.assertEqual(decoded, [{"a": 1}, {"a": 2}])
+        for response in responses:
+            response.release.assert_called_once()
+
+
+class TestRecordBuffer(unittest.IsolatedAsyncioTestCase):
+    async def test_put_waits_until_drained(self):
+        buffer: RecordBuffer[int] = RecordBuffer(max_items=2, max_bytes=100)
+        await buffer.put(1, 10)
+        await buffer.put(2, 10)
+        blocked_put = asyncio.create_task(buffer.put(3, 10))
+        await asyncio.sleep(0)
+        self.assertFalse(blocked_put.done())
+
+        self.assertEqual(buffer.get_nowait(), 1)
+        await blocked_put
+        self.assertEqual([await buffer.get(), await buffer.get()], [2, 3])
+
+    async def test_bytes_bound(self):
+        buffer: RecordBuffer[int] = RecordBuffer(max_items=100, max_bytes=15)
+        # Oversized item is accepted into an empty buffer
+        await buffer.put(1, 20)
+        self.assertTrue(buffer.full())
+        blocked_put = asyncio.create_task(buffer.put(2, 1))
+        await asyncio.sleep(0)
+        self.assertFalse(blocked_put.done())
+        await buffer.get()
+        await blocked_put
+        self.assertEqual(buffer.bytes, 1)
+
+
+class TestDomainRecordBatch(unittest.TestCase):
+    def test_round_trip(self):
+        records = [
+            DomainRecord(
+                filename="crawl-data/warc-1.warc.gz",
+                url=f"https://example.com/{i}",
+                offset=i * 100,
+                length=100,
+                digest=f"DIGEST{i}",
+                timestamp=datetime(2021, 1, 20, 10, 0, i),
+            )
+            for i in range(3)
+        ]
+        records.append(DomainRecord(filename="f", url=None, offset=0, length=1))
+        batch = DomainRecordBatch.from_domain_records(records)
+
+        self.assertEqual(len(batch), 4)
+        # Filename is stored only once
+        self.assertEqual(len(batch.filenames), 2)
+        self.assertEqual(batch[1].url, "https://example.com/1")
+        self.assertEqual(batch[-1].timestamp, None)
+        self.assertEqual(list(batch.domain_records()), records)
+
+    def test_from_columns(self):
+        batch = DomainRecordBatch.from_columns(
+            filenames=["a", "a"], urls=["u1", "u2"], offsets=[0, 10], lengths=[10, 5]
+        )
+        self.assertEqual([view.offset for view in batch], [0, 10])
+        self.assertEqual(batch[1].to_domain_record().length, 5)
+        with self.assertRaises(ValueError):
+            DomainRecordBatch.from_columns(
+                filenames=["a"], urls=["u1", "u2"], offsets=[0], lengths=[10]
+            )
+
+
+class TestCDXResponseCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cache_dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_set(self):
+        cache = CDXResponseCache(self.cache_dir)
+        params = {"url": "idnes.cz", "page": 0}
+        self.assertIsNone(cache.get("http://test.com", params))
+        cache.set("http://test.com", params, b"data")
+        self.assertEqual(cache.get("http://test.com", params), b"data")
+        self.assertIsNone(cache.get("http://test.com", {"url": "idnes.cz", "page": 1}))
+
+    def test_lru_eviction(self):
+        cache = CDXResponseCache(self.cache_dir, max_size=10)
+        cache.set("http://test.com", {"page": 0}, b"a" * 4)
+        cache.set("http://test.com", {"page": 1}, b"b" * 4)
+        # Make page 0 the oldest used entry
+        for entry in self.cache_dir.glob("*.bin"):
+            os.utime(entry, (0, 0))
+        cache.get("http://test.com", {"page": 1})
+
+        cache.set("http://test.com", {"page": 2}, b"c" * 4)
+        self.assertIsNone(cache.get("http://test.com", {"page": 0}))
+        self.assertIsNotNone(cache.get("http://test.com", {"page": 1}))
+        self.assertIsNotNone(cache.get("http://test.com", {"page": 2}))
+        self.assertLessEqual(cache.size, 10)
+
+    def test_eviction_index(self):
+        cache = CDXResponseCache(self.cache_dir, max_size=10)
+        for page in range(2):
+            cache.set("http://test.com", {"page": page}, b"a" * 4)
+        # Page 1 was used before page 0
+        os.utime(self.cache_dir / cdx_cache_key("http://test.com", {"page": 1}), (0, 0))
+
+        # The order of use is read from the cache dir only on start
+        cache = CDXResponseCache(self.cache_dir, max_size=10)
+        self.assertEqual(cache.size, 8)
+        with patch.object(Path, "glob", side_effect=AssertionError):
+            cache.set("http://test.com", {"page": 2}, b"c" * 4)
+            self.assertIsNone(cache.get("http://test.com", {"page": 1}))
+            cache.get("http://test.com", {"page": 0})
+            cache.set("http://test.com", {"page": 3}, b"d" * 4)
+        self.assertIsNotNone(cache.get("http://test.com", {"page": 0}))
+        self.assertIsNone(cache.get("http://test.com", {"page": 2}))
+        self.assertIsNotNone(cache.get("http://test.com", {"page": 3}))
+        self.assertEqual(cache.size, 8)
+
+    def test_ttl(self):
+        cache = CDXResponseCache(self.cache_dir)
+        cache.set("http://test.com", {}, b"collinfo")
+        for entry in self.cache_dir.glob("*.bin"):
+            os.utime(entry, (0, 0))
+        # Without TTL the entry never expires
+        self.assertIsNotNone(cache.get("http://test.com", {}))
+        self.assertIsNone(cache.get("http://test.com", {}, ttl=timedelta(days=1)))
+
+
+class TestScalableBloomFilter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+        for i in range(2000):
+            bloom.add(f"DIGEST{i}")
+        self.assertGreater(len(bloom.slices), 1)
+        self.assertTrue(all(f"DIGEST{i}" in bloom for i in range(2000)))
+        false_positives = sum(f"OTHER{i}" in bloom for i in range(2000))
+        self.assertLess(false_positives / 2000, 0.01)
+
+    def test_save_load(self):
+        path = Path(tempfile.mkdtemp()) / "digests.bloom"
+        self.addCleanup(shutil.rmtree, path.parent)
+        bloom = ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+        for i in range(500):
+            bloom.add(f"DIGEST{i}")
+        bloom.save(path)
+
+        loaded = ScalableBloomFilter.load(path)
+        self.assertEqual(len(loaded), len(bloom))
+        self.assertTrue(all(f"DIGEST{i}" in loaded for i in range(500)))
+
+    def test_memory_budget(self):
+        bloom = ScalableBloomFilter(
+            initial_capacity=100, error_rate=0.01, max_bytes=1000
+        )
+        for i in range(5000):
+            bloom.add(f"DIGEST{i}")
+        self.assertLessEqual(bloom.nbytes, 1000)
+        # The newest digests are kept
+        self.assertIn("DIGEST4999", bloom)
+
+    def test_memory_budget_rotation(self):
+        bloom = ScalableBloomFilter(initial_capacity=10, max_bytes=64)
+        with self.assertLogs(all_purpose_logger, level="WARNING") as logs:
+            for i in range(20_000):
+                bloom.add(f"DIGEST{i}")
+        # Single warning, the slices keep their size and error rate while rotating
+        self.assertEqual(len(logs.records), 1)
+        self.assertLessEqual(bloom.nbytes, 64)
+        self.assertGreaterEqual(min(s.error_rate for s in bloom.slices), 1e-4)
+        self.assertLessEqual(sum(s.error_rate for s in bloom.slices), 0.001)
+        self.assertIn("DIGEST19999", bloom)
+
+
+class TestDigestDeduplication(unittest.IsolatedAsyncioTestCase):
+    async def test_duplicate_digests_are_skipped(self):
+        records = [
+            DomainRecord(
+                filename=f"file{i}",
+                url=f"https://example.com/{i}",
+                offset=0,
+                length=1,
+                digest=f"DIGEST{i % 3}",
+            )
+            for i in range(6)
+        ]
+        aggregator = MagicMock()
+        aggregator.__aenter__ = AsyncMock(return_value=aggregator)
+        aggregator.__aexit__ = AsyncMock(return_value=None)
+        aggregator.__aiter__ = lambda self: _records(records)
+        pipeline = MagicMock()
+        pipeline.process_domain_record = AsyncMock(return_value=[])
+        bloom = ScalableBloomFilter(initial_capacity=10)
+
+        await query_and_extract(aggregator, pipeline, digest_filter=bloom)
+        processed = [
+            call.args[0].filename
+            for call in pipeline.process_domain_record.call_args_list
+        ]
+        self.assertEqual(processed, ["file0", "file1", "file2"])
+        self.assertTrue(all(f"DIGEST{i}" in bloom for i in range(3)))
+
+
+class TestRetrieveStreamCache(unittest.IsolatedAsyncioTestCase):
+    async def test_stream_is_cached(self):
+        cache_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = CDXResponseCache(cache_dir)
+
+        response = MagicMock()
+        response.ok = True
+        response.content.iter_any.return_value = _chunks(b'{"a": 1}\n{"a"', b": 2}\n")
+        mock_client = MagicMock()
+        mock_client.get = AsyncMock(return_value=response)
+
+        for _ in range(2):
+            decoded = [
+                js
+                async for js in retrieve_stream(
+                    mock_client,
+                    "http://test.com",
+                    {"page": 0},
+                    max_retry=1,
+                    sleep_base=1.0,
+                    cache=cache,
+                )
+            ]
+            self.assertEqual(decoded, [{"a": 1}, {"a": 2}])
+        # Second run is answered from cache
+        self.assertEqual(mock_client.get.call_count, 1)
+
+
+class TestAWSClientPool(unittest.IsolatedAsyncioTestCase):
+    async def test_shared_clients(self):
+        session = MagicMock()
+        session.client.return_value.__aenter__ = AsyncMock(
+            side_effect=lambda *args: MagicMock()
+        )
+        session.client.return_value.__aexit__ = AsyncMock(return_value=None)
+        session.region_name = "us-east-1"
+        pool = AWSClientPool(session, max_pool_connections=7)
+
+        async with pool.client("s3") as s3_first:
+            pass
+        async with pool.client("s3") as s3_second:
+            pass
+        async with pool.client("athena", region_name="us-east-1") as athena:
+            pass
+        # Without region, the region of the session is used
+        async with pool.client("athena") as athena_default_region:
+            pass
+
+        self.assertIs(s3_first, s3_second)
+        self.assertIsNot(s3_first, athena)
+        self.assertIs(athena, athena_default_region)
+        # One client per service, opened with the pool size
+        self.assertEqual(session.client.call_count, 2)
+        self.assertEqual(
+            session.client.call_args.kwargs["config"].max_pool_connections, 7
+        )
+        session.client.return_value.__aexit__.assert_not_called()
+
+        await pool.aclose()
+        self.assertEqual(session.client.return_value.__aexit__.call_count, 2)
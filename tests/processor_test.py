@@ -1,13 +1,20 @@
 import asyncio
 import json
+import multiprocessing
 import os
 import re
+import time
 import unittest
 from datetime import datetime
 from pathlib import Path
 from unittest.mock import AsyncMock
 
 from cmoncrawl.common.loggers import metadata_logger
+from cmoncrawl.common.throttling import (
+    AdaptiveThrottler,
+    SharedTokenBucketThrottler,
+    TokenBucketThrottler,
+)
 from cmoncrawl.common.types import DomainRecord, PipeMetadata
 from cmoncrawl.config import CONFIG
 from cmoncrawl.processor.dao.api import CCAPIGatewayDAO
@@ -26,6 +33,15 @@ from cmoncrawl.processor.pipeline.streamer import (
 )
 
 
+def _throttled_calls(bucket, n_calls: int):
+    async def calls():
+        throttler = SharedTokenBucketThrottler(20, bucket)
+        for _ in range(n_calls):
+            await throttler.throttle(AsyncMock())
+
+    asyncio.run(calls())
+
+
 class AsyncDownloaderTests(unittest.IsolatedAsyncioTestCase):
     async def asyncSetUp(self) -> None:
         self.dr = DomainRecord(
@@ -72,6 +88,119 @@ class AsyncDownloaderTests(unittest.IsolatedAsyncioTestCase):
         # Check if the throttler delayed the execution by at least 2 second
         self.assertTrue((end_time - start_time).total_seconds() >= 2)
 
+    async def test_adaptive_throttler(self):
+        async def dummy_download():
+            pass
+
+        async def overloaded_download():
+            raise DownloadError("Slow Down", 503)
+
+        throttler = AdaptiveThrottler(100, max_requests_per_second=1000, cooldown=0)
+        for _ in range(10):
+            await throttler.throttle(dummy_download)
+        # Additive increase
+        self.assertGreater(throttler.rate, 100)
+        self.assertLess(throttler.rate, 101)
+
+        rate = throttler.rate
+        with self.assertRaises(DownloadError):
+            await throttler.throttle(overloaded_download)
+        # Multiplicative decrease
+        self.assertAlmostEqual(throttler.rate, rate / 2)
+
+        # Not found is not an overload
+        rate = throttler.rate
+        with self.assertRaises(DownloadError):
+            await throttler.throttle(AsyncMock(side_effect=DownloadError("NF", 404)))
+        self.assertAlmostEqual(throttler.rate, rate)
+
+    async def test_token_bucket_throttler(self):
+        in_flight = 0
+        max_seen = 0
+
+        async def slow_download():
+            nonlocal in_flight, max_seen
+            in_flight += 1
+            max_seen = max(max_seen, in_flight)
+            await asyncio.sleep(0.05)
+            in_flight -= 1
+
+        throttler = TokenBucketThrottler(10, burst=5, max_in_flight=2)
+        start = time.monotonic()
+        await asyncio.gather(*[throttler.throttle(slow_download) for _ in range(5)])
+        # Burst doesn't wait for the rate, only for the in-flight slots
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(max_seen, 2)
+
+        # Bucket is empty now, so the next calls are paced by the rate
+        start = time.monotonic()
+        await asyncio.gather(*[throttler.throttle(AsyncMock()) for _ in range(5)])
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    async def test_token_bucket_per_host(self):
+        throttler = TokenBucketThrottler(1, burst=1)
+        first = throttler.for_host("index.commoncrawl.org")
+        self.assertIs(first, throttler.for_host("index.commoncrawl.org"))
+        self.assertIsNot(first, throttler.for_host("data.commoncrawl.org"))
+        # Each host has its own bucket
+        start = time.monotonic()
+        await first.throttle(AsyncMock())
+        await throttler.for_host("data.commoncrawl.org").throttle(AsyncMock())
+        self.assertLess(time.monotonic() - start, 0.5)
+        # Base throttler is shared by all hosts
+        base = Throttler(1000)
+        self.assertIs(base.for_host("index.commoncrawl.org"), base)
+
+    async def test_token_bucket_stream(self):
+        throttler = TokenBucketThrottler(100, burst=5, max_in_flight=1)
+        events = []
+
+        async def consume_stream(name: str):
+            async with throttler.throttle_stream(AsyncMock()):
+                events.append(f"open {name}")
+                await asyncio.sleep(0.05)
+                events.append(f"close {name}")
+
+        await asyncio.gather(consume_stream("a"), consume_stream("b"))
+        # The slot is held until the stream is consumed
+        self.assertEqual(events, ["open a", "close a", "open b", "close b"])
+
+    async def test_downloader_throttles_per_host(self):
+        throttler = TokenBucketThrottler(1, burst=5)
+        fake_client = AsyncMock(spec=ICC_Dao)
+        fake_client.host = "data.commoncrawl.org"
+        fake_client.fetch.side_effect = DownloadError("test", 404)
+        downloader = AsyncDownloader(dao=fake_client, max_retry=0, throttler=throttler)
+        with self.assertRaises(DownloadError):
+            await downloader.download(self.dr)
+        self.assertLess(throttler.for_host("data.commoncrawl.org").tokens, 5)
+        self.assertEqual(throttler.tokens, 5)
+
+    async def test_shared_token_bucket_across_processes(self):
+        bucket = SharedTokenBucketThrottler.new_bucket()
+        processes = [
+            multiprocessing.Process(target=_throttled_calls, args=(bucket, 5))
+            for _ in range(2)
+        ]
+        start = time.monotonic()
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        # 10 calls at 20 per second over both processes, first one is free
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+        self.assertTrue(all(process.exitcode == 0 for process in processes))
+
+    async def test_adaptive_throttler_shared(self):
+        throttler = AdaptiveThrottler(100)
+        fake_client = AsyncMock(spec=ICC_Dao)
+        fake_client.fetch.side_effect = DownloadError("test", None)
+        downloader = AsyncDownloader(dao=fake_client, max_retry=0, throttler=throttler)
+        self.assertIs(downloader.throttler, throttler)
+        with self.assertRaises(DownloadError):
+            await downloader.download(self.dr)
+        self.assertAlmostEqual(throttler.rate, 50)
+
     async def test_logging(self):
         # Create a fake client that always fails
         fake_client = AsyncMock(spec=ICC_Dao)
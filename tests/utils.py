@@ -120,6 +120,7 @@ class MySQLRecordsDB(unittest.TestCase):
                 CREATE TABLE IF NOT EXISTS {self.table_name} (
                     url VARCHAR(255),
                     fetch_time TIMESTAMP,
+                    content_digest VARCHAR(50),
                     warc_filename VARCHAR(255),
                     warc_record_offset INT,
                     warc_record_length INT,
@@ -190,7 +191,10 @@ class PatchedAWSResponse:
             content=_AsyncReader(response.content), url=response.url
         )
         if not hasattr(self.raw, "raw_headers"):
-            self.raw.raw_headers = {}
+            self.raw.raw_headers = [
+                (str(key).encode("utf-8"), str(value).encode("utf-8"))
+                for key, value in response.headers.items()
+            ]
 
 
 def _factory(
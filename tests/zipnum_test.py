@@ -0,0 +1,178 @@
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Tuple
+
+from cmoncrawl.aggregator.utils.surt import surt_range, url_to_surt
+from cmoncrawl.aggregator.utils.zipnum import (
+    ClusterIndex,
+    LocalByteRangeSource,
+)
+from cmoncrawl.aggregator.zipnum_query import ZipNumAggregator
+from cmoncrawl.common.types import CollapseMode, MatchType, RecordFilter
+
+CRAWL = "CC-MAIN-2021-04"
+BLOCK_LINES = 5
+BLOCKS_PER_SHARD = 4
+
+
+def build_zipnum_index(root: Path, crawl: str, urls: List[Tuple[str, datetime]]):
+    """
+    Builds a small zipnum index, laid out same as cc-index/collections
+    """
+    lines = []
+    for i, (url, timestamp) in enumerate(urls):
+        ts = timestamp.strftime("%Y%m%d%H%M%S")
+        js = {
+            "url": url,
+            "status": "200",
+            "digest": f"DIGEST{i}",
+            "length": "100",
+            "offset": str(i * 100),
+            "filename": f"crawl-data/{crawl}/warc-{i}.warc.gz",
+        }
+        lines.append(f"{url_to_surt(url)} {ts} {json.dumps(js)}")
+    lines.sort()
+
+    index_dir = root / crawl / "indexes"
+    index_dir.mkdir(parents=True)
+    cluster_lines = []
+    blocks = [lines[i : i + BLOCK_LINES] for i in range(0, len(lines), BLOCK_LINES)]
+    for shard_start in range(0, len(blocks), BLOCKS_PER_SHARD):
+        filename = f"cdx-{shard_start // BLOCKS_PER_SHARD:05d}.gz"
+        offset = 0
+        with open(index_dir / filename, "wb") as f:
+            for block in blocks[shard_start : shard_start + BLOCKS_PER_SHARD]:
+                data = gzip.compress(("\n".join(block) + "\n").encode())
+                f.write(data)
+                key = " ".join(block[0].split(" ")[:2])
+                cluster_lines.append(f"{key}\t{filename}\t{offset}\t{len(data)}\t1")
+                offset += len(data)
+    (index_dir / "cluster.idx").write_text("\n".join(cluster_lines) + "\n")
+
+
+class TestSurt(unittest.TestCase):
+    def test_url_to_surt(self):
+        self.assertEqual(
+            url_to_surt("https://www.Example.com/Path/?b=1&a=2"),
+            "com,example)/path?a=2&b=1",
+        )
+        self.assertEqual(url_to_surt("example.com"), "com,example)/")
+        self.assertEqual(
+            url_to_surt("http://example.com:8080/a"), "com,example:8080)/a"
+        )
+
+    def test_domain_range(self):
+        start, end = surt_range("example.com", MatchType.DOMAIN)
+        self.assertTrue(start <= "com,example)/ 2021" < end)
+        self.assertTrue(start <= "com,example,sub)/ 2021" < end)
+        self.assertFalse(start <= "com,examples)/ 2021" < end)
+        self.assertFalse(start <= "com,example-a)/ 2021" < end)
+
+
+class TestZipNumAggregator(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.root = Path(tempfile.mkdtemp())
+        base = datetime(2021, 1, 20)
+        self.urls = []
+        for host in ["aaa.com", "bbb.com", "example.com", "sub.example.com", "zzz.org"]:
+            for i in range(12):
+                self.urls.append(
+                    (f"https://{host}/page{i % 4}", base + timedelta(days=i % 3))
+                )
+        build_zipnum_index(self.root, CRAWL, self.urls)
+        self.source = LocalByteRangeSource(self.root)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.root)
+
+    async def query(self, url: str, match_type: MatchType, **kwargs):
+        async with ZipNumAggregator(
+            [url], match_type=match_type, source=self.source, **kwargs
+        ) as aggregator:
+            return [record async for record in aggregator]
+
+    async def test_bisect_matches_linear_search(self):
+        cluster_index = ClusterIndex(self.source, CRAWL, probe_size=64)
+        path = self.root / CRAWL / "indexes" / "cluster.idx"
+        keys = [line.split("\t")[0] for line in path.read_text().splitlines()]
+        for url in ["aaa.com", "example.com", "sub.example.com/page2", "zzz.org"]:
+            start, end = surt_range(url, MatchType.PREFIX)
+            blocks = await cluster_index.find_blocks(start, end)
+            first = max(sum(key < start for key in keys) - 1, 0)
+            last = sum(key < end for key in keys)
+            self.assertEqual([block.key for block in blocks], keys[first:last])
+
+    async def test_list_crawls(self):
+        async with ZipNumAggregator(["example.com"], source=self.source) as aggregator:
+            self.assertEqual(aggregator.cc_servers, [CRAWL])
+
+    async def test_exact(self):
+        records = await self.query("https://www.example.com/page1", MatchType.EXACT)
+        expected = [u for u, _ in self.urls if u == "https://example.com/page1"]
+        self.assertEqual(len(records), len(expected))
+        self.assertTrue(all(r.url == "https://example.com/page1" for r in records))
+
+    async def test_domain(self):
+        records = await self.query("example.com", MatchType.DOMAIN)
+        self.assertEqual(len(records), 24)
+        self.assertEqual(
+            {r.url.split("/")[2] for r in records if r.url},
+            {"example.com", "sub.example.com"},
+        )
+
+    async def test_host(self):
+        records = await self.query("example.com", MatchType.HOST)
+        self.assertEqual(len(records), 12)
+
+    async def test_since_to(self):
+        records = await self.query(
+            "example.com",
+            MatchType.DOMAIN,
+            since=datetime(2021, 1, 21),
+            to=datetime(2021, 1, 21, 23),
+        )
+        self.assertEqual(len(records), 8)
+        self.assertTrue(all(r.timestamp == datetime(2021, 1, 21) for r in records))
+
+    async def test_limit(self):
+        records = await self.query("example.com", MatchType.DOMAIN, limit=3)
+        self.assertEqual(len(records), 3)
+
+    async def test_collapse(self):
+        records = await self.query(
+            "example.com", MatchType.DOMAIN, collapse=CollapseMode.FIRST
+        )
+        # 4 pages of example.com and sub.example.com
+        self.assertEqual(len(records), 8)
+        self.assertEqual(len({r.url for r in records}), 8)
+        self.assertTrue(all(r.timestamp == datetime(2021, 1, 20) for r in records))
+
+    async def test_crawl_outside_of_range(self):
+        records = await self.query(
+            "example.com", MatchType.DOMAIN, since=datetime(2022, 1, 1)
+        )
+        self.assertEqual(len(records), 0)
+
+    async def test_batches(self):
+        async with ZipNumAggregator(
+            ["example.com"], match_type=MatchType.DOMAIN, source=self.source
+        ) as aggregator:
+            batches = [batch async for batch in aggregator.batches(batch_size=10)]
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 4])
+
+    async def test_record_filter(self):
+        records = await self.query(
+            "example.com",
+            MatchType.DOMAIN,
+            record_filter=RecordFilter(url_regex=r"sub\.example\.com/page[01]$"),
+        )
+        self.assertEqual(len(records), 6)
+        records = await self.query(
+            "example.com", MatchType.DOMAIN, record_filter=RecordFilter(statuses=[404])
+        )
+        self.assertEqual(records, [])